@@ -1,40 +1,332 @@
 import asyncio
+import dataclasses
+import json
+import math
 import os
+import tempfile
+import time
+from typing import AsyncIterator, Optional
 
+import psutil
 from tqdm import tqdm
 
 _ANALYSIS_TOOLS_JAR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libs", "analysis_tools.jar")
 
+JVM_BASE_MEMORY = 512 * 1024 * 1024
+JVM_APK_MEMORY_FACTOR = 8
 
-async def run_analysis_tools(output_dir: str, apk_paths: list[str]) -> dict[str, tuple[bool, str]]:
-    apk_path_args = " ".join([f"\"{i}\"" for i in apk_paths])
-    process = await asyncio.create_subprocess_shell(
-        f"java -jar \"{_ANALYSIS_TOOLS_JAR_PATH}\" --output \"{output_dir}\" {apk_path_args}",
+
+@dataclasses.dataclass(frozen=True)
+class AnalysisToolResult:
+    apk_path: str
+    success: bool
+    output: str
+    aborted: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class AnalysisShard:
+    index: int
+    apk_paths: list[str]
+    workers: int
+    max_memory: int
+    isolated: bool = False
+
+    def __str__(self) -> str:
+        return f"Shard {self.index}: APK: {len(self.apk_paths)}   Workers: {self.workers}   Heap: {self.max_memory // 1024 // 1024} MB"
+
+
+class AnalysisToolsAborted(Exception):
+    def __init__(self, reason: str, suspects: list[str], remaining: list[str]):
+        super().__init__(reason)
+        self.reason = reason
+        self.suspects = suspects
+        self.remaining = remaining
+
+
+def _parse_result_line(line: str) -> tuple[str, str]:
+    input_path, output = [i.strip().strip("\'") for i in line.split(":", 1)[1].split("->", 1)]
+    return input_path, output
+
+
+def get_analysis_tools_command(*args: str, max_memory: Optional[int] = None) -> list[str]:
+    jvm_args = [f"-Xmx{max(1, max_memory // 1024 // 1024)}m"] if max_memory is not None else []
+    return ["java", *jvm_args, "-jar", _ANALYSIS_TOOLS_JAR_PATH, *args]
+
+
+def _write_input_list(apk_paths: list[str]) -> str:
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="apk_analysis_", suffix=".txt", delete=False) as f:
+        f.write("\n".join(apk_paths))
+        return f.name
+
+
+def _get_process_rss(pid: int) -> Optional[int]:
+    try:
+        return psutil.Process(pid).memory_info().rss
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+
+
+async def iter_analysis_tools(
+        output_dir: str,
+        apk_paths: list[str],
+        workers: Optional[int] = None,
+        max_memory: Optional[int] = None,
+        show_bar: bool = True,
+        timeout: Optional[float] = None,
+        memory_limit: Optional[int] = None,
+        poll_interval: float = 1.0
+) -> AsyncIterator[AnalysisToolResult]:
+    input_list_path = _write_input_list(apk_paths)
+    tool_args = ["--workers", str(workers)] if workers is not None else []
+    process = await asyncio.create_subprocess_exec(
+        *get_analysis_tools_command("--output", output_dir, "--input-list", input_list_path, *tool_args, max_memory=max_memory),
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT
     )
+    started: dict[str, float] = {}
+    reported = set()
+    abort: Optional[tuple[str, Optional[list[str]]]] = None
+
+    async def _watch():
+        nonlocal abort
+        while process.returncode is None:
+            await asyncio.sleep(poll_interval)
+            now = time.monotonic()
+            expired = [i for i, start in started.items() if i not in reported and now - start > timeout] if timeout is not None else []
+            if len(expired) > 0:
+                abort = (f"Timeout after {timeout:.0f}s", expired)
+            elif memory_limit is not None and (_get_process_rss(process.pid) or 0) > memory_limit:
+                abort = (f"Memory limit {memory_limit // 1024 // 1024} MB exceeded", None)
+            if abort is not None and process.returncode is None:
+                process.kill()
+                return
+
+    watch_task = asyncio.create_task(_watch()) if timeout is not None or memory_limit is not None else None
     process_start = False
-    result: dict[str, tuple[bool, str]] = {}
-    with tqdm(total=len(apk_paths)) as pbar:
-        while True:
-            line = await process.stdout.readline()
-            if line == b'':
-                break
-            elif line:
+    try:
+        with tqdm(total=len(apk_paths), disable=not show_bar) as pbar:
+            while True:
+                line = await process.stdout.readline()
+                if line == b'':
+                    break
                 line_str = line.decode().strip()
                 if process_start:
-                    if line_str.startswith("Success"):
+                    if line_str.startswith("Start:"):
+                        started[line_str.split(":", 1)[1].strip().strip("\'")] = time.monotonic()
+                    elif line_str.startswith("Success"):
                         pbar.update(1)
-                        input_path, output_path = [i.strip().strip("\'") for i in line_str.split(":")[1].split("->")]
-                        result[input_path] = (True, output_path)
+                        input_path, output_path = _parse_result_line(line_str)
+                        reported.add(input_path)
+                        yield AnalysisToolResult(input_path, True, output_path)
                     elif line_str.startswith("Error"):
                         pbar.update(1)
-                        input_path, error = [i.strip().strip("\'") for i in line_str.split(":")[1].split("->")]
-                        result[input_path] = (True, error)
+                        input_path, error = _parse_result_line(line_str)
+                        reported.add(input_path)
+                        yield AnalysisToolResult(input_path, False, error)
+                    elif line_str.startswith("Finish:"):
+                        break
                 elif line_str.startswith("Total:"):
                     pbar.reset(total=int(line_str.split(":")[1].strip()))
                     process_start = True
-                elif line_str.startswith("Finish:"):
-                    break
-    await process.wait()
-    return result
+        return_code = await process.wait()
+        unreported = [i for i in apk_paths if i not in reported]
+        if len(unreported) > 0:
+            reason, suspects = abort if abort is not None else (f"Analysis tools exited with code {return_code}", None)
+            if suspects is None:
+                suspects = [i for i in unreported if i in started]
+            raise AnalysisToolsAborted(reason, suspects, [i for i in unreported if i not in suspects])
+    finally:
+        if watch_task is not None:
+            watch_task.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        os.remove(input_list_path)
+
+
+def _get_apk_size(apk_path: str) -> int:
+    try:
+        return os.path.getsize(apk_path)
+    except OSError:
+        return 0
+
+
+class AnalysisQuarantine:
+    def __init__(self, path: str):
+        self._path = path
+        self._entries: dict[str, dict[str, str]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+
+    @staticmethod
+    def _key(apk_path: str) -> str:
+        return f"{os.path.basename(apk_path)}:{_get_apk_size(apk_path)}"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, apk_path: str) -> bool:
+        return self._key(apk_path) in self._entries
+
+    def get_reason(self, apk_path: str) -> Optional[str]:
+        entry = self._entries.get(self._key(apk_path))
+        return entry["reason"] if entry is not None else None
+
+    def add(self, apk_path: str, reason: str):
+        self._entries[self._key(apk_path)] = {"path": apk_path, "reason": reason, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.save()
+
+    def remove(self, apk_path: str):
+        if self._entries.pop(self._key(apk_path), None) is not None:
+            self.save()
+
+    def save(self):
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self._path)
+
+
+class AnalysisShardScheduler:
+    def __init__(
+            self,
+            apk_paths: list[str],
+            jvms: Optional[int] = None,
+            jvm_workers: int = 2,
+            memory_ratio: float = 0.5,
+            min_shard_size: int = 4
+    ):
+        self._jvm_workers = jvm_workers
+        self._jvms = jvms if jvms is not None else max(1, (psutil.cpu_count() or 1) // jvm_workers)
+        self._memory_budget = int(psutil.virtual_memory().available * memory_ratio)
+        self._min_shard_size = min_shard_size
+        self._pending = sorted(apk_paths, key=_get_apk_size, reverse=True)
+        self._isolated: list[tuple[str, int]] = []
+        self._reserved: dict[int, int] = {}
+        self._shard_count = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending) + len(self._isolated)
+
+    @property
+    def running(self) -> int:
+        return len(self._reserved)
+
+    @staticmethod
+    def estimate_memory(apk_paths: list[str], workers: int) -> int:
+        return JVM_BASE_MEMORY + JVM_APK_MEMORY_FACTOR * sum(sorted((_get_apk_size(i) for i in apk_paths), reverse=True)[:workers])
+
+    def requeue(self, apk_paths: list[str]):
+        self._pending = apk_paths + self._pending
+
+    def isolate(self, apk_path: str, max_memory: int):
+        self._isolated.append((apk_path, max(max_memory, self.estimate_memory([apk_path], 1))))
+
+    def _reserve(self, apk_paths: list[str], workers: int, max_memory: int, isolated: bool) -> Optional[AnalysisShard]:
+        if len(self._reserved) > 0 and sum(self._reserved.values()) + max_memory > self._memory_budget:
+            return None
+        shard = AnalysisShard(self._shard_count, apk_paths, workers, max_memory, isolated)
+        self._shard_count += 1
+        self._reserved[shard.index] = max_memory
+        return shard
+
+    def next_shard(self) -> Optional[AnalysisShard]:
+        if len(self._reserved) >= self._jvms:
+            return None
+        if len(self._isolated) > 0:
+            apk_path, max_memory = self._isolated[0]
+            shard = self._reserve([apk_path], 1, max_memory, True)
+            if shard is not None:
+                self._isolated.pop(0)
+            return shard
+        if len(self._pending) == 0:
+            return None
+        size = max(self._min_shard_size, math.ceil(len(self._pending) / (2 * self._jvms)))
+        apk_paths = self._pending[:size]
+        shard = self._reserve(apk_paths, self._jvm_workers, self.estimate_memory(apk_paths, self._jvm_workers), False)
+        if shard is not None:
+            self._pending = self._pending[size:]
+        return shard
+
+    def finish_shard(self, shard: AnalysisShard):
+        self._reserved.pop(shard.index, None)
+
+
+async def iter_sharded_analysis_tools(
+        output_dir: str,
+        apk_paths: list[str],
+        jvms: Optional[int] = None,
+        jvm_workers: int = 2,
+        memory_ratio: float = 0.5,
+        apk_timeout: Optional[float] = None,
+        memory_limit_ratio: Optional[float] = None,
+        quarantine: Optional[AnalysisQuarantine] = None
+) -> AsyncIterator[AnalysisToolResult]:
+    results: asyncio.Queue[Optional[AnalysisToolResult]] = asyncio.Queue()
+    if quarantine is not None:
+        for apk_path in [i for i in apk_paths if i in quarantine]:
+            results.put_nowait(AnalysisToolResult(apk_path, False, f"Quarantined: {quarantine.get_reason(apk_path)}"))
+        scheduler = AnalysisShardScheduler([i for i in apk_paths if i not in quarantine], jvms, jvm_workers, memory_ratio)
+    else:
+        scheduler = AnalysisShardScheduler(apk_paths, jvms, jvm_workers, memory_ratio)
+    shard_finished = asyncio.Event()
+
+    async def _run_shard(shard: AnalysisShard):
+        memory_limit = int(shard.max_memory * memory_limit_ratio) if memory_limit_ratio is not None else None
+        reported = set()
+        try:
+            async for result in iter_analysis_tools(output_dir, shard.apk_paths, shard.workers, shard.max_memory, False, apk_timeout, memory_limit):
+                reported.add(result.apk_path)
+                await results.put(result)
+        except AnalysisToolsAborted as e:
+            if len(e.suspects) == 0:
+                for apk_path in e.remaining:
+                    await results.put(AnalysisToolResult(apk_path, False, e.reason))
+            elif shard.isolated:
+                for apk_path in e.suspects:
+                    if quarantine is not None:
+                        quarantine.add(apk_path, e.reason)
+                    await results.put(AnalysisToolResult(apk_path, False, e.reason))
+            else:
+                for apk_path in e.suspects:
+                    scheduler.isolate(apk_path, shard.max_memory)
+                scheduler.requeue(e.remaining)
+        except Exception as e:
+            for apk_path in shard.apk_paths:
+                if apk_path not in reported:
+                    await results.put(AnalysisToolResult(apk_path, False, f"{type(e).__name__}: {e}"))
+        finally:
+            scheduler.finish_shard(shard)
+            shard_finished.set()
+
+    async def _schedule():
+        tasks = set()
+        try:
+            while scheduler.pending > 0 or len(tasks) > 0:
+                while (shard := scheduler.next_shard()) is not None:
+                    tasks.add(asyncio.create_task(_run_shard(shard)))
+                shard_finished.clear()
+                await shard_finished.wait()
+                tasks = {i for i in tasks if not i.done()}
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await results.put(None)
+
+    schedule_task = asyncio.create_task(_schedule())
+    try:
+        with tqdm(total=len(apk_paths)) as pbar:
+            while (result := await results.get()) is not None:
+                pbar.update(1)
+                yield result
+        await schedule_task
+    finally:
+        schedule_task.cancel()
+
+
+async def run_analysis_tools(output_dir: str, apk_paths: list[str]) -> dict[str, tuple[bool, str]]:
+    return {i.apk_path: (i.success, i.output) async for i in iter_sharded_analysis_tools(output_dir, apk_paths)}
@@ -0,0 +1,100 @@
+import dataclasses
+import time
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+DEFAULT_MAX_TOKENS = 16384
+
+
+@dataclasses.dataclass
+class BatchingStats:
+    batches: int = 0
+    items: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def padding_efficiency(self) -> float:
+        return self.tokens / self.padded_tokens if self.padded_tokens > 0 else 1.0
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else float("inf")
+
+    def add(self, lengths: np.ndarray, batches: list[np.ndarray], seconds: float):
+        self.batches += len(batches)
+        self.items += len(lengths)
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += sum(int(lengths[indexes].max()) * len(indexes) for indexes in batches if len(indexes) > 0)
+        self.seconds += seconds
+
+    def __str__(self) -> str:
+        return (f"Batches: {self.batches}   Items: {self.items}   Padding efficiency: {self.padding_efficiency:.2%}   "
+                f"Throughput: {self.throughput:.1f} items/s")
+
+
+def plan_fixed_batches(lengths: Sequence[int], batch_size: int) -> list[np.ndarray]:
+    indexes = np.arange(len(lengths))
+    return [indexes[i:i + batch_size] for i in range(0, len(indexes), batch_size)]
+
+
+def plan_token_batches(lengths: Sequence[int], max_tokens: Optional[int] = DEFAULT_MAX_TOKENS, max_batch_size: int = 256) -> list[np.ndarray]:
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    if max_tokens is None:
+        return [order[i:i + max_batch_size] for i in range(0, len(order), max_batch_size)]
+
+    batches = []
+    start = 0
+    while start < len(order):
+        width = max(int(lengths[order[start]]), 1)
+        size = min(max(max_tokens // width, 1), max_batch_size)
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def run_batches(
+        texts: list[str],
+        lengths: np.ndarray,
+        batches: list[np.ndarray],
+        func: Callable[[list[str]], np.ndarray],
+        stats: Optional[BatchingStats] = None,
+        show_progress_bar: bool = False
+) -> np.ndarray:
+    start = time.perf_counter()
+    result: Optional[np.ndarray] = None
+    for indexes in tqdm(batches, desc="Batches", disable=not show_progress_bar):
+        output = func([texts[i] for i in indexes])
+        if result is None:
+            result = np.zeros((len(texts),) + output.shape[1:], dtype=output.dtype)
+        result[indexes] = output
+    if stats is not None:
+        stats.add(lengths, batches, time.perf_counter() - start)
+    return result if result is not None else np.zeros((0,), dtype=np.float32)
+
+
+def predict_multi_label(
+        model: torch.nn.Module,
+        tokenizer: Callable,
+        texts: list[str],
+        device: torch.device,
+        max_length: int,
+        max_tokens: Optional[int] = DEFAULT_MAX_TOKENS,
+        max_batch_size: int = 256,
+        stats: Optional[BatchingStats] = None,
+        show_progress_bar: bool = False
+) -> np.ndarray:
+    def _predict(batch_texts: list[str]) -> np.ndarray:
+        inputs = tokenizer(batch_texts, max_length=max_length, padding=True, truncation=True, return_tensors="pt")
+        with torch.no_grad():
+            logits = model(inputs["input_ids"].to(device), attention_mask=inputs["attention_mask"].to(device))[0]
+        return torch.sigmoid(logits).float().cpu().numpy()
+
+    lengths = np.array([len(i) for i in tokenizer(texts, max_length=max_length, truncation=True)["input_ids"]], dtype=np.int64)
+    model.eval()
+    return run_batches(texts, lengths, plan_token_batches(lengths, max_tokens, max_batch_size), _predict, stats, show_progress_bar)
@@ -0,0 +1,238 @@
+import dataclasses
+import random
+import re
+import time
+from typing import Callable, Collection, Optional, TypeVar
+
+import numpy as np
+import spacy
+
+from .batching import DEFAULT_MAX_TOKENS, BatchingStats, plan_fixed_batches, plan_token_batches, run_batches
+from .encoder import load_sentence_encoder
+from .lexical import CascadeRecall, LexicalPrefilter, measure_cascade_recall
+from .nlp import NGramIndex, calculate_cascade_similarity, calculate_cosine_similarity, calculate_transformer_centroid_similarity, \
+    calculate_vector_cosine_similarity, clean_text, n_gram, normalize_text, normalize_texts
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass(frozen=True)
+class TimingResult:
+    name: str
+    seconds: float
+    items: int
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else float("inf")
+
+    def __str__(self) -> str:
+        return f"{self.name}: {self.seconds:.3f}s ({self.throughput:.1f} items/s)"
+
+
+def measure(name: str, items: int, func: Callable[[], T], repeat: int = 1) -> tuple[TimingResult, T]:
+    result = None
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return TimingResult(name=name, seconds=best, items=items), result
+
+
+def legacy_normalize_texts(strings: Collection[str]) -> list[str]:
+    re_strings = []
+    for string in strings:
+        string = re.sub(r"https?://\S+", "", string)
+        string = re.sub(r"<.*?>", " ", string)
+        string = re.sub(r"\b[0-9]+\b\s*", "", string)
+        string = re.sub(r"([a-z]|\d)([A-Z])", r"\1 \2", string)
+        string = " ".join(string.split())
+        string = string.lower().strip()
+        re_strings.append(string)
+    return re_strings
+
+
+# noinspection SpellCheckingInspection
+def legacy_clean_text(strings: Collection[str], model: str) -> list[str]:
+    nlp = spacy.load(model)
+    re_strings = [i for i in legacy_normalize_texts(strings) if len(i) > 2]
+    clean_texts = []
+    for doc in nlp.pipe(re_strings):
+        for sentence_doc in doc.sents:
+            sentence = []
+            for token in sentence_doc:
+                if not token.is_punct and not token.is_stop and \
+                        not token.like_num and not token.like_email and not token.like_url and \
+                        not token.is_space and token.is_alpha and len(token.lemma_) > 1:
+                    sentence.append(token.lemma_)
+            if len(sentence) > 0:
+                clean_texts.append(" ".join(sentence))
+    return clean_texts
+
+
+def benchmark_clean_text(strings: list[str], model: str, sentence_splitter: str = "parser") -> tuple[bool, list[TimingResult]]:
+    legacy_timing, legacy_result = measure("Legacy clean text", len(strings), lambda: legacy_clean_text(strings, model))
+    load_timing, _ = measure(f"Text cleaner first call ({sentence_splitter})", len(strings), lambda: clean_text(strings, model, sentence_splitter=sentence_splitter))
+    cleaner_timing, cleaner_result = measure(
+        f"Text cleaner warm call ({sentence_splitter})",
+        len(strings),
+        lambda: clean_text(strings, model, sentence_splitter=sentence_splitter),
+        repeat=3
+    )
+    return legacy_result == cleaner_result, [legacy_timing, load_timing, cleaner_timing]
+
+
+def benchmark_normalize_text(strings: list[str], repeat: int = 3) -> tuple[bool, list[TimingResult]]:
+    legacy_timing, legacy_result = measure("Legacy normalize loop", len(strings), lambda: legacy_normalize_texts(strings), repeat)
+    single_timing, single_result = measure("Compiled normalize", len(strings), lambda: [normalize_text(i) for i in strings], repeat)
+    batch_timing, batch_result = measure("Compiled batch normalize", len(strings), lambda: normalize_texts(strings), repeat)
+    return legacy_result == single_result == batch_result, [legacy_timing, single_timing, batch_timing]
+
+
+def make_synthetic_corpus(categories: dict[str, set[str]], size: int, max_tokens: int = 12, seed: int = 9326) -> list[str]:
+    rand = random.Random(seed)
+    labels = sorted({i for v in categories.values() for i in v})
+    words = sorted({j for i in labels for j in i.split()})
+    corpus = []
+    for _ in range(size):
+        tokens = []
+        while len(tokens) < rand.randint(1, max_tokens):
+            if rand.random() < 0.3:
+                tokens.extend(rand.choice(labels).split())
+            else:
+                tokens.append(rand.choice(words))
+        corpus.append(" ".join(tokens))
+    return corpus
+
+
+def legacy_calculate_n_gram_similarity(strings: list[str], categories_docs: dict[str, list[tuple[str]]]) -> list[dict[str, float]]:
+    all_scores: list[dict[str, float]] = []
+    for idx, text in enumerate(strings):
+        tokens: list[str] = text.split()
+        scores: dict[str, float] = {}
+        for category, category_words in categories_docs.items():
+            similarities = []
+            for category_tokens in category_words:
+                if len(category_tokens) <= len(tokens):
+                    tokens_pairs = n_gram(tokens, len(category_tokens))
+                    similarities.append(tokens_pairs.count(category_tokens))
+                else:
+                    similarities.append(0.0)
+            scores[category] = sum(similarities) / len(similarities)
+        all_scores.append(scores)
+    return all_scores
+
+
+def benchmark_n_gram_similarity(strings: list[str], categories: dict[str, set[str]]) -> tuple[bool, list[TimingResult]]:
+    categories_docs = {k: [tuple(i.split()) for i in v] for k, v in categories.items()}
+    legacy_timing, legacy_result = measure("Legacy n gram similarity", len(strings), lambda: legacy_calculate_n_gram_similarity(strings, categories_docs))
+
+    def _index_similarity() -> list[dict[str, float]]:
+        n_gram_index = NGramIndex(categories_docs)
+        return [n_gram_index.score(text.split()) for text in strings]
+
+    index_timing, index_result = measure("Indexed n gram similarity", len(strings), _index_similarity)
+    return legacy_result == index_result, [legacy_timing, index_timing]
+
+
+def max_score_difference(scores1: dict[int, dict[str, float]], scores2: dict[int, dict[str, float]]) -> float:
+    categories = sorted(next(iter(scores1.values())).keys())
+    matrix1 = np.array([[scores1[i][c] for c in categories] for i in range(len(scores1))], dtype=np.float64)
+    matrix2 = np.array([[scores2[i][c] for c in categories] for i in range(len(scores2))], dtype=np.float64)
+    return float(np.abs(matrix1 - matrix2).max())
+
+
+def benchmark_cosine_similarity(strings: list[str], categories: dict[str, set[str]], model: str) -> tuple[float, list[TimingResult]]:
+    legacy_timing, legacy_result = measure("Doc similarity", len(strings), lambda: calculate_cosine_similarity(strings, categories, model))
+    vector_timing, vector_result = measure("Vectorized similarity", len(strings), lambda: calculate_vector_cosine_similarity(strings, categories, model))
+    return max_score_difference(legacy_result, vector_result), [legacy_timing, vector_timing]
+
+
+@dataclasses.dataclass(frozen=True)
+class EncoderAccuracy:
+    min_label_cosine: Optional[float]
+    mean_label_cosine: Optional[float]
+    max_score_difference: float
+    decision_agreement: float
+
+    def __str__(self) -> str:
+        label_cosine = f"min {self.min_label_cosine:.4f} mean {self.mean_label_cosine:.4f}" if self.min_label_cosine is not None else "n/a"
+        return (f"Label embedding cosine: {label_cosine}   "
+                f"Max score difference: {self.max_score_difference:.4f}   Threshold agreement: {self.decision_agreement:.4%}")
+
+
+def benchmark_sentence_encoder(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        threshold: float,
+        reference_model: str,
+        model: str,
+        threads: Optional[int] = None
+) -> tuple[EncoderAccuracy, list[TimingResult]]:
+    reference_encoder = load_sentence_encoder(reference_model, threads)
+    encoder = load_sentence_encoder(model, threads)
+
+    label_cosine = None
+    if encoder.dimension == reference_encoder.dimension:
+        labels = sorted(set().union(*categories.values()))
+        label_cosine = (reference_encoder.encode(labels, normalize_embeddings=True) * encoder.encode(labels, normalize_embeddings=True)).sum(axis=1)
+
+    reference_timing, (reference_scores, _) = measure(
+        reference_model, len(strings),
+        lambda: calculate_transformer_centroid_similarity(strings, categories, reference_encoder)
+    )
+    timing, (scores, _) = measure(model, len(strings), lambda: calculate_transformer_centroid_similarity(strings, categories, encoder))
+    accuracy = EncoderAccuracy(
+        min_label_cosine=float(label_cosine.min()) if label_cosine is not None else None,
+        mean_label_cosine=float(label_cosine.mean()) if label_cosine is not None else None,
+        max_score_difference=float(np.abs(reference_scores - scores).max()),
+        decision_agreement=float(((reference_scores >= threshold) == (scores >= threshold)).mean())
+    )
+    return accuracy, [reference_timing, timing]
+
+
+def benchmark_lexical_prefilter(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        threshold: float,
+        model: str,
+        min_overlap: int = 1,
+        threads: Optional[int] = None
+) -> tuple[CascadeRecall, list[TimingResult]]:
+    encoder = load_sentence_encoder(model, threads)
+    prefilter = LexicalPrefilter(categories, min_overlap)
+
+    def _score(texts: list[str]) -> tuple[np.ndarray, list[str]]:
+        return calculate_transformer_centroid_similarity(texts, categories, encoder)
+
+    full_timing, (full_scores, _) = measure("Full transformer", len(strings), lambda: _score(strings))
+    cascade_timing, (cascade_scores, _, mask) = measure("Lexical cascade", len(strings), lambda: calculate_cascade_similarity(strings, prefilter, _score))
+    return measure_cascade_recall(full_scores, cascade_scores, mask, threshold), [full_timing, cascade_timing]
+
+
+def benchmark_token_batching(
+        strings: list[str],
+        model: str,
+        batch_size: int = 256,
+        max_tokens: int = DEFAULT_MAX_TOKENS
+) -> tuple[float, list[tuple[str, BatchingStats]]]:
+    encoder = load_sentence_encoder(model)
+    lengths = encoder.token_lengths(strings)
+    plans = [
+        ("Fixed count, input order", plan_fixed_batches(lengths, batch_size)),
+        ("Fixed count, length sorted", plan_token_batches(lengths, None, batch_size)),
+        (f"Token budget {max_tokens}", plan_token_batches(lengths, max_tokens, batch_size)),
+    ]
+    results = []
+    reference = None
+    max_difference = 0.0
+    for name, batches in plans:
+        stats = BatchingStats()
+        embeddings = run_batches(strings, lengths, batches, encoder.encode_batch, stats)
+        if reference is None:
+            reference = embeddings
+        else:
+            max_difference = max(max_difference, float(np.abs(reference - embeddings).max()))
+        results.append((name, stats))
+    return max_difference, results
@@ -0,0 +1,130 @@
+import dataclasses
+import functools
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Collection, Iterable
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"Hits: {self.hits}   Misses: {self.misses}   Hit rate: {self.hit_rate:.2%}   Evictions: {self.evictions}"
+
+
+def synchronized(method: Callable) -> Callable:
+    @functools.wraps(method)
+    def _wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return _wrapper
+
+
+class CleanTextCache:
+    _QUERY_BATCH_SIZE = 500
+    _EVICTION_RATIO = 0.9
+
+    def __init__(self, path: str, namespace: str, max_size: int = 1024 * 1024 * 1024):
+        self._namespace = namespace
+        self._max_size = max_size
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, access INTEGER NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (access)")
+        self._connection.commit()
+        self._size: int = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self.stats = CacheStats()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self._namespace}\0{text}".encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def _batches(self, items: list) -> Iterable[list]:
+        for i in range(0, len(items), self._QUERY_BATCH_SIZE):
+            yield items[i:i + self._QUERY_BATCH_SIZE]
+
+    @synchronized
+    def get_many(self, texts: Collection[str]) -> dict[str, list[str]]:
+        keys = {self._key(text): text for text in texts}
+        result: dict[str, list[str]] = {}
+        for batch_keys in self._batches(list(keys.keys())):
+            rows = self._connection.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})",
+                batch_keys
+            ).fetchall()
+            for key, value in rows:
+                result[keys[key]] = json.loads(value)
+            if len(rows) > 0:
+                access = time.time_ns()
+                self._connection.executemany("UPDATE entries SET access = ? WHERE key = ?", [(access, key) for key, _ in rows])
+        self._connection.commit()
+        self.stats.hits += len(result)
+        self.stats.misses += len(keys) - len(result)
+        return result
+
+    @synchronized
+    def put_many(self, items: dict[str, list[str]]):
+        access = time.time_ns()
+        rows = []
+        for text, value in items.items():
+            content = json.dumps(value, ensure_ascii=False)
+            rows.append((self._key(text), content, len(content.encode("utf-8", "surrogatepass")), access))
+        for batch_rows in self._batches(rows):
+            batch_keys = [row[0] for row in batch_rows]
+            self._size -= self._connection.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})",
+                batch_keys
+            ).fetchone()[0]
+            self._connection.executemany("INSERT OR REPLACE INTO entries (key, value, size, access) VALUES (?, ?, ?, ?)", batch_rows)
+            self._size += sum(row[2] for row in batch_rows)
+        self._connection.commit()
+        if self._size > self._max_size:
+            self.evict(int(self._max_size * self._EVICTION_RATIO))
+
+    @synchronized
+    def evict(self, target_size: int):
+        cursor = self._connection.execute("SELECT key, size FROM entries ORDER BY access")
+        evict_keys = []
+        while self._size > target_size:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            evict_keys.append(row[0])
+            self._size -= row[1]
+        cursor.close()
+        for batch_keys in self._batches(evict_keys):
+            self._connection.execute(f"DELETE FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})", batch_keys)
+        self._connection.commit()
+        self.stats.evictions += len(evict_keys)
+
+    @synchronized
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self) -> 'CleanTextCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
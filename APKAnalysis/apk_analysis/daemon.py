@@ -0,0 +1,384 @@
+import abc
+import asyncio
+import dataclasses
+import itertools
+import json
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Optional
+
+from tqdm import tqdm
+
+from .analysis import AnalysisQuarantine, AnalysisToolResult, _get_process_rss, get_analysis_tools_command
+
+DEFAULT_ANALYSIS_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "apk_analysis_tools.sock")
+
+
+@dataclasses.dataclass
+class AnalysisDaemonStats:
+    starts: int = 0
+    requests: int = 0
+    failures: int = 0
+    retries: int = 0
+    resubmits: int = 0
+    aborts: int = 0
+    quarantined: int = 0
+    health_check_failures: int = 0
+
+    def __str__(self) -> str:
+        return (f"Starts: {self.starts}   Requests: {self.requests}   Failures: {self.failures}   "
+                f"Retries: {self.retries}   Resubmits: {self.resubmits}   Aborts: {self.aborts}   Quarantined: {self.quarantined}   "
+                f"Health check failures: {self.health_check_failures}")
+
+
+class AnalysisRequestDropped(ConnectionError):
+    pass
+
+
+class AnalysisRequestInterrupted(ConnectionError):
+    pass
+
+
+class _AnalysisToolsClient(abc.ABC):
+    def __init__(self, apk_timeout: Optional[float] = None, quarantine: Optional[AnalysisQuarantine] = None):
+        self._apk_timeout = apk_timeout
+        self._quarantine = quarantine
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._started: dict[int, float] = {}
+        self._timeouts: dict[int, float] = {}
+        self._aborted: dict[int, str] = {}
+        self.stats = AnalysisDaemonStats()
+
+    @abc.abstractmethod
+    async def _get_writer(self) -> asyncio.StreamWriter:
+        pass
+
+    @abc.abstractmethod
+    async def _analyze(self, apk_path: str, timeout: Optional[float]) -> dict:
+        pass
+
+    def _dispatch_response(self, line: bytes):
+        try:
+            response = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        if response.get("op") == "start":
+            if response.get("id") in self._pending:
+                self._started.setdefault(response["id"], time.monotonic())
+            return
+        future = self._pending.get(response.get("id"))
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def _fail_pending(self, message: str, recoverable: bool = True):
+        for request_id, future in self._pending.items():
+            if not future.done():
+                if not recoverable:
+                    future.set_exception(ConnectionError(message))
+                elif request_id in self._aborted:
+                    future.set_result({"op": "result", "success": False, "output": self._aborted[request_id], "aborted": True})
+                elif request_id in self._started:
+                    future.set_exception(AnalysisRequestInterrupted(message))
+                else:
+                    future.set_exception(AnalysisRequestDropped(message))
+
+    async def _request(self, request: dict, writer: Optional[asyncio.StreamWriter] = None, timeout: Optional[float] = None) -> dict:
+        writer = writer if writer is not None else await self._get_writer()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        if timeout is not None:
+            self._timeouts[request_id] = timeout
+        try:
+            try:
+                writer.write(json.dumps({**request, "id": request_id}).encode("utf-8") + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                pass
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+            self._started.pop(request_id, None)
+            self._timeouts.pop(request_id, None)
+            self._aborted.pop(request_id, None)
+
+    async def ping(self) -> bool:
+        return (await self._request({"op": "ping"})).get("op") == "pong"
+
+    async def analyze(self, apk_path: str, timeout: Optional[float] = None) -> AnalysisToolResult:
+        if self._quarantine is not None and apk_path in self._quarantine:
+            self.stats.quarantined += 1
+            return AnalysisToolResult(apk_path, False, f"Quarantined: {self._quarantine.get_reason(apk_path)}")
+        self.stats.requests += 1
+        try:
+            response = await self._analyze(apk_path, timeout if timeout is not None else self._apk_timeout)
+        except ConnectionError as e:
+            response = {"op": "error", "output": str(e)}
+        if response.get("op") != "result" or not response.get("success", False):
+            self.stats.failures += 1
+        if response.get("op") != "result":
+            return AnalysisToolResult(apk_path, False, response.get("output", "Unknown error"))
+        aborted = response.get("aborted", False)
+        if aborted:
+            self.stats.aborts += 1
+            if self._quarantine is not None:
+                self._quarantine.add(apk_path, response["output"])
+        return AnalysisToolResult(apk_path, response["success"], response["output"], aborted)
+
+    async def iter_analysis(self, apk_paths: list[str]) -> AsyncIterator[AnalysisToolResult]:
+        tasks = [asyncio.ensure_future(self.analyze(i)) for i in apk_paths]
+        try:
+            with tqdm(total=len(apk_paths)) as pbar:
+                for task in asyncio.as_completed(tasks):
+                    result = await task
+                    pbar.update(1)
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class AnalysisToolsDaemon(_AnalysisToolsClient):
+    def __init__(
+            self,
+            output_dir: str,
+            workers: Optional[int] = None,
+            max_memory: Optional[int] = None,
+            ping_interval: float = 30.0,
+            ping_timeout: float = 10.0,
+            start_timeout: float = 120.0,
+            apk_timeout: Optional[float] = None,
+            memory_limit: Optional[int] = None,
+            poll_interval: float = 1.0,
+            quarantine: Optional[AnalysisQuarantine] = None
+    ):
+        super().__init__(apk_timeout, quarantine)
+        self._output_dir = output_dir
+        self._workers = workers
+        self._max_memory = max_memory
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout
+        self._start_timeout = start_timeout
+        self._memory_limit = memory_limit
+        self._poll_interval = poll_interval
+        self._abort_reason: Optional[str] = None
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._tasks: list[asyncio.Task] = []
+        self._start_lock = asyncio.Lock()
+        self._retry_lock = asyncio.Lock()
+        self._closing = False
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    async def _wait_ready(self, process: asyncio.subprocess.Process):
+        while line := await process.stdout.readline():
+            try:
+                if json.loads(line).get("op") == "ready":
+                    return
+            except json.JSONDecodeError:
+                pass
+        raise ConnectionError(f"Analysis tools daemon exited with code {await process.wait()} before ready")
+
+    async def _read_responses(self, process: asyncio.subprocess.Process):
+        while line := await process.stdout.readline():
+            self._dispatch_response(line)
+        return_code = await process.wait()
+        self._fail_pending(self._abort_reason or f"Analysis tools daemon exited with code {return_code}", not self._closing)
+
+    async def _check_health(self, process: asyncio.subprocess.Process):
+        while process.returncode is None:
+            await asyncio.sleep(self._ping_interval)
+            try:
+                await asyncio.wait_for(self._request({"op": "ping"}, process.stdin), self._ping_timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                self.stats.health_check_failures += 1
+                if process.returncode is None:
+                    process.kill()
+                return
+
+    async def _watch(self, process: asyncio.subprocess.Process):
+        while process.returncode is None:
+            await asyncio.sleep(self._poll_interval)
+            now = time.monotonic()
+            expired = [i for i, start in self._started.items() if i in self._timeouts and now - start > self._timeouts[i]]
+            if len(expired) > 0:
+                for request_id in expired:
+                    self._aborted[request_id] = f"Timeout after {self._timeouts[request_id]:.0f}s"
+                self._abort_reason = "Analysis tools daemon killed after a request timeout"
+            elif self._memory_limit is not None and (_get_process_rss(process.pid) or 0) > self._memory_limit:
+                self._abort_reason = f"Memory limit {self._memory_limit // 1024 // 1024} MB exceeded"
+            if self._abort_reason is not None and process.returncode is None:
+                process.kill()
+                return
+
+    async def _start(self):
+        tool_args = ["--workers", str(self._workers)] if self._workers is not None else []
+        process = await asyncio.create_subprocess_exec(
+            *get_analysis_tools_command("--daemon", "--output", self._output_dir, *tool_args, max_memory=self._max_memory),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            await asyncio.wait_for(self._wait_ready(process), self._start_timeout)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+            raise
+        self._process = process
+        self._abort_reason = None
+        self._reader_task = asyncio.create_task(self._read_responses(process))
+        self._tasks = [
+            self._reader_task,
+            asyncio.create_task(self._check_health(process)),
+            asyncio.create_task(self._watch(process))
+        ]
+        self.stats.starts += 1
+
+    async def _get_writer(self) -> asyncio.StreamWriter:
+        async with self._start_lock:
+            if not self.is_running:
+                if self._reader_task is not None:
+                    await asyncio.gather(self._reader_task, return_exceptions=True)
+                await self._cancel_tasks()
+                await self._start()
+            return self._process.stdin
+
+    async def _analyze(self, apk_path: str, timeout: Optional[float]) -> dict:
+        request = {"op": "analyze", "path": apk_path}
+        retried = False
+        while True:
+            try:
+                if not retried:
+                    return await self._request(request, timeout=timeout)
+                async with self._retry_lock:
+                    return await self._request(request, timeout=timeout)
+            except AnalysisRequestDropped:
+                self.stats.resubmits += 1
+            except AnalysisRequestInterrupted as e:
+                if retried:
+                    return {"op": "result", "path": apk_path, "success": False, "output": str(e), "aborted": True}
+                retried = True
+                self.stats.retries += 1
+
+    async def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def close(self, timeout: float = 60.0):
+        self._closing = True
+        if self._process is not None and self._process.returncode is None:
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        await self._cancel_tasks()
+        self._fail_pending("Analysis tools daemon closed", False)
+
+    async def __aenter__(self) -> 'AnalysisToolsDaemon':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AnalysisToolsServer:
+    def __init__(self, daemon: AnalysisToolsDaemon, socket_path: str = DEFAULT_ANALYSIS_SOCKET_PATH):
+        self._daemon = daemon
+        self._socket_path = socket_path
+
+    async def _respond(self, request: dict, writer: asyncio.StreamWriter):
+        op = request.get("op")
+        if op == "ping":
+            try:
+                response = {"op": "pong" if await self._daemon.ping() else "error"}
+            except ConnectionError as e:
+                response = {"op": "error", "output": str(e)}
+        elif op == "analyze":
+            result = await self._daemon.analyze(request["path"], request.get("timeout"))
+            response = {"op": "result", "path": result.apk_path, "success": result.success, "output": result.output, "aborted": result.aborted}
+        else:
+            response = {"op": "error", "output": f"Unknown op: {op}"}
+        writer.write(json.dumps({**response, "id": request.get("id")}).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._respond(json.loads(line), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self._socket_path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self._daemon.close()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+
+class RemoteAnalysisTools(_AnalysisToolsClient):
+    def __init__(
+            self,
+            socket_path: str = DEFAULT_ANALYSIS_SOCKET_PATH,
+            apk_timeout: Optional[float] = None,
+            quarantine: Optional[AnalysisQuarantine] = None
+    ):
+        super().__init__(apk_timeout, quarantine)
+        self._socket_path = socket_path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        while line := await reader.readline():
+            self._dispatch_response(line)
+        self._writer.close()
+        self._fail_pending("Analysis tools server closed the connection")
+
+    async def _get_writer(self) -> asyncio.StreamWriter:
+        if self._writer is None or self._writer.is_closing():
+            reader, self._writer = await asyncio.open_unix_connection(self._socket_path)
+            self._reader_task = asyncio.create_task(self._read_responses(reader))
+        return self._writer
+
+    async def _analyze(self, apk_path: str, timeout: Optional[float]) -> dict:
+        request = {"op": "analyze", "path": apk_path, **({"timeout": timeout} if timeout is not None else {})}
+        try:
+            return await self._request(request)
+        except ConnectionError:
+            self.stats.retries += 1
+            return await self._request(request)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+    async def __aenter__(self) -> 'RemoteAnalysisTools':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
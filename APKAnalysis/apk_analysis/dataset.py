@@ -1,19 +1,24 @@
 import asyncio
 import dataclasses
+import json
 import math
-import multiprocessing
 import os
 import pickle
-from typing import Optional
+from typing import IO, Iterable, Iterator, Optional, Union
 
 import aiofiles
 import aiofiles.os
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from dataclasses_json import DataClassJsonMixin
 from tqdm import tqdm
 
 from .data import APKAnalysisResult
-from .nlp import clean_text, filter_english_text
+from .cache import CleanTextCache
+from .nlp import LanguageDetectorPool, LanguageFilterStats, TextCleaner, filter_english_text, init_text_cleaner
+from .pool import PreloadedPool
+from .scores import AnyScoreBlock, ScoreBlock, SparseScoreBlock
 from .utils import load_strings, list_all_json, dump_strings, dump_data, get_workers_size
 
 
@@ -42,7 +47,11 @@ async def load_all_english_strings(*apk_dumps_path: str, batch_size: int = 100)
             for task in asyncio.as_completed(tasks):
                 results.update(await task)
                 pbar.update(1)
-    return list(filter_english_text(results, accuracy=True))
+    language_stats = LanguageFilterStats()
+    en_results = list(filter_english_text(results, accuracy=True, stats=language_stats))
+    print(language_stats)
+    print(LanguageDetectorPool.instance(accuracy=True).memory_report())
+    return en_results
 
 
 async def get_apk_dump_english_strings(apk_dump_path: str) -> list[str]:
@@ -64,25 +73,69 @@ async def get_all_apk_dump_english_strings(apk_dump_dir: str, raw_string_path: s
         return strings
 
 
-def _clean_raw_apk_dump_english_strings(raw_strings: list[str], model: str) -> list[str]:
-    return list(set([i for i in clean_text(raw_strings, model, False) if len(i) > 0]))
+def _clean_raw_apk_dump_english_strings(raw_strings: list[str], model: str, sentence_splitter: str) -> list[list[str]]:
+    return TextCleaner.instance(model, sentence_splitter).clean_each(raw_strings)
 
 
-def clean_raw_apk_dump_english_strings(texts: list[str], model: str, workers: Optional[int] = None, batch_size: int = 10000) -> list[str]:
+def _clean_texts_in_pool(
+        pool: PreloadedPool,
+        texts: list[str],
+        model: str,
+        batch_size: int,
+        sentence_splitter: str,
+        cache: Optional[CleanTextCache],
+        show_bar: bool = True
+) -> set[str]:
     result = set()
-    with multiprocessing.Pool(processes=get_workers_size(0.5, workers)) as pool:
-        with tqdm(total=math.ceil(len(texts) / batch_size), desc=f"Cleaning text") as pbar:
-            batch_tasks = []
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i + batch_size]
-                batch_result = pool.apply_async(_clean_raw_apk_dump_english_strings, (batch_texts, model), callback=lambda _: pbar.update(1))
-                batch_tasks.append(batch_result)
-            for batch_task in batch_tasks:
-                result.update(batch_task.get())
+    with tqdm(total=math.ceil(len(texts) / batch_size), desc=f"Cleaning text", disable=not show_bar) as pbar:
+        batch_tasks = {}
+        for i in range(0, len(texts), batch_size):
+            batch_texts = texts[i:i + batch_size]
+            batch_result = pool.apply_async(_clean_raw_apk_dump_english_strings, (batch_texts, model, sentence_splitter), callback=lambda _: pbar.update(1))
+            batch_tasks[i] = batch_result
+        for start_idx, batch_task in batch_tasks.items():
+            batch_clean_strings = batch_task.get()
+            for clean_strings in batch_clean_strings:
+                result.update(clean_strings)
+            if cache is not None:
+                cache.put_many(dict(zip(texts[start_idx:start_idx + batch_size], batch_clean_strings)))
+    return result
+
+
+def clean_raw_apk_dump_english_strings(
+        texts: list[str],
+        model: str,
+        workers: Optional[int] = None,
+        batch_size: int = 10000,
+        sentence_splitter: str = "parser",
+        cache: Optional[CleanTextCache] = None,
+        pool: Optional[PreloadedPool] = None
+) -> list[str]:
+    result = set()
+    if cache is not None:
+        cached_texts = cache.get_many(texts)
+        for clean_strings in cached_texts.values():
+            result.update(clean_strings)
+        texts = [i for i in dict.fromkeys(texts) if i not in cached_texts]
+    if len(texts) == 0:
+        return list(result)
+    if pool is not None:
+        result.update(_clean_texts_in_pool(pool, texts, model, batch_size, sentence_splitter, cache, show_bar=False))
+        return list(result)
+    with PreloadedPool(get_workers_size(0.5, workers), preload=init_text_cleaner, preload_args=(model, sentence_splitter), name="Text cleaner") as pool:
+        result.update(_clean_texts_in_pool(pool, texts, model, batch_size, sentence_splitter, cache))
+        print(pool.memory_report())
     return list(result)
 
 
-async def get_clean_all_raw_apk_dump_english_strings(raw_strings: list[str], clean_string_path: str, model: str, dump_pickle: bool) -> list[str]:
+async def get_clean_all_raw_apk_dump_english_strings(
+        raw_strings: list[str],
+        clean_string_path: str,
+        model: str,
+        dump_pickle: bool,
+        sentence_splitter: str = "parser",
+        cache: Optional[CleanTextCache] = None
+) -> list[str]:
     if dump_pickle:
         clean_string_path += ".pkl"
     else:
@@ -90,7 +143,7 @@ async def get_clean_all_raw_apk_dump_english_strings(raw_strings: list[str], cle
     if await aiofiles.os.path.exists(clean_string_path):
         return await load_strings(clean_string_path)
     else:
-        clean_strings = clean_raw_apk_dump_english_strings(raw_strings, model)
+        clean_strings = clean_raw_apk_dump_english_strings(raw_strings, model, sentence_splitter=sentence_splitter, cache=cache)
         await dump_strings(clean_strings, clean_string_path, dump_pickle)
         return clean_strings
 
@@ -104,6 +157,18 @@ class TextDataset(DataClassJsonMixin):
         return pd.DataFrame(self.labels, columns=self.categories)
 
 
+@dataclasses.dataclass(frozen=True)
+class SparseTextDataset:
+    categories: list[str]
+    scores: sp.csr_matrix
+
+    def to_dense(self) -> TextDataset:
+        return TextDataset(categories=self.categories, labels=self.scores.toarray().tolist())
+
+    def to_pandas(self) -> pd.DataFrame:
+        return pd.DataFrame.sparse.from_spmatrix(self.scores, columns=self.categories)
+
+
 def get_dataset_path(type_dir: str, file_name: str, is_pickle: bool) -> str:
     if is_pickle:
         file_name += ".pkl"
@@ -112,20 +177,62 @@ def get_dataset_path(type_dir: str, file_name: str, is_pickle: bool) -> str:
     return os.path.join(type_dir, file_name)
 
 
-def load_dataset(dataset_path: str) -> TextDataset:
+def _load_pickle_frames(f: IO[bytes]) -> Iterator[any]:
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def _sparse_pairs_to_matrix(pairs: list[list[list[float]]], size: int) -> sp.csr_matrix:
+    indptr = np.cumsum([0] + [len(i) for i in pairs])
+    items = np.array([j for i in pairs for j in i], dtype=np.float64).reshape(-1, 2)
+    return sp.csr_matrix((items[:, 1].astype(np.float32), items[:, 0].astype(np.int32), indptr), shape=(len(pairs), size))
+
+
+def _load_dataset_content(dataset_path: str) -> Union[TextDataset, SparseTextDataset]:
     if os.path.exists(dataset_path):
         file_name = os.path.basename(dataset_path)
         if file_name.endswith(".json"):
             with open(dataset_path, "r", encoding="utf-8") as f:
-                return TextDataset.from_json(f.read())
+                content = json.load(f)
+            if content.get("sparse", False):
+                return SparseTextDataset(categories=content["categories"], scores=_sparse_pairs_to_matrix(content["labels"], len(content["categories"])))
+            return TextDataset.from_dict(content)
         elif file_name.endswith(".pkl"):
             with open(dataset_path, "rb") as f:
-                return TextDataset.from_dict(pickle.load(f))
+                content = pickle.load(f)
+                if content.get("sparse", False):
+                    frames = list(_load_pickle_frames(f))
+                    scores = sp.vstack(frames, format="csr") if len(frames) > 0 else sp.csr_matrix((0, len(content["categories"])), dtype=np.float32)
+                    return SparseTextDataset(categories=content["categories"], scores=scores)
+                if content.get("streamed", False):
+                    labels = []
+                    for scores in _load_pickle_frames(f):
+                        labels.extend(scores.tolist())
+                    return TextDataset(categories=content["categories"], labels=labels)
+                return TextDataset.from_dict(content)
         else:
             raise ValueError(f"Unknown extension from file: {file_name}")
     raise FileNotFoundError(f"File {dataset_path} not exists!")
 
 
+def load_dataset(dataset_path: str) -> TextDataset:
+    dataset = _load_dataset_content(dataset_path)
+    if isinstance(dataset, SparseTextDataset):
+        return dataset.to_dense()
+    return dataset
+
+
+def load_sparse_dataset(dataset_path: str) -> SparseTextDataset:
+    dataset = _load_dataset_content(dataset_path)
+    if isinstance(dataset, TextDataset):
+        scores = np.array(dataset.labels, dtype=np.float32).reshape(len(dataset.labels), len(dataset.categories))
+        return SparseTextDataset(categories=dataset.categories, scores=sp.csr_matrix(scores))
+    return dataset
+
+
 def generate_dataset(similarities: dict[int, dict[str, float]]) -> TextDataset:
     categories = sorted(list(next(iter(similarities.values())).keys()))
     labels = [
@@ -138,12 +245,141 @@ def generate_dataset(similarities: dict[int, dict[str, float]]) -> TextDataset:
     )
 
 
+def generate_matrix_dataset(scores: np.ndarray, categories: list[str]) -> TextDataset:
+    order = sorted(range(len(categories)), key=lambda x: categories[x])
+    return TextDataset(
+        categories=[categories[i] for i in order],
+        labels=scores[:, order].tolist()
+    )
+
+
 async def dump_dataset(dataset_path: str, similarities: dict[int, dict[str, float]], dump_pickle: bool):
     data = generate_dataset(similarities)
     await dump_data(data.to_dict(), dataset_path, dump_pickle)
     return data
 
 
+async def dump_matrix_dataset(dataset_path: str, scores: np.ndarray, categories: list[str], dump_pickle: bool):
+    data = generate_matrix_dataset(scores, categories)
+    await dump_data(data.to_dict(), dataset_path, dump_pickle)
+    return data
+
+
+@dataclasses.dataclass
+class DatasetSummary:
+    total: int = 0
+    empty: int = 0
+
+    def add(self, scores: Union[np.ndarray, sp.csr_matrix]):
+        self.total += scores.shape[0]
+        if sp.issparse(scores):
+            self.empty += int(np.count_nonzero(scores.getnnz(axis=1) == 0))
+        else:
+            self.empty += int(np.count_nonzero(~scores.any(axis=1)))
+
+
+class DatasetWriter:
+    def __init__(self, dataset_path: str, is_pickle: bool):
+        self._dataset_path = dataset_path
+        self._temp_path = dataset_path + ".tmp"
+        self._is_pickle = is_pickle
+        self._file: Optional[IO] = None
+        self._order: Optional[list[int]] = None
+        self._sparse = False
+        self.summary = DatasetSummary()
+
+    def _open(self, categories: list[str], sparse: bool = False):
+        self._order = sorted(range(len(categories)), key=lambda x: categories[x])
+        self._sparse = sparse
+        sorted_categories = [categories[i] for i in self._order]
+        if self._is_pickle:
+            self._file = open(self._temp_path, "wb")
+            pickle.dump({"categories": sorted_categories, "streamed": True, "sparse": sparse}, self._file)
+        else:
+            self._file = open(self._temp_path, "w", encoding="utf-8")
+            sparse_field = '"sparse": true, ' if sparse else ""
+            self._file.write(f'{{"categories": {json.dumps(sorted_categories, ensure_ascii=False)}, {sparse_field}"labels": [')
+
+    @staticmethod
+    def _sparse_pairs(scores: sp.csr_matrix) -> list[list[list[float]]]:
+        return [
+            [[c, v] for c, v in zip(scores.indices[scores.indptr[i]:scores.indptr[i + 1]].tolist(), scores.data[scores.indptr[i]:scores.indptr[i + 1]].tolist())]
+            for i in range(scores.shape[0])
+        ]
+
+    def write(self, block: AnyScoreBlock):
+        if block.start != self.summary.total:
+            raise ValueError(f"Score block starts at {block.start}, expected {self.summary.total}")
+        sparse = isinstance(block, SparseScoreBlock)
+        if self._file is None:
+            self._open(block.categories, sparse)
+        elif sparse != self._sparse:
+            raise ValueError("Cannot mix sparse and dense score blocks in one dataset")
+        scores = block.scores[:, self._order]
+        if sparse:
+            scores = scores.tocsr()
+            scores.sort_indices()
+        if self._is_pickle:
+            pickle.dump(scores, self._file)
+        elif len(block) > 0:
+            if self.summary.total > 0:
+                self._file.write(", ")
+            self._file.write(json.dumps(self._sparse_pairs(scores) if sparse else scores.tolist())[1:-1])
+        self.summary.add(scores)
+
+    def close(self):
+        if self._file is None:
+            self._open([])
+        if not self._is_pickle:
+            self._file.write("]}")
+        self._file.close()
+        os.replace(self._temp_path, self._dataset_path)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def __enter__(self) -> 'DatasetWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_dataset_blocks(dataset_path: str, blocks: Iterable[AnyScoreBlock], dump_pickle: bool) -> DatasetSummary:
+    with DatasetWriter(dataset_path, dump_pickle) as writer:
+        for block in blocks:
+            writer.write(block)
+    return writer.summary
+
+
+def iter_dataset_blocks(dataset_path: str, batch_size: int = 100000) -> Iterator[AnyScoreBlock]:
+    if dataset_path.endswith(".pkl"):
+        with open(dataset_path, "rb") as f:
+            content = pickle.load(f)
+            if content.get("streamed", False):
+                block_type = SparseScoreBlock if content.get("sparse", False) else ScoreBlock
+                start = 0
+                for scores in _load_pickle_frames(f):
+                    yield block_type(start, content["categories"], scores)
+                    start += scores.shape[0]
+                return
+        dataset = TextDataset.from_dict(content)
+    else:
+        dataset = _load_dataset_content(dataset_path)
+    if isinstance(dataset, SparseTextDataset):
+        for i in range(0, dataset.scores.shape[0], batch_size):
+            yield SparseScoreBlock(i, dataset.categories, dataset.scores[i:i + batch_size])
+        return
+    for i in range(0, len(dataset.labels), batch_size):
+        yield ScoreBlock(i, dataset.categories, np.array(dataset.labels[i:i + batch_size], dtype=np.float64).reshape(-1, len(dataset.categories)))
+
+
 async def try_convert_dataset_to_pickle(*dataset_paths: str):
     for dataset_path in dataset_paths:
         file_name = os.path.basename(dataset_path)
@@ -152,8 +388,7 @@ async def try_convert_dataset_to_pickle(*dataset_paths: str):
             if os.path.exists(new_dataset_path):
                 print(f"Pickle exists! {new_dataset_path}")
             else:
-                dataset = load_dataset(dataset_path)
-                await dump_data(dataset.to_dict(), new_dataset_path, True)
+                write_dataset_blocks(new_dataset_path, iter_dataset_blocks(dataset_path), True)
         else:
             print(f"Not a JSON file! {dataset_path}")
 
@@ -166,7 +401,6 @@ async def try_convert_dataset_to_json(*dataset_paths: str):
             if os.path.exists(new_dataset_path):
                 print(f"JSON exists! {new_dataset_path}")
             else:
-                dataset = load_dataset(dataset_path)
-                await dump_data(dataset.to_dict(), new_dataset_path, False)
+                write_dataset_blocks(new_dataset_path, iter_dataset_blocks(dataset_path), False)
         else:
             print(f"Not a Pickle file! {dataset_path}")
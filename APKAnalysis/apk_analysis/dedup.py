@@ -0,0 +1,180 @@
+import dataclasses
+import itertools
+import zlib
+from typing import Iterable, Iterator
+
+import numpy as np
+import scipy.sparse as sp
+from tqdm import tqdm
+
+from .scores import AnyScoreBlock, ScoreBlock, SparseScoreBlock
+
+_PRIME = (1 << 61) - 1
+
+
+def _shingle_hashes(text: str, shingle_size: int) -> list[int]:
+    tokens = text.split()
+    if len(tokens) < shingle_size:
+        return [zlib.crc32(" ".join(tokens).encode("utf-8", "surrogatepass"))] if len(tokens) > 0 else []
+    return list({zlib.crc32(" ".join(tokens[i:i + shingle_size]).encode("utf-8", "surrogatepass")) for i in range(len(tokens) - shingle_size + 1)})
+
+
+def optimal_lsh_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+    candidates = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm // b > 0]
+    return min(candidates, key=lambda x: (abs((1 / x[0]) ** (1 / x[1]) - threshold), -x[0] * x[1]))
+
+
+class _DisjointSet:
+    def __init__(self, size: int):
+        self._parent = np.arange(size)
+
+    def find(self, x: int) -> int:
+        root = x
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[x] != root:
+            self._parent[x], x = root, self._parent[x]
+        return root
+
+    def union(self, x: int, y: int):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self._parent[max(x, y)] = min(x, y)
+
+    def roots(self) -> np.ndarray:
+        roots = self._parent.copy()
+        while True:
+            parents = roots[roots]
+            if np.array_equal(parents, roots):
+                return roots
+            roots = parents
+
+
+@dataclasses.dataclass(frozen=True)
+class NearDuplicateClusters:
+    representatives: np.ndarray
+    assignments: np.ndarray
+    threshold: float
+
+    @property
+    def total(self) -> int:
+        return len(self.assignments)
+
+    @property
+    def clusters(self) -> int:
+        return len(self.representatives)
+
+    @property
+    def reduction_ratio(self) -> float:
+        return 1 - self.clusters / self.total if self.total > 0 else 0.0
+
+    def representative_strings(self, strings: list[str]) -> list[str]:
+        return [strings[i] for i in self.representatives.tolist()]
+
+    def expand_score_blocks(self, blocks: Iterable[AnyScoreBlock], batch_size: int = 100000) -> Iterator[AnyScoreBlock]:
+        order = np.argsort(self.assignments, kind="stable")
+        last_members = order[np.cumsum(np.bincount(self.assignments, minlength=self.clusters)) - 1]
+        batch_starts = list(range(0, self.total, batch_size))
+        ready = np.searchsorted(self.representatives, [min(i + batch_size, self.total) for i in batch_starts])
+        retained: list[tuple[AnyScoreBlock, int]] = []
+        received = 0
+        batch = 0
+
+        def _expand(start: int) -> AnyScoreBlock:
+            clusters = self.assignments[start:start + batch_size]
+            positions, parts = [], []
+            for block, _ in retained:
+                rows = np.flatnonzero((clusters >= block.start) & (clusters < block.stop))
+                if len(rows) > 0:
+                    positions.append(rows)
+                    parts.append(block.scores[clusters[rows] - block.start])
+            inverse = np.argsort(np.concatenate(positions), kind="stable")
+            if isinstance(retained[0][0], SparseScoreBlock):
+                return SparseScoreBlock(start, retained[0][0].categories, sp.vstack(parts, format="csr")[inverse])
+            return ScoreBlock(start, retained[0][0].categories, np.concatenate(parts)[inverse])
+
+        for block in itertools.chain(blocks, [None]):
+            if block is None and received == 0:
+                return
+            if block is not None:
+                if block.start != received:
+                    raise ValueError(f"Expected score block starting at {received}, got {block.start}")
+                received = block.stop
+                retained.append((block, int(last_members[block.start:block.stop].max(initial=-1))))
+            while batch < len(batch_starts) and (block is None or ready[batch] <= received):
+                start = batch_starts[batch]
+                yield _expand(start)
+                batch += 1
+                retained = [(i, last) for i, last in retained if last >= start + batch_size]
+
+    def __str__(self) -> str:
+        return (f"Strings: {self.total}   Clusters: {self.clusters}   Reduction: {self.reduction_ratio:.2%}   "
+                f"Threshold: {self.threshold}")
+
+
+class MinHashLSH:
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 1, seed: int = 9326):
+        self._threshold = threshold
+        self._num_perm = num_perm
+        self._shingle_size = shingle_size
+        self._bands, self._rows = optimal_lsh_bands(threshold, num_perm)
+        rand = np.random.default_rng(seed)
+        self._a = rand.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rand.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    @property
+    def bands(self) -> int:
+        return self._bands
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    def signatures(self, strings: list[str], batch_size: int = 10000) -> tuple[np.ndarray, np.ndarray]:
+        signatures = np.zeros((len(strings), self._num_perm), dtype=np.uint32)
+        empty = np.zeros(len(strings), dtype=bool)
+        for start in tqdm(range(0, len(strings), batch_size), desc="Calculating min hash signatures"):
+            owners, hashes = [], []
+            for row, text in enumerate(strings[start:start + batch_size]):
+                text_hashes = _shingle_hashes(text, self._shingle_size)
+                if len(text_hashes) == 0:
+                    empty[start + row] = True
+                owners.extend([row] * len(text_hashes))
+                hashes.extend(text_hashes)
+            if len(owners) == 0:
+                continue
+            owners = np.array(owners, dtype=np.int64)
+            rows, starts = np.unique(owners, return_index=True)
+            permuted = (np.array(hashes, dtype=np.uint64)[:, None] * self._a[None, :] + self._b[None, :]) % _PRIME
+            signatures[start + rows] = (np.minimum.reduceat(permuted, starts, axis=0) & 0xFFFFFFFF).astype(np.uint32)
+        return signatures, empty
+
+    def cluster(self, strings: list[str]) -> NearDuplicateClusters:
+        signatures, empty = self.signatures(strings)
+        candidates = np.flatnonzero(~empty)
+        disjoint_set = _DisjointSet(len(strings))
+        for band in tqdm(range(self._bands), desc=f"Clustering near duplicates ({self._bands}x{self._rows} bands)"):
+            band_signatures = np.ascontiguousarray(signatures[candidates, band * self._rows:(band + 1) * self._rows])
+            _, inverse, counts = np.unique(band_signatures.view(np.dtype((np.void, band_signatures.dtype.itemsize * self._rows))).ravel(),
+                                           return_inverse=True, return_counts=True)
+            inverse = inverse.ravel()
+            duplicated = counts[inverse] > 1
+            if not duplicated.any():
+                continue
+            members = candidates[duplicated]
+            buckets = inverse[duplicated]
+            order = np.argsort(buckets, kind="stable")
+            members, buckets = members[order], buckets[order]
+            heads = members[np.searchsorted(buckets, buckets)]
+            pairs = heads != members
+            heads, members = heads[pairs], members[pairs]
+            similarities = (signatures[heads] == signatures[members]).mean(axis=1)
+            for head, member in zip(heads[similarities >= self._threshold].tolist(), members[similarities >= self._threshold].tolist()):
+                disjoint_set.union(head, member)
+        roots = disjoint_set.roots()
+        representatives, assignments = np.unique(roots, return_inverse=True)
+        return NearDuplicateClusters(representatives=representatives, assignments=assignments.ravel(), threshold=self._threshold)
+
+
+def cluster_near_duplicates(strings: list[str], threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 1) -> NearDuplicateClusters:
+    return MinHashLSH(threshold, num_perm, shingle_size).cluster(strings)
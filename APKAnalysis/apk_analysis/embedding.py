@@ -0,0 +1,330 @@
+import dataclasses
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from .cache import CacheStats, synchronized
+
+EMBEDDING_QUANTIZATIONS = ("float32", "float16", "int8")
+
+
+@dataclasses.dataclass(frozen=True)
+class EmbeddingStoreReport:
+    model: str
+    quantization: str
+    dimension: int
+    entries: int
+    capacity: int
+    index_size: int
+    vectors_size: int
+    lifetime: CacheStats
+
+    @property
+    def size(self) -> int:
+        return self.index_size + self.vectors_size
+
+    @property
+    def fragmentation(self) -> float:
+        return 1 - self.entries / self.capacity if self.capacity > 0 else 0.0
+
+    def __str__(self) -> str:
+        return "\n".join([
+            f"Model: {self.model}   Quantization: {self.quantization}   Dimension: {self.dimension}",
+            f"Entries: {self.entries}   Capacity: {self.capacity}   Fragmentation: {self.fragmentation:.2%}",
+            f"Size: {self.size / 1024 / 1024:.2f} MiB (index {self.index_size / 1024 / 1024:.2f} MiB, vectors {self.vectors_size / 1024 / 1024:.2f} MiB)",
+            f"Lifetime {self.lifetime}",
+        ])
+
+
+def get_embedding_store_dir(root: str, model: str, quantization: str) -> str:
+    name = hashlib.blake2b(model.encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(root, f"{name}-{quantization}")
+
+
+class EmbeddingStore:
+    _QUERY_BATCH_SIZE = 500
+    _MIN_CAPACITY = 1024
+    _INDEX_FILE = "index.sqlite"
+    _VECTORS_FILE = "vectors.bin"
+
+    def __init__(self, path: str, model: str, dimension: Optional[int] = None, quantization: str = "float32"):
+        if quantization not in EMBEDDING_QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._model = model
+        self._dimension = dimension
+        self._quantization = quantization
+        self._dtype = np.dtype(quantization)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(os.path.join(path, self._INDEX_FILE), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, row INTEGER NOT NULL UNIQUE, scale REAL NOT NULL, access INTEGER NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (access)")
+        self._check_meta()
+        self._connection.commit()
+        self._vectors_path = os.path.join(path, self._VECTORS_FILE)
+        if not os.path.exists(self._vectors_path):
+            open(self._vectors_path, "wb").close()
+        self._vectors: Optional[np.memmap] = None
+        self._open_vectors()
+        self._next_row: int = self._connection.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM entries").fetchone()[0]
+        self.stats = CacheStats()
+
+    @classmethod
+    def open(cls, root: str, model: str, dimension: Optional[int] = None, quantization: str = "float32") -> 'EmbeddingStore':
+        return cls(get_embedding_store_dir(root, model, quantization), model, dimension, quantization)
+
+    def _check_meta(self):
+        meta = dict(self._connection.execute("SELECT name, value FROM meta").fetchall())
+        if len(meta) == 0:
+            self._connection.executemany(
+                "INSERT INTO meta (name, value) VALUES (?, ?)",
+                [("model", self._model), ("quantization", self._quantization), ("hits", "0"), ("misses", "0")]
+            )
+            if self._dimension is not None:
+                self._connection.execute("INSERT INTO meta (name, value) VALUES ('dimension', ?)", (str(self._dimension),))
+            return
+        if self._dimension is None and "dimension" in meta:
+            self._dimension = int(meta["dimension"])
+        expected = {"model": self._model, "quantization": self._quantization}
+        if self._dimension is not None:
+            expected["dimension"] = str(self._dimension)
+        for name, value in expected.items():
+            if meta.get(name) != value:
+                raise ValueError(f"Embedding store {self._path} was created with {name}={meta.get(name)}, got {value}")
+
+    def _set_dimension(self, dimension: int):
+        self._dimension = dimension
+        self._connection.execute("INSERT INTO meta (name, value) VALUES ('dimension', ?)", (str(dimension),))
+        self._connection.commit()
+        self._open_vectors()
+
+    def _open_vectors(self):
+        if self._dimension is None:
+            return
+        row_size = self._dimension * self._dtype.itemsize
+        capacity = os.path.getsize(self._vectors_path) // row_size
+        self._vectors = np.memmap(self._vectors_path, dtype=self._dtype, mode="r+", shape=(capacity, self._dimension)) if capacity > 0 else None
+
+    def _close_vectors(self):
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+            self._vectors = None
+
+    def _resize(self, capacity: int):
+        self._close_vectors()
+        with open(self._vectors_path, "r+b") as f:
+            f.truncate(capacity * self._dimension * self._dtype.itemsize)
+        self._open_vectors()
+
+    def _reserve(self, rows: int):
+        required = self._next_row + rows
+        if required > self.capacity:
+            self._resize(max(self._MIN_CAPACITY, required, self.capacity * 2))
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return self._dimension
+
+    @property
+    def quantization(self) -> str:
+        return self._quantization
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self._vectors is None else self._vectors.shape[0]
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self._model}\0{text}".encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def _batches(self, items: list) -> Iterable[list]:
+        for i in range(0, len(items), self._QUERY_BATCH_SIZE):
+            yield items[i:i + self._QUERY_BATCH_SIZE]
+
+    def _quantize(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        vectors = vectors.astype(np.float32, copy=False)
+        if self._quantization == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.rint(vectors / scales[:, None]).astype(np.int8), scales
+        return vectors.astype(self._dtype), np.ones(len(vectors), dtype=np.float32)
+
+    @synchronized
+    def get_many(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        if self._dimension is None:
+            self.stats.misses += len(texts)
+            return np.zeros((len(texts), 0), dtype=np.float32), np.zeros(len(texts), dtype=bool)
+        keys = [self._key(text) for text in texts]
+        positions: dict[bytes, list[int]] = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+
+        result = np.zeros((len(texts), self._dimension), dtype=np.float32)
+        found = np.zeros(len(texts), dtype=bool)
+        access = time.time_ns()
+        for batch_keys in self._batches(list(positions.keys())):
+            rows = self._connection.execute(
+                f"SELECT key, row, scale FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})",
+                batch_keys
+            ).fetchall()
+            if len(rows) == 0:
+                continue
+            indexes = np.array([row for _, row, _ in rows], dtype=np.int64)
+            vectors = self._vectors[indexes].astype(np.float32) * np.array([scale for _, _, scale in rows], dtype=np.float32)[:, None]
+            for (key, _, _), vector in zip(rows, vectors):
+                result[positions[key]] = vector
+                found[positions[key]] = True
+            self._connection.executemany("UPDATE entries SET access = ? WHERE key = ?", [(access, key) for key, _, _ in rows])
+        self._connection.commit()
+        hits = int(found.sum())
+        self.stats.hits += hits
+        self.stats.misses += len(texts) - hits
+        return result, found
+
+    @synchronized
+    def put_many(self, texts: list[str], vectors: np.ndarray):
+        items = {self._key(text): i for i, text in enumerate(texts)}
+        existing = set()
+        for batch_keys in self._batches(list(items.keys())):
+            existing.update(key for key, in self._connection.execute(
+                f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})",
+                batch_keys
+            ).fetchall())
+        items = {key: i for key, i in items.items() if key not in existing}
+        if len(items) == 0:
+            return
+        if self._dimension is None:
+            self._set_dimension(vectors.shape[1])
+
+        quantized, scales = self._quantize(vectors[list(items.values())])
+        self._reserve(len(items))
+        start = self._next_row
+        self._vectors[start:start + len(items)] = quantized
+        self._vectors.flush()
+        self._next_row += len(items)
+
+        access = time.time_ns()
+        rows = [(key, start + j, float(scales[j]), access) for j, key in enumerate(items.keys())]
+        for batch_rows in self._batches(rows):
+            self._connection.executemany("INSERT INTO entries (key, row, scale, access) VALUES (?, ?, ?, ?)", batch_rows)
+        self._connection.commit()
+
+    def encode(self, texts: list[str], encoder: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+        result, found = self.get_many(texts)
+        missing = list(dict.fromkeys(text for text, f in zip(texts, found) if not f))
+        if len(missing) > 0:
+            vectors = np.asarray(encoder(missing), dtype=np.float32)
+            self.put_many(missing, vectors)
+            if result.shape[1] != vectors.shape[1]:
+                result = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+            missing_vectors = dict(zip(missing, vectors))
+            for i in np.flatnonzero(~found):
+                result[i] = missing_vectors[texts[i]]
+        return result
+
+    @synchronized
+    def evict(self, max_entries: int):
+        cursor = self._connection.execute("SELECT key FROM entries ORDER BY access")
+        evict_keys = []
+        total = len(self)
+        while total - len(evict_keys) > max_entries:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            evict_keys.append(row[0])
+        cursor.close()
+        for batch_keys in self._batches(evict_keys):
+            self._connection.execute(f"DELETE FROM entries WHERE key IN ({','.join('?' * len(batch_keys))})", batch_keys)
+        self._connection.commit()
+        self.stats.evictions += len(evict_keys)
+
+    @synchronized
+    def compact(self):
+        if self._dimension is None:
+            return
+        entries = self._connection.execute("SELECT key, row FROM entries ORDER BY row").fetchall()
+        compact_path = self._vectors_path + ".compact"
+        if len(entries) > 0:
+            vectors = np.memmap(compact_path, dtype=self._dtype, mode="w+", shape=(len(entries), self._dimension))
+            for start in range(0, len(entries), self._QUERY_BATCH_SIZE):
+                batch = entries[start:start + self._QUERY_BATCH_SIZE]
+                vectors[start:start + len(batch)] = self._vectors[np.array([row for _, row in batch], dtype=np.int64)]
+            vectors.flush()
+            del vectors
+        else:
+            open(compact_path, "wb").close()
+
+        self._connection.execute("UPDATE entries SET row = -row - 1")
+        self._connection.executemany("UPDATE entries SET row = ? WHERE key = ?", [(i, key) for i, (key, _) in enumerate(entries)])
+        self._close_vectors()
+        os.replace(compact_path, self._vectors_path)
+        self._connection.commit()
+        self._connection.execute("VACUUM")
+        self._open_vectors()
+        self._next_row = len(entries)
+
+    def _save_stats(self):
+        self._connection.executemany(
+            "UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE name = ?",
+            [(self.stats.hits, "hits"), (self.stats.misses, "misses")]
+        )
+        self._connection.commit()
+        self.stats = CacheStats(evictions=self.stats.evictions)
+
+    @synchronized
+    def report(self) -> EmbeddingStoreReport:
+        self._save_stats()
+        meta = dict(self._connection.execute("SELECT name, value FROM meta").fetchall())
+        index_size = sum(
+            os.path.getsize(os.path.join(self._path, name))
+            for name in os.listdir(self._path) if name.startswith(self._INDEX_FILE)
+        )
+        return EmbeddingStoreReport(
+            model=self._model,
+            quantization=self._quantization,
+            dimension=self._dimension or 0,
+            entries=len(self),
+            capacity=self.capacity,
+            index_size=index_size,
+            vectors_size=os.path.getsize(self._vectors_path),
+            lifetime=CacheStats(hits=int(meta["hits"]), misses=int(meta["misses"]))
+        )
+
+    @synchronized
+    def close(self):
+        self._save_stats()
+        self._close_vectors()
+        self._connection.close()
+
+    def __enter__(self) -> 'EmbeddingStore':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_embedding_store(path: str) -> EmbeddingStore:
+    connection = sqlite3.connect(os.path.join(path, EmbeddingStore._INDEX_FILE))
+    try:
+        meta = dict(connection.execute("SELECT name, value FROM meta").fetchall())
+    finally:
+        connection.close()
+    return EmbeddingStore(path, meta["model"], int(meta["dimension"]) if "dimension" in meta else None, meta["quantization"])
@@ -0,0 +1,300 @@
+import abc
+import collections
+import json
+import os
+from typing import Collection, Optional
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+from sentence_transformers import SentenceTransformer, models
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from .batching import DEFAULT_MAX_TOKENS, BatchingStats, plan_token_batches, run_batches
+
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8", "static", "server")
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "apk_analysis", "onnx")
+STATIC_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "apk_analysis", "static")
+STATIC_EMBEDDING_DIMENSION = 256
+
+
+def parse_encoder_model(model: str) -> tuple[str, str]:
+    backend, sep, name = model.partition(":")
+    if sep and backend in ENCODER_BACKENDS:
+        return backend, name
+    return "torch", model
+
+
+class SentenceEncoder(abc.ABC):
+    def __init__(self, model: str, max_tokens: Optional[int] = DEFAULT_MAX_TOKENS):
+        self._model = model
+        self._max_tokens = max_tokens
+        self.stats = BatchingStats()
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def identifier(self) -> str:
+        return self._model
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    @property
+    def max_tokens(self) -> Optional[int]:
+        return self._max_tokens
+
+    @property
+    @abc.abstractmethod
+    def dimension(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        pass
+
+    @abc.abstractmethod
+    def token_lengths(self, texts: list[str]) -> np.ndarray:
+        pass
+
+    def encode(self, texts: list[str], batch_size: int = 256, show_progress_bar: bool = False, normalize_embeddings: bool = False) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        lengths = self.token_lengths(texts)
+        batches = plan_token_batches(lengths, self._max_tokens, batch_size)
+        result = run_batches(texts, lengths, batches, self.encode_batch, self.stats, show_progress_bar).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            norms = np.linalg.norm(result, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            result /= norms
+        return result
+
+    def encode_tensor(self, texts: list[str], batch_size: int = 256, show_progress_bar: bool = False, normalize_embeddings: bool = False) -> torch.Tensor:
+        return torch.from_numpy(self.encode(texts, batch_size, show_progress_bar, normalize_embeddings)).to(self.device)
+
+
+class TransformerSentenceEncoder(SentenceEncoder, abc.ABC):
+    @abc.abstractmethod
+    def _transformer_module(self) -> models.Transformer:
+        pass
+
+    def token_lengths(self, texts: list[str]) -> np.ndarray:
+        module = self._transformer_module()
+        input_ids = module.tokenizer(texts, max_length=module.max_seq_length, truncation=True)["input_ids"]
+        return np.array([len(i) for i in input_ids], dtype=np.int64)
+
+
+class TorchSentenceEncoder(TransformerSentenceEncoder):
+    def __init__(self, model: str, threads: Optional[int] = None, max_tokens: Optional[int] = DEFAULT_MAX_TOKENS):
+        super().__init__(model, max_tokens)
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self._transformer = SentenceTransformer(model)
+
+    @property
+    def device(self) -> torch.device:
+        return self._transformer.device
+
+    @property
+    def dimension(self) -> int:
+        return self._transformer.get_sentence_embedding_dimension()
+
+    def _transformer_module(self) -> models.Transformer:
+        return self._transformer[0]
+
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        return self._transformer.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+
+
+class _TokenEmbeddings(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class OnnxSentenceEncoder(TransformerSentenceEncoder):
+    def __init__(
+            self,
+            model: str,
+            quantize: bool = False,
+            threads: Optional[int] = None,
+            max_tokens: Optional[int] = DEFAULT_MAX_TOKENS,
+            cache_dir: str = ONNX_CACHE_DIR
+    ):
+        super().__init__(model, max_tokens)
+        self._quantize = quantize
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("ONNX encoder backends require the onnxruntime package") from e
+
+        transformer = SentenceTransformer(model, device="cpu")
+        self._transformer = transformer[0]
+        self._modules = [module for _, module in list(transformer.named_children())[1:]]
+        self._dimension = transformer.get_sentence_embedding_dimension()
+
+        path = self.export(transformer, os.path.join(cache_dir, model.replace("/", "__")), quantize)
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [i.name for i in self._session.get_inputs()]
+
+    @property
+    def identifier(self) -> str:
+        return f"{'onnx-int8' if self._quantize else 'onnx'}:{self._model}"
+
+    @staticmethod
+    def export(transformer: SentenceTransformer, path: str, quantize: bool = False) -> str:
+        model_path = os.path.join(path, "model.onnx")
+        quantized_model_path = os.path.join(path, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            os.makedirs(path, exist_ok=True)
+            features = transformer.tokenize(["Export sentence"])
+            torch.onnx.export(
+                _TokenEmbeddings(transformer[0].auto_model).eval(),
+                (features["input_ids"], features["attention_mask"]),
+                model_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["token_embeddings"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "token_embeddings": {0: "batch", 1: "sequence"}
+                },
+                opset_version=14
+            )
+        if not quantize:
+            return model_path
+        if not os.path.exists(quantized_model_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(model_path, quantized_model_path, weight_type=QuantType.QInt8)
+        return quantized_model_path
+
+    @property
+    def dimension(self) -> int:
+        return self._dimension
+
+    def _transformer_module(self) -> models.Transformer:
+        return self._transformer
+
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        features = self._transformer.tokenize(texts)
+        token_embeddings = self._session.run(None, {name: features[name].numpy().astype(np.int64) for name in self._input_names})[0]
+        features = {"token_embeddings": torch.from_numpy(token_embeddings), "attention_mask": features["attention_mask"]}
+        with torch.no_grad():
+            for module in self._modules:
+                features = module(features)
+        return features["sentence_embedding"].numpy()
+
+
+def get_static_encoder_path(model: str, cache_dir: str = STATIC_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, model.replace("/", "__"))
+
+
+def distill_static_embeddings(
+        model: str,
+        path: str,
+        dimension: Optional[int] = STATIC_EMBEDDING_DIMENSION,
+        corpus: Optional[Collection[str]] = None,
+        sif_coefficient: float = 1e-3,
+        batch_size: int = 1024,
+        threads: Optional[int] = None
+) -> str:
+    if threads is not None:
+        torch.set_num_threads(threads)
+    transformer = SentenceTransformer(model, device="cpu")
+    tokenizer = transformer.tokenizer
+    vocabulary_size = len(tokenizer)
+    prefix = [tokenizer.cls_token_id] if tokenizer.cls_token_id is not None else []
+    suffix = [tokenizer.sep_token_id] if tokenizer.sep_token_id is not None else []
+
+    embeddings = np.zeros((vocabulary_size, transformer.get_sentence_embedding_dimension()), dtype=np.float32)
+    with torch.no_grad():
+        for start in tqdm(range(0, vocabulary_size, batch_size), desc="Distilling token embeddings"):
+            stop = min(start + batch_size, vocabulary_size)
+            input_ids = torch.tensor([prefix + [i] + suffix for i in range(start, stop)], dtype=torch.long)
+            features = transformer({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+            embeddings[start:stop] = features["sentence_embedding"].numpy()
+
+    embeddings -= embeddings.mean(axis=0, keepdims=True)
+    if dimension is not None and dimension < embeddings.shape[1]:
+        _, _, components = np.linalg.svd(embeddings, full_matrices=False)
+        embeddings = embeddings @ components[:dimension].T
+
+    if corpus is not None:
+        counts = collections.Counter()
+        for input_ids in tokenizer(list(corpus), add_special_tokens=False)["input_ids"]:
+            counts.update(input_ids)
+        frequencies = np.zeros(vocabulary_size, dtype=np.float64)
+        frequencies[list(counts.keys())] = list(counts.values())
+        frequencies /= max(frequencies.sum(), 1.0)
+        embeddings *= (sif_coefficient / (sif_coefficient + frequencies))[:, None]
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "embeddings.npy"), embeddings.astype(np.float32))
+    tokenizer.save_pretrained(path)
+    with open(os.path.join(path, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model,
+            "dimension": int(embeddings.shape[1]),
+            "max_seq_length": transformer.max_seq_length,
+            "sif_coefficient": sif_coefficient if corpus is not None else None
+        }, f)
+    return path
+
+
+class StaticSentenceEncoder(SentenceEncoder):
+    def __init__(self, path: str, max_tokens: Optional[int] = DEFAULT_MAX_TOKENS):
+        with open(os.path.join(path, "config.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        super().__init__(config["model"], max_tokens)
+        self._max_seq_length = config["max_seq_length"]
+        self._embeddings: np.ndarray = np.load(os.path.join(path, "embeddings.npy"))
+        self._tokenizer = AutoTokenizer.from_pretrained(path)
+
+    @property
+    def identifier(self) -> str:
+        return f"static:{self._model}"
+
+    @property
+    def dimension(self) -> int:
+        return self._embeddings.shape[1]
+
+    def _input_ids(self, texts: list[str]) -> list[list[int]]:
+        return self._tokenizer(texts, add_special_tokens=False, max_length=self._max_seq_length, truncation=True)["input_ids"]
+
+    def token_lengths(self, texts: list[str]) -> np.ndarray:
+        return np.array([len(i) for i in self._input_ids(texts)], dtype=np.int64)
+
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        input_ids = self._input_ids(texts)
+        lengths = np.array([len(i) for i in input_ids], dtype=np.int64)
+        weights = np.repeat(1.0 / np.maximum(lengths, 1), lengths).astype(np.float32)
+        indices = np.fromiter((j for i in input_ids for j in i), dtype=np.int64, count=int(lengths.sum()))
+        pooling = sp.csr_matrix((weights, indices, np.concatenate([[0], np.cumsum(lengths)])), shape=(len(texts), self._embeddings.shape[0]))
+        return np.asarray(pooling @ self._embeddings, dtype=np.float32)
+
+
+def load_sentence_encoder(model: str, threads: Optional[int] = None, max_tokens: Optional[int] = DEFAULT_MAX_TOKENS) -> SentenceEncoder:
+    backend, name = parse_encoder_model(model)
+    if backend == "torch":
+        return TorchSentenceEncoder(name, threads, max_tokens)
+    if backend == "server":
+        from .server import RemoteSentenceEncoder
+        return RemoteSentenceEncoder(name)
+    if backend == "static":
+        path = get_static_encoder_path(name)
+        if not os.path.exists(os.path.join(path, "embeddings.npy")):
+            distill_static_embeddings(name, path, threads=threads)
+        return StaticSentenceEncoder(path, max_tokens)
+    return OnnxSentenceEncoder(name, quantize=backend == "onnx-int8", threads=threads, max_tokens=max_tokens)
@@ -0,0 +1,250 @@
+import collections
+import dataclasses
+import math
+from typing import Iterator
+
+import numpy as np
+import scipy.sparse as sp
+from tqdm import tqdm
+
+from .scores import ScoreBlock, collect_score_blocks
+
+TERM_WEIGHTINGS = ("bm25", "tfidf")
+
+
+def _distinct_n_grams(tokens: list[str], n: int) -> set[tuple[str]]:
+    return {tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1)}
+
+
+class NGramLabelMatrix:
+    def __init__(self, categories_docs: dict[str, list[tuple[str]]]):
+        self._categories: list[str] = list(categories_docs.keys())
+        vocabularies: dict[int, dict[tuple[str], int]] = {}
+        weights: dict[int, dict[tuple[int, int], float]] = {}
+        for category_idx, category_words in enumerate(categories_docs.values()):
+            for category_tokens in category_words:
+                vocabulary = vocabularies.setdefault(len(category_tokens), {})
+                gram_idx = vocabulary.setdefault(category_tokens, len(vocabulary))
+                category_weights = weights.setdefault(len(category_tokens), {})
+                category_weights[(gram_idx, category_idx)] = category_weights.get((gram_idx, category_idx), 0.0) + 1 / len(category_words)
+        self._vocabularies = vocabularies
+        self._weights: dict[int, sp.csr_matrix] = {
+            n: sp.csr_matrix(
+                (list(weights[n].values()), ([i[0] for i in weights[n]], [i[1] for i in weights[n]])),
+                shape=(len(vocabularies[n]), len(self._categories))
+            )
+            for n in vocabularies
+        }
+
+    @property
+    def categories(self) -> list[str]:
+        return self._categories
+
+    @property
+    def sizes(self) -> list[int]:
+        return sorted(self._vocabularies.keys())
+
+    def vocabulary(self, n: int) -> dict[tuple[str], int]:
+        return self._vocabularies[n]
+
+    def weights(self, n: int) -> sp.csr_matrix:
+        return self._weights[n]
+
+    def indicator_matrix(self, tokens_list: list[list[str]], n: int) -> tuple[sp.csr_matrix, np.ndarray]:
+        vocabulary = self._vocabularies[n]
+        rows, cols = [], []
+        gram_sizes = np.zeros(len(tokens_list), dtype=np.float64)
+        for row, tokens in enumerate(tokens_list):
+            if len(tokens) < n:
+                continue
+            grams = _distinct_n_grams(tokens, n)
+            gram_sizes[row] = len(grams)
+            for gram in grams:
+                col = vocabulary.get(gram)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(tokens_list), len(vocabulary)))
+        return matrix, gram_sizes
+
+
+def calculate_sparse_n_gram_jaccard_scores(strings: list[str], label_matrix: NGramLabelMatrix) -> np.ndarray:
+    tokens_list = [text.split() for text in strings]
+    scores = np.zeros((len(strings), len(label_matrix.categories)), dtype=np.float64)
+    for n in label_matrix.sizes:
+        indicator, gram_sizes = label_matrix.indicator_matrix(tokens_list, n)
+        jaccard = sp.diags(np.divide(1.0, gram_sizes, out=np.zeros_like(gram_sizes), where=gram_sizes > 0)) @ indicator
+        scores += (jaccard @ label_matrix.weights(n)).toarray()
+    return scores
+
+
+def iter_sparse_n_gram_jaccard_similarity(
+        strings: list[str],
+        categories_docs: dict[str, list[tuple[str]]],
+        batch_size: int = 100000
+) -> Iterator[ScoreBlock]:
+    label_matrix = NGramLabelMatrix(categories_docs)
+    for i in tqdm(range(0, len(strings), batch_size), desc="Calculating sparse similarity"):
+        yield ScoreBlock(i, label_matrix.categories, calculate_sparse_n_gram_jaccard_scores(strings[i:i + batch_size], label_matrix))
+
+
+def calculate_sparse_n_gram_jaccard_similarity(
+        strings: list[str],
+        categories_docs: dict[str, list[tuple[str]]],
+        batch_size: int = 100000
+) -> dict[int, dict[str, float]]:
+    return collect_score_blocks(iter_sparse_n_gram_jaccard_similarity(strings, categories_docs, batch_size))
+
+
+class LabelTermIndex:
+    def __init__(self, categories: dict[str, set[str]], weighting: str = "bm25", k1: float = 1.2, b: float = 0.75):
+        if weighting not in TERM_WEIGHTINGS:
+            raise ValueError(f"Unknown term weighting: {weighting}")
+        self._categories: list[str] = list(categories.keys())
+        self._weighting = weighting
+        self._k1 = k1
+        vocabulary: dict[str, int] = {}
+        rows, cols = [], []
+        for category_idx, labels in enumerate(categories.values()):
+            for label in labels:
+                for token in label.split():
+                    rows.append(category_idx)
+                    cols.append(vocabulary.setdefault(token, len(vocabulary)))
+        self._vocabulary = vocabulary
+
+        size = len(self._categories)
+        term_counts = sp.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(size, len(vocabulary)))
+        document_counts = np.bincount(term_counts.indices, minlength=len(vocabulary)).astype(np.float64)
+        data_rows = np.repeat(np.arange(size), np.diff(term_counts.indptr))
+        weights = term_counts.copy()
+        if weighting == "bm25":
+            self._idf = np.log1p((size - document_counts + 0.5) / (document_counts + 0.5))
+            self._oov_idf = math.log1p((size + 0.5) / 0.5)
+            lengths = np.asarray(term_counts.sum(axis=1)).ravel()
+            length_norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0)) if size > 0 else lengths
+            weights.data = self._idf[weights.indices] * weights.data * (k1 + 1) / (weights.data + length_norms[data_rows])
+        else:
+            self._idf = np.log((1 + size) / (1 + document_counts)) + 1
+            self._oov_idf = math.log(1 + size) + 1
+            weights.data = weights.data * self._idf[weights.indices]
+            norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+            weights.data /= np.where(norms > 0, norms, 1.0)[data_rows]
+        self._weights: sp.csr_matrix = weights.T.tocsr()
+
+    @property
+    def categories(self) -> list[str]:
+        return self._categories
+
+    @property
+    def vocabulary_size(self) -> int:
+        return len(self._vocabulary)
+
+    def term_matrix(self, strings: list[str]) -> tuple[sp.csr_matrix, np.ndarray]:
+        rows, cols = [], []
+        oov = np.zeros(len(strings), dtype=np.float64)
+        for row, text in enumerate(strings):
+            tokens = text.split()
+            if self._weighting == "bm25":
+                tokens = set(tokens)
+            oov_counts = collections.Counter()
+            for token in tokens:
+                col = self._vocabulary.get(token)
+                if col is None:
+                    oov_counts[token] += 1
+                else:
+                    rows.append(row)
+                    cols.append(col)
+            oov[row] = sum(count * count for count in oov_counts.values())
+        matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(strings), len(self._vocabulary)))
+        return matrix, oov
+
+    def score_matrix(self, strings: list[str]) -> np.ndarray:
+        terms, oov = self.term_matrix(strings)
+        if self._weighting == "bm25":
+            scores = (terms @ self._weights).toarray()
+            norms = (terms @ self._idf + oov * self._oov_idf) * (self._k1 + 1)
+        else:
+            terms.data *= self._idf[terms.indices]
+            scores = (terms @ self._weights).toarray()
+            norms = np.sqrt(np.asarray(terms.multiply(terms).sum(axis=1)).ravel() + oov * self._oov_idf ** 2)
+        return scores / np.where(norms > 0, norms, 1.0)[:, None]
+
+
+def iter_term_weight_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        weighting: str = "bm25",
+        k1: float = 1.2,
+        b: float = 0.75,
+        batch_size: int = 100000
+) -> Iterator[ScoreBlock]:
+    index = LabelTermIndex(categories, weighting, k1, b)
+    for i in tqdm(range(0, len(strings), batch_size), desc=f"Calculating {weighting} similarity"):
+        yield ScoreBlock(i, index.categories, index.score_matrix(strings[i:i + batch_size]))
+
+
+def calculate_term_weight_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        weighting: str = "bm25",
+        k1: float = 1.2,
+        b: float = 0.75,
+        batch_size: int = 100000
+) -> dict[int, dict[str, float]]:
+    return collect_score_blocks(iter_term_weight_similarity(strings, categories, weighting, k1, b, batch_size))
+
+
+class LexicalPrefilter:
+    def __init__(self, categories: dict[str, set[str]], min_overlap: int = 1):
+        self._min_overlap = min_overlap
+        self._vocabulary: frozenset[str] = frozenset(token.lower() for labels in categories.values() for label in labels for token in label.split())
+
+    @property
+    def vocabulary_size(self) -> int:
+        return len(self._vocabulary)
+
+    def overlap(self, text: str) -> int:
+        return len(self._vocabulary.intersection(text.lower().split()))
+
+    def mask(self, strings: list[str]) -> np.ndarray:
+        return np.fromiter((self.overlap(text) >= self._min_overlap for text in strings), dtype=bool, count=len(strings))
+
+
+@dataclasses.dataclass(frozen=True)
+class CascadeRecall:
+    kept: int
+    total: int
+    matches: int
+    kept_matches: int
+    categories: int
+    kept_categories: int
+
+    @property
+    def keep_ratio(self) -> float:
+        return self.kept / self.total if self.total > 0 else 1.0
+
+    @property
+    def match_recall(self) -> float:
+        return self.kept_matches / self.matches if self.matches > 0 else 1.0
+
+    @property
+    def category_recall(self) -> float:
+        return self.kept_categories / self.categories if self.categories > 0 else 1.0
+
+    def __str__(self) -> str:
+        return (f"Kept: {self.kept}/{self.total} ({self.keep_ratio:.2%})   "
+                f"Match recall: {self.kept_matches}/{self.matches} ({self.match_recall:.2%})   "
+                f"Category recall: {self.kept_categories}/{self.categories} ({self.category_recall:.2%})")
+
+
+def measure_cascade_recall(full_scores: np.ndarray, cascade_scores: np.ndarray, mask: np.ndarray, threshold: float) -> CascadeRecall:
+    full_matches = full_scores >= threshold
+    cascade_matches = cascade_scores >= threshold
+    return CascadeRecall(
+        kept=int(mask.sum()),
+        total=len(mask),
+        matches=int(full_matches.sum()),
+        kept_matches=int((full_matches & cascade_matches).sum()),
+        categories=int(full_matches.any(axis=0).sum()),
+        kept_categories=int((full_matches.any(axis=0) & cascade_matches.any(axis=0)).sum())
+    )
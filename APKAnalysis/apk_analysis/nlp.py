@@ -1,63 +1,321 @@
+import atexit
+import collections
+import dataclasses
+import functools
 import math
 import multiprocessing
 import re
-from typing import Collection, Optional
+from typing import Callable, Collection, Iterator, Optional, Union
 
+import numpy as np
+import scipy.sparse as sp
 import spacy
 import torch
-from lingua import Language, LanguageDetectorBuilder
-from sentence_transformers import SentenceTransformer, util
+from spacy.tokens import Doc
+from spacy.vectors import Vectors
+from lingua import Language, LanguageDetector, LanguageDetectorBuilder
+from sentence_transformers import util
 from tqdm import tqdm
 
+from apk_analysis.embedding import EmbeddingStore
+from apk_analysis.encoder import SentenceEncoder, load_sentence_encoder
+from apk_analysis.lexical import LexicalPrefilter, iter_sparse_n_gram_jaccard_similarity
+from apk_analysis.pool import PoolMemoryReport, PreloadedPool
+from apk_analysis.scores import ScoreBlock, collect_score_blocks, collect_score_matrix
 from apk_analysis.utils import get_workers_size
 
 
-def _filter_language_text(texts: Collection[str], language: Language, accuracy: bool = False) -> set[str]:
-    detector_builder = LanguageDetectorBuilder.from_all_spoken_languages()
+_LANGUAGE_DETECTOR: Optional[LanguageDetector] = None
+
+
+def _build_language_detector(accuracy: bool = False, languages: Optional[frozenset[Language]] = None) -> LanguageDetector:
+    if languages is None:
+        detector_builder = LanguageDetectorBuilder.from_all_spoken_languages()
+    else:
+        detector_builder = LanguageDetectorBuilder.from_languages(*languages)
     if accuracy:
         detector_builder = detector_builder.with_low_accuracy_mode()
-    detector = detector_builder.build()
-    result = set()
-    for text in texts:
-        detect_language = detector.detect_language_of(text)
-        if detect_language == language:
-            result.add(text)
-    return result
+    return detector_builder.with_preloaded_language_models().build()
+
+
+def _init_language_detector(accuracy: bool, languages: Optional[frozenset[Language]]):
+    global _LANGUAGE_DETECTOR
+    _LANGUAGE_DETECTOR = _build_language_detector(accuracy, languages)
+
+
+def _filter_language_text(texts: list[str], language: Language) -> list[str]:
+    return [text for text in texts if _LANGUAGE_DETECTOR.detect_language_of(text) == language]
+
+
+class LanguageDetectorPool:
+    _INSTANCES: dict[tuple[int, bool, Optional[frozenset[Language]]], 'LanguageDetectorPool'] = {}
+
+    @staticmethod
+    def instance(workers: Optional[int] = None, accuracy: bool = False, languages: Optional[Collection[Language]] = None) -> 'LanguageDetectorPool':
+        key = (get_workers_size(0.5, workers), accuracy, frozenset(languages) if languages is not None else None)
+        if key not in LanguageDetectorPool._INSTANCES:
+            if len(LanguageDetectorPool._INSTANCES) == 0:
+                atexit.register(LanguageDetectorPool.close_all)
+            LanguageDetectorPool._INSTANCES[key] = LanguageDetectorPool(*key)
+        return LanguageDetectorPool._INSTANCES[key]
 
+    @staticmethod
+    def close_all():
+        for pool in LanguageDetectorPool._INSTANCES.values():
+            pool.close()
+        LanguageDetectorPool._INSTANCES.clear()
 
-def filter_english_text(texts: Collection[str], batch_size: int = 50, workers: Optional[int] = None, accuracy: bool = False) -> set[str]:
+    def __init__(self, workers: Optional[int] = None, accuracy: bool = False, languages: Optional[Collection[Language]] = None):
+        self._languages: Optional[frozenset[Language]] = frozenset(languages) if languages is not None else None
+        self._pool = PreloadedPool(
+            get_workers_size(0.5, workers),
+            preload=_init_language_detector,
+            preload_args=(accuracy, self._languages),
+            name="Language detector"
+        )
+
+    def filter_text(self, texts: Collection[str], language: Language, batch_size: int = 1000) -> set[str]:
+        if self._languages is not None and language not in self._languages:
+            raise ValueError(f"Language {language.name} is not in detector candidate languages")
+        texts = list(texts)
+        result = set()
+        batches = (texts[i:i + batch_size] for i in range(0, len(texts), batch_size))
+        with tqdm(total=math.ceil(len(texts) / batch_size), desc=f"Filtering {language.name} text") as pbar:
+            for batch_result in self._pool.imap_unordered(functools.partial(_filter_language_text, language=language), batches):
+                result.update(batch_result)
+                pbar.update(1)
+        return result
+
+    def memory_report(self) -> PoolMemoryReport:
+        return self._pool.memory_report()
+
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self) -> 'LanguageDetectorPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_SCRIPT_OTHER = 0
+_SCRIPT_ASCII_LETTER = 1
+_SCRIPT_LATIN_LETTER = 2
+_SCRIPT_NON_LATIN_LETTER = 3
+
+_SCRIPT_RANGES: list[tuple[int, int, int]] = [
+    (0x0041, 0x005A, _SCRIPT_ASCII_LETTER),
+    (0x0061, 0x007A, _SCRIPT_ASCII_LETTER),
+    (0x00C0, 0x00D6, _SCRIPT_LATIN_LETTER),
+    (0x00D8, 0x00F6, _SCRIPT_LATIN_LETTER),
+    (0x00F8, 0x024F, _SCRIPT_LATIN_LETTER),
+    (0x0370, 0x03FF, _SCRIPT_NON_LATIN_LETTER),  # Greek
+    (0x0400, 0x052F, _SCRIPT_NON_LATIN_LETTER),  # Cyrillic
+    (0x0530, 0x08FF, _SCRIPT_NON_LATIN_LETTER),  # Armenian, Hebrew, Arabic, Syriac, Thaana
+    (0x0900, 0x0DFF, _SCRIPT_NON_LATIN_LETTER),  # Indic
+    (0x0E00, 0x0FFF, _SCRIPT_NON_LATIN_LETTER),  # Thai, Lao, Tibetan
+    (0x1000, 0x139F, _SCRIPT_NON_LATIN_LETTER),  # Myanmar, Georgian, Hangul Jamo, Ethiopic
+    (0x1780, 0x17FF, _SCRIPT_NON_LATIN_LETTER),  # Khmer
+    (0x1E00, 0x1EFF, _SCRIPT_LATIN_LETTER),
+    (0x2E80, 0x9FFF, _SCRIPT_NON_LATIN_LETTER),  # CJK, Kana, Bopomofo
+    (0xA000, 0xA4CF, _SCRIPT_NON_LATIN_LETTER),  # Yi
+    (0xAC00, 0xD7AF, _SCRIPT_NON_LATIN_LETTER),  # Hangul
+    (0xF900, 0xFAFF, _SCRIPT_NON_LATIN_LETTER),  # CJK compatibility
+    (0xFF66, 0xFFDC, _SCRIPT_NON_LATIN_LETTER),  # Halfwidth Kana, Hangul
+    (0x20000, 0x3FFFF, _SCRIPT_NON_LATIN_LETTER),  # CJK extensions
+]
+
+# noinspection SpellCheckingInspection
+_ENGLISH_FUNCTION_WORDS = frozenset({
+    "a", "about", "after", "all", "an", "and", "are", "as", "at", "be", "been", "before", "but", "by", "can", "cannot", "could",
+    "do", "does", "for", "from", "has", "have", "how", "if", "in", "into", "is", "it", "its", "may", "more", "must", "no", "not",
+    "of", "on", "or", "our", "please", "should", "so", "than", "that", "the", "their", "there", "this", "to", "was", "we", "were",
+    "what", "when", "which", "while", "will", "with", "would", "you", "your"
+})
+_ENGLISH_WORD_PATTERN = re.compile(r"[a-z]+")
+
+_FAST_PATH_REJECT = -1
+_FAST_PATH_UNKNOWN = 0
+_FAST_PATH_ACCEPT = 1
+
+
+def _build_script_table() -> tuple[np.ndarray, np.ndarray]:
+    bounds, scripts = [0], [_SCRIPT_OTHER]
+    for start, end, script in sorted(_SCRIPT_RANGES):
+        bounds.extend((start, end + 1))
+        scripts.extend((script, _SCRIPT_OTHER))
+    return np.array(bounds, dtype=np.uint32), np.array(scripts, dtype=np.int64)
+
+
+_SCRIPT_BOUNDS, _SCRIPT_CLASSES = _build_script_table()
+
+
+@dataclasses.dataclass
+class LanguageFilterStats:
+    script_rejected: int = 0
+    ascii_accepted: int = 0
+    detector_checked: int = 0
+    detector_accepted: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.script_rejected + self.ascii_accepted + self.detector_checked
+
+    def __str__(self) -> str:
+        return f"Script rejected: {self.script_rejected}   ASCII accepted: {self.ascii_accepted}   " \
+               f"Detector checked: {self.detector_checked} (accepted {self.detector_accepted})"
+
+
+def _count_text_scripts(texts: list[str]) -> np.ndarray:
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    code_points = np.frombuffer("".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    scripts = _SCRIPT_CLASSES[np.searchsorted(_SCRIPT_BOUNDS, code_points, side="right") - 1]
+    owners = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+    return np.bincount(owners * 4 + scripts, minlength=len(texts) * 4).reshape(len(texts), 4)
+
+
+def _is_ascii_english_prose(text: str, min_words: int, min_function_word_ratio: float) -> bool:
+    words = _ENGLISH_WORD_PATTERN.findall(text.lower())
+    if len(words) < min_words:
+        return False
+    return sum(1 for word in words if word in _ENGLISH_FUNCTION_WORDS) >= min_function_word_ratio * len(words)
+
+
+def classify_english_text_by_script(texts: list[str], min_words: int = 4, min_function_word_ratio: float = 0.25) -> np.ndarray:
+    decisions = np.full(len(texts), _FAST_PATH_UNKNOWN, dtype=np.int8)
+    if len(texts) == 0:
+        return decisions
+    counts = _count_text_scripts(texts)
+    latin_letters = counts[:, _SCRIPT_ASCII_LETTER] + counts[:, _SCRIPT_LATIN_LETTER]
+    decisions[(latin_letters == 0) | (counts[:, _SCRIPT_NON_LATIN_LETTER] >= latin_letters)] = _FAST_PATH_REJECT
+    ascii_only = (counts[:, _SCRIPT_LATIN_LETTER] == 0) & (counts[:, _SCRIPT_NON_LATIN_LETTER] == 0) & (latin_letters >= min_words * 2)
+    for idx in np.flatnonzero(ascii_only & (decisions == _FAST_PATH_UNKNOWN)):
+        if _is_ascii_english_prose(texts[idx], min_words, min_function_word_ratio):
+            decisions[idx] = _FAST_PATH_ACCEPT
+    return decisions
+
+
+def filter_english_text(
+        texts: Collection[str],
+        batch_size: int = 1000,
+        workers: Optional[int] = None,
+        accuracy: bool = False,
+        languages: Optional[Collection[Language]] = None,
+        fast_path: bool = True,
+        stats: Optional[LanguageFilterStats] = None
+) -> set[str]:
     texts = list(texts)
     result = set()
-    with multiprocessing.Pool(processes=get_workers_size(0.5, workers)) as pool:
-        with tqdm(total=math.ceil(len(texts) / batch_size), desc=f"Filtering {Language.ENGLISH.name} text") as pbar:
-            batch_tasks = []
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i + batch_size]
-                batch_result = pool.apply_async(_filter_language_text, (batch_texts, Language.ENGLISH, accuracy), callback=lambda _: pbar.update(1))
-                batch_tasks.append(batch_result)
-            for batch_task in batch_tasks:
-                result.update(batch_task.get())
+    script_rejected, ascii_accepted = 0, 0
+    if fast_path:
+        decisions = classify_english_text_by_script(texts)
+        accepted = np.flatnonzero(decisions == _FAST_PATH_ACCEPT)
+        result.update(texts[i] for i in accepted)
+        detect_texts = [texts[i] for i in np.flatnonzero(decisions == _FAST_PATH_UNKNOWN)]
+        script_rejected, ascii_accepted = int(np.count_nonzero(decisions == _FAST_PATH_REJECT)), len(accepted)
+    else:
+        detect_texts = texts
+    if languages is not None:
+        languages = {Language.ENGLISH, *languages}
+    detect_result = LanguageDetectorPool.instance(workers, accuracy, languages).filter_text(detect_texts, Language.ENGLISH, batch_size)
+    if stats is not None:
+        stats.ascii_accepted += ascii_accepted
+        stats.detector_checked += len(detect_texts)
+        stats.detector_accepted += len(detect_result)
+        stats.script_rejected += script_rejected
+    result.update(detect_result)
     return result
 
 
+_URL_PATTERN = re.compile(r"https?://\S+")
+_TAG_PATTERN = re.compile(r"<.*?>")
+_NUMBER_PATTERN = re.compile(r"\b[0-9]+\b\s*")
+_CAMEL_CASE_PATTERN = re.compile(r"([a-z]|\d)([A-Z])")
+_NORMALIZE_SEPARATOR = "\n\0"
+
+
+def normalize_text(string: str) -> str:
+    string = _URL_PATTERN.sub("", string)
+    string = _TAG_PATTERN.sub(" ", string)
+    string = _NUMBER_PATTERN.sub("", string)
+    string = _CAMEL_CASE_PATTERN.sub(r"\1 \2", string)
+    return " ".join(string.split()).lower().strip()
+
+
+def normalize_texts(strings: Collection[str]) -> list[str]:
+    strings = list(strings)
+    if len(strings) == 0:
+        return []
+    joined = _NORMALIZE_SEPARATOR.join(strings)
+    if joined.count("\0") != len(strings) - 1:
+        return [normalize_text(i) for i in strings]
+    joined = _URL_PATTERN.sub("", joined)
+    joined = _TAG_PATTERN.sub(" ", joined)
+    joined = _NUMBER_PATTERN.sub("", joined)
+    joined = _CAMEL_CASE_PATTERN.sub(r"\1 \2", joined)
+    return [" ".join(i.split()).lower().strip() for i in joined.split("\0")]
+
+
+SENTENCE_SPLITTERS = ("parser", "senter", "sentencizer")
+
+
 # noinspection SpellCheckingInspection
-def clean_text(strings: list[str], model: str, show_bar: bool = False, workers: int = 1) -> list[str]:
-    nlp = spacy.load(model)
-    re_strings = []
-    for string in strings:
-        string = re.sub(r"https?://\S+", "", string)
-        string = re.sub(r"<.*?>", " ", string)
-        string = re.sub(r"\b[0-9]+\b\s*", "", string)
-        string = re.sub(r"([a-z]|\d)([A-Z])", r"\1 \2", string)
-        string = " ".join(string.split())
-        string = string.lower().strip()
-        if len(string) > 2:
-            re_strings.append(string)
-    iter_data = nlp.pipe(re_strings, n_process=workers)
-    if show_bar:
-        iter_data = tqdm(iter_data, total=len(re_strings), desc="Cleaning text")
-    clean_texts = []
-    for doc in iter_data:
+class TextCleaner:
+    _INSTANCES: dict[tuple[str, str], 'TextCleaner'] = {}
+    _PIPE_CHARS_PER_BATCH = 100000
+    _PIPE_MIN_BATCH_SIZE = 32
+    _PIPE_MAX_BATCH_SIZE = 4096
+
+    @staticmethod
+    def instance(model: str, sentence_splitter: str = "parser") -> 'TextCleaner':
+        key = (model, sentence_splitter)
+        if key not in TextCleaner._INSTANCES:
+            TextCleaner._INSTANCES[key] = TextCleaner(model, sentence_splitter)
+        return TextCleaner._INSTANCES[key]
+
+    def __init__(self, model: str, sentence_splitter: str = "parser"):
+        if sentence_splitter == "parser":
+            nlp = spacy.load(model, exclude=["ner", "senter"])
+        elif sentence_splitter == "senter":
+            nlp = spacy.load(model, exclude=["parser", "ner"])
+            if "senter" in nlp.disabled:
+                nlp.enable_pipe("senter")
+            elif "senter" not in nlp.pipe_names:
+                nlp.add_pipe("sentencizer")
+        elif sentence_splitter == "sentencizer":
+            nlp = spacy.load(model, exclude=["parser", "ner", "senter"])
+            nlp.add_pipe("sentencizer")
+        else:
+            raise ValueError(f"Unknown sentence splitter: {sentence_splitter}")
+        self._nlp = nlp
+        self._sentence_splitter = sentence_splitter
+
+    @property
+    def model_name(self) -> str:
+        return f"{self._nlp.meta['lang']}_{self._nlp.meta['name']}"
+
+    @property
+    def model_version(self) -> str:
+        return self._nlp.meta["version"]
+
+    @property
+    def sentence_splitter(self) -> str:
+        return self._sentence_splitter
+
+    @staticmethod
+    def normalize(strings: Collection[str]) -> list[str]:
+        return [i for i in normalize_texts(strings) if len(i) > 2]
+
+    def _pipe_batch_size(self, strings: list[str]) -> int:
+        if len(strings) == 0:
+            return self._PIPE_MIN_BATCH_SIZE
+        avg_length = max(1, sum(len(i) for i in strings) // len(strings))
+        return max(self._PIPE_MIN_BATCH_SIZE, min(self._PIPE_MAX_BATCH_SIZE, self._PIPE_CHARS_PER_BATCH // avg_length))
+
+    @staticmethod
+    def _clean_doc(doc: Doc) -> list[str]:
+        clean_texts = []
         for sentence_doc in doc.sents:
             sentence = []
             for token in sentence_doc:
@@ -67,7 +325,33 @@ def clean_text(strings: list[str], model: str, show_bar: bool = False, workers:
                     sentence.append(token.lemma_)
             if len(sentence) > 0:
                 clean_texts.append(" ".join(sentence))
-    return clean_texts
+        return clean_texts
+
+    def clean(self, strings: Collection[str], show_bar: bool = False, workers: int = 1) -> list[str]:
+        re_strings = self.normalize(strings)
+        iter_data = self._nlp.pipe(re_strings, batch_size=self._pipe_batch_size(re_strings), n_process=workers)
+        if show_bar:
+            iter_data = tqdm(iter_data, total=len(re_strings), desc="Cleaning text")
+        return [sentence for doc in iter_data for sentence in self._clean_doc(doc)]
+
+    def clean_each(self, strings: Collection[str], workers: int = 1) -> list[list[str]]:
+        re_strings = normalize_texts(strings)
+        valid_strings = [i for i in re_strings if len(i) > 2]
+        iter_data = iter(self._nlp.pipe(valid_strings, batch_size=self._pipe_batch_size(valid_strings), n_process=workers))
+        return [self._clean_doc(next(iter_data)) if len(i) > 2 else [] for i in re_strings]
+
+
+def get_text_cleaner_namespace(model: str, sentence_splitter: str = "parser") -> str:
+    return f"{model}=={spacy.util.get_package_version(model)}:{sentence_splitter}"
+
+
+def init_text_cleaner(model: str, sentence_splitter: str = "parser"):
+    TextCleaner.instance(model, sentence_splitter)
+
+
+# noinspection SpellCheckingInspection
+def clean_text(strings: Collection[str], model: str, show_bar: bool = False, workers: int = 1, sentence_splitter: str = "parser") -> list[str]:
+    return TextCleaner.instance(model, sentence_splitter).clean(strings, show_bar, workers)
 
 
 def n_gram(tokens: Collection[str], n: int) -> list[tuple[str]]:
@@ -101,25 +385,59 @@ def _calculate_n_gram_jaccard_similarity(strings: list[str], categories_docs: di
     return all_scores
 
 
+N_GRAM_JACCARD_BACKENDS = ("pool", "sparse")
+
+
+def _iter_pool_batches(
+        pool: multiprocessing.Pool,
+        func: Callable[[list[str]], any],
+        strings: list[str],
+        batch_size: int,
+        max_pending: int
+) -> Iterator[tuple[int, any]]:
+    pending = collections.deque()
+    with tqdm(total=math.ceil(len(strings) / batch_size), desc=f"Calculating batch similarity") as pbar:
+        for i in range(0, len(strings), batch_size):
+            pending.append((i, pool.apply_async(func, (strings[i:i + batch_size],))))
+            while len(pending) >= max_pending:
+                start_idx, batch_task = pending.popleft()
+                yield start_idx, batch_task.get()
+                pbar.update(1)
+        while len(pending) > 0:
+            start_idx, batch_task = pending.popleft()
+            yield start_idx, batch_task.get()
+            pbar.update(1)
+
+
+def iter_n_gram_jaccard_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        batch_size: int = 500,
+        workers: Optional[int] = None,
+        backend: str = "pool"
+) -> Iterator[ScoreBlock]:
+    categories_docs: dict[str, list[tuple[str]]] = {k: [tuple(i.split()) for i in v] for k, v in categories.items()}
+    if backend == "sparse":
+        yield from iter_sparse_n_gram_jaccard_similarity(strings, categories_docs)
+        return
+    elif backend != "pool":
+        raise ValueError(f"Unknown n gram jaccard backend: {backend}")
+    category_names = list(categories_docs.keys())
+    workers = get_workers_size(1 / 2, workers)
+    with multiprocessing.Pool(processes=workers) as pool:
+        func = functools.partial(_calculate_n_gram_jaccard_similarity, categories_docs=categories_docs)
+        for start_idx, scores in _iter_pool_batches(pool, func, strings, batch_size, workers * 2):
+            yield ScoreBlock(start_idx, category_names, np.array([[score[c] for c in category_names] for score in scores], dtype=np.float64))
+
+
 def calculate_n_gram_jaccard_similarity(
         strings: list[str],
         categories: dict[str, set[str]],
         batch_size: int = 500,
-        workers: Optional[int] = None
+        workers: Optional[int] = None,
+        backend: str = "pool"
 ) -> dict[int, dict[str, float]]:
-    result: dict[int, dict[str, float]] = {}
-    categories_docs: dict[str, list[tuple[str]]] = {k: [tuple(i.split()) for i in v] for k, v in categories.items()}
-    with multiprocessing.Pool(processes=get_workers_size(1 / 2, workers)) as pool:
-        with tqdm(total=math.ceil(len(strings) / batch_size), desc=f"Calculating batch similarity") as pbar:
-            batch_tasks: dict = {}
-            for i in range(0, len(strings), batch_size):
-                batch_texts = strings[i:i + batch_size]
-                batch_result = pool.apply_async(_calculate_n_gram_jaccard_similarity, (batch_texts, categories_docs), callback=lambda _: pbar.update(1))
-                batch_tasks[i] = batch_result
-            for start_idx, batch_task in batch_tasks.items():
-                for score_idx, score in enumerate(batch_task.get()):
-                    result[start_idx + score_idx] = score
-    return result
+    return collect_score_blocks(iter_n_gram_jaccard_similarity(strings, categories, batch_size, workers, backend))
 
 
 def calculate_cosine_similarity(strings: list[str], categories: dict[str, set[str]], model: str, workers: int = 1) -> dict[int, dict[str, float]]:
@@ -136,22 +454,121 @@ def calculate_cosine_similarity(strings: list[str], categories: dict[str, set[st
     return all_scores
 
 
-def _calculate_n_gram_similarity(strings: list[str], categories_docs: dict[str, list[tuple[str]]]) -> list[dict[str, float]]:
-    all_scores: list[dict[str, float]] = []
-    for idx, text in enumerate(strings):
-        tokens: list[str] = text.split()
-        scores: dict[str, float] = {}
-        for category, category_words in categories_docs.items():
-            similarities = []
+def _average_static_vectors(orths_list: list[list[int]], vectors: Vectors) -> tuple[np.ndarray, np.ndarray]:
+    lengths = np.fromiter((len(orths) for orths in orths_list), dtype=np.int64, count=len(orths_list))
+    vector_rows = np.asarray(vectors.find(keys=[orth for orths in orths_list for orth in orths]), dtype=np.int64)
+    owners = np.repeat(np.arange(len(orths_list), dtype=np.int64), lengths)
+    valid = vector_rows >= 0
+    weights = sp.csr_matrix(
+        ((1 / lengths[owners[valid]]).astype(np.float32), (owners[valid], vector_rows[valid])),
+        shape=(len(orths_list), vectors.data.shape[0])
+    )
+    has_vector = np.bincount(owners[valid], minlength=len(orths_list)) > 0
+    return np.asarray(weights @ vectors.data, dtype=np.float32), has_vector
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def iter_vector_cosine_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        model: str,
+        batch_size: int = 50000
+) -> Iterator[ScoreBlock]:
+    nlp = spacy.load(model, exclude=["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer", "ner"])
+    vectors: Vectors = nlp.vocab.vectors
+    category_names = list(categories.keys())
+    category_orths = [[token.orth for token in nlp.tokenizer(" ".join(sorted([j for i in v for j in i.split()])))] for v in categories.values()]
+    category_vectors = _normalize_rows(_average_static_vectors(category_orths, vectors)[0])
+    same_category_orths: dict[tuple[int, ...], list[int]] = {}
+    for category_idx, orths in enumerate(category_orths):
+        same_category_orths.setdefault(tuple(orths), []).append(category_idx)
+
+    for i in tqdm(range(0, len(strings), batch_size), desc="Calculating vector similarity"):
+        orths_list = [[token.orth for token in doc] for doc in nlp.tokenizer.pipe(strings[i:i + batch_size])]
+        string_vectors, has_vector = _average_static_vectors(orths_list, vectors)
+        scores = _normalize_rows(string_vectors) @ category_vectors.T
+        for row, orths in enumerate(orths_list):
+            if has_vector[row] and tuple(orths) in same_category_orths:
+                scores[row, same_category_orths[tuple(orths)]] = 1.0
+        yield ScoreBlock(i, category_names, scores)
+
+
+def calculate_vector_cosine_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        model: str,
+        batch_size: int = 50000
+) -> dict[int, dict[str, float]]:
+    return collect_score_blocks(iter_vector_cosine_similarity(strings, categories, model, batch_size))
+
+
+class NGramIndex:
+    def __init__(self, categories_docs: dict[str, list[tuple[str]]]):
+        self._categories: list[str] = list(categories_docs.keys())
+        self._label_sizes: list[int] = [len(v) for v in categories_docs.values()]
+        self._index: dict[int, dict[tuple[str], dict[int, int]]] = {}
+        for category_idx, category_words in enumerate(categories_docs.values()):
             for category_tokens in category_words:
-                if len(category_tokens) <= len(tokens):
-                    tokens_pairs = n_gram(tokens, len(category_tokens))
-                    similarities.append(tokens_pairs.count(category_tokens))
-                else:
-                    similarities.append(0.0)
-            scores[category] = sum(similarities) / len(similarities)
-        all_scores.append(scores)
-    return all_scores
+                grams = self._index.setdefault(len(category_tokens), {})
+                category_counts = grams.setdefault(category_tokens, {})
+                category_counts[category_idx] = category_counts.get(category_idx, 0) + 1
+        self._sizes: list[int] = sorted(self._index.keys())
+
+    @property
+    def categories(self) -> list[str]:
+        return self._categories
+
+    def count(self, tokens: list[str]) -> list[int]:
+        counts = [0] * len(self._categories)
+        for n in self._sizes:
+            if n > len(tokens):
+                break
+            grams = self._index[n]
+            for i in range(len(tokens) - n + 1):
+                category_counts = grams.get(tuple(tokens[i:i + n]))
+                if category_counts is not None:
+                    for category_idx, count in category_counts.items():
+                        counts[category_idx] += count
+        return counts
+
+    def score(self, tokens: list[str]) -> dict[str, float]:
+        return {
+            category: count / label_size
+            for category, count, label_size in zip(self._categories, self.count(tokens), self._label_sizes)
+        }
+
+    def score_matrix(self, tokens_list: list[list[str]]) -> np.ndarray:
+        counts = np.array([self.count(tokens) for tokens in tokens_list], dtype=np.float64).reshape(len(tokens_list), len(self._categories))
+        return counts / np.array(self._label_sizes, dtype=np.float64)
+
+
+_N_GRAM_INDEX: Optional[NGramIndex] = None
+
+
+def _init_n_gram_index(n_gram_index: NGramIndex):
+    global _N_GRAM_INDEX
+    _N_GRAM_INDEX = n_gram_index
+
+
+def _calculate_n_gram_similarity(strings: list[str]) -> np.ndarray:
+    return _N_GRAM_INDEX.score_matrix([text.split() for text in strings])
+
+
+def iter_n_gram_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        batch_size: int = 500,
+        workers: Optional[int] = None
+) -> Iterator[ScoreBlock]:
+    n_gram_index = NGramIndex({k: [tuple(i.split()) for i in v] for k, v in categories.items()})
+    workers = get_workers_size(1 / 2, workers)
+    with multiprocessing.Pool(processes=workers, initializer=_init_n_gram_index, initargs=(n_gram_index,)) as pool:
+        for start_idx, scores in _iter_pool_batches(pool, _calculate_n_gram_similarity, strings, batch_size, workers * 2):
+            yield ScoreBlock(start_idx, n_gram_index.categories, scores)
 
 
 def calculate_n_gram_similarity(
@@ -160,52 +577,132 @@ def calculate_n_gram_similarity(
         batch_size: int = 500,
         workers: Optional[int] = None
 ) -> dict[int, dict[str, float]]:
-    result: dict[int, dict[str, float]] = {}
-    categories_docs: dict[str, list[tuple[str]]] = {k: [tuple(i.split()) for i in v] for k, v in categories.items()}
-    with multiprocessing.Pool(processes=get_workers_size(1 / 2, workers)) as pool:
-        with tqdm(total=math.ceil(len(strings) / batch_size), desc=f"Calculating batch similarity") as pbar:
-            batch_tasks: dict = {}
-            for i in range(0, len(strings), batch_size):
-                batch_texts = strings[i:i + batch_size]
-                batch_result = pool.apply_async(_calculate_n_gram_similarity, (batch_texts, categories_docs), callback=lambda _: pbar.update(1))
-                batch_tasks[i] = batch_result
-            for start_idx, batch_task in batch_tasks.items():
-                for score_idx, score in enumerate(batch_task.get()):
-                    result[start_idx + score_idx] = score
-    return result
+    return collect_score_blocks(iter_n_gram_similarity(strings, categories, batch_size, workers))
 
 
-def calculate_transformer_cosine_similarity(
+def encode_sentences(
+        model: SentenceEncoder,
+        texts: list[str],
+        store: Optional[EmbeddingStore] = None,
+        batch_size: int = 256,
+        show_progress_bar: bool = False,
+        normalize_embeddings: bool = False
+) -> torch.Tensor:
+    if store is None:
+        return model.encode_tensor(texts, batch_size=batch_size, show_progress_bar=show_progress_bar, normalize_embeddings=normalize_embeddings)
+    if store.model != model.identifier:
+        raise ValueError(f"Embedding store model {store.model} does not match sentence encoder {model.identifier}")
+    embeddings = store.encode(texts, lambda missing: model.encode(missing, batch_size=batch_size, show_progress_bar=show_progress_bar))
+    embeddings = torch.from_numpy(embeddings).to(model.device)
+    if normalize_embeddings:
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+    return embeddings
+
+
+def iter_transformer_cosine_similarity(
         strings: list[str],
         categories: dict[str, set[str]],
-        model: str,
-        batch_size: int = 80000
-) -> dict[int, dict[str, float]]:
-    model = SentenceTransformer(model)
+        model: Union[str, SentenceEncoder],
+        batch_size: int = 80000,
+        store: Optional[EmbeddingStore] = None
+) -> Iterator[ScoreBlock]:
+    if isinstance(model, str):
+        model = load_sentence_encoder(model)
 
     print("Preparing categories embeddings")
-    categories_embeddings = dict({c: model.encode(list(sorted(v)), convert_to_tensor=True) for c, v in categories.items()})
+    categories_embeddings = dict({c: encode_sentences(model, list(sorted(v)), store) for c, v in categories.items()})
+    category_names = list(categories_embeddings.keys())
 
-    result: dict[int, dict[str, float]] = {}
     total_text_batch = math.ceil(len(strings) / batch_size)
     for b, i in enumerate(range(0, len(strings), batch_size)):
         batch_texts = strings[i:i + batch_size]
 
         print(f"Preparing strings embeddings: {b + 1}/{total_text_batch}")
-        strings_embeddings = model.encode(batch_texts, batch_size=256, convert_to_tensor=True, show_progress_bar=True)
-
-        for category, category_embedding in tqdm(categories_embeddings.items(), total=len(categories_embeddings), desc=f"Calculating similarity"):
-            matrix = util.cos_sim(strings_embeddings, category_embedding).tolist()
-            for idx in range(len(matrix)):
-                score = sum(matrix[idx]) / len(matrix[idx])
-                key = i + idx
-                if key in result:
-                    result[key][category] = score
-                else:
-                    result[key] = {category: score}
+        strings_embeddings = encode_sentences(model, batch_texts, store, show_progress_bar=True)
+
+        scores = np.zeros((len(batch_texts), len(category_names)), dtype=np.float64)
+        for category_idx, category_embedding in enumerate(tqdm(categories_embeddings.values(), total=len(categories_embeddings), desc=f"Calculating similarity")):
+            scores[:, category_idx] = util.cos_sim(strings_embeddings, category_embedding).double().mean(dim=1).cpu().numpy()
 
         del strings_embeddings
         torch.cuda.empty_cache()
+        yield ScoreBlock(i, category_names, scores)
     del categories_embeddings
     torch.cuda.empty_cache()
-    return result
+
+
+def calculate_transformer_cosine_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        model: Union[str, SentenceEncoder],
+        batch_size: int = 80000,
+        store: Optional[EmbeddingStore] = None
+) -> dict[int, dict[str, float]]:
+    return collect_score_blocks(iter_transformer_cosine_similarity(strings, categories, model, batch_size, store))
+
+
+def encode_category_centroids(
+        model: SentenceEncoder,
+        categories: dict[str, set[str]],
+        store: Optional[EmbeddingStore] = None
+) -> tuple[list[str], torch.Tensor]:
+    category_names = sorted(categories.keys())
+    centroids = [
+        encode_sentences(model, list(sorted(categories[c])), store, normalize_embeddings=True).mean(dim=0)
+        for c in category_names
+    ]
+    return category_names, torch.stack(centroids)
+
+
+def iter_transformer_centroid_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        model: Union[str, SentenceEncoder],
+        batch_size: int = 80000,
+        store: Optional[EmbeddingStore] = None
+) -> Iterator[ScoreBlock]:
+    if isinstance(model, str):
+        model = load_sentence_encoder(model)
+
+    print("Preparing categories centroids")
+    category_names, centroids = encode_category_centroids(model, categories, store)
+
+    total_text_batch = math.ceil(len(strings) / batch_size)
+    for b, i in enumerate(range(0, len(strings), batch_size)):
+        batch_texts = strings[i:i + batch_size]
+
+        print(f"Preparing strings embeddings: {b + 1}/{total_text_batch}")
+        strings_embeddings = encode_sentences(model, batch_texts, store, show_progress_bar=True, normalize_embeddings=True)
+        scores = (strings_embeddings @ centroids.T).float().cpu().numpy()
+
+        del strings_embeddings
+        torch.cuda.empty_cache()
+        yield ScoreBlock(i, category_names, scores)
+    del centroids
+    torch.cuda.empty_cache()
+
+
+def calculate_transformer_centroid_similarity(
+        strings: list[str],
+        categories: dict[str, set[str]],
+        model: Union[str, SentenceEncoder],
+        batch_size: int = 80000,
+        store: Optional[EmbeddingStore] = None
+) -> tuple[np.ndarray, list[str]]:
+    scores, category_names = collect_score_matrix(iter_transformer_centroid_similarity(strings, categories, model, batch_size, store), len(strings))
+    if len(category_names) == 0:
+        category_names = sorted(categories.keys())
+        scores = np.zeros((len(strings), len(category_names)), dtype=np.float32)
+    return scores, category_names
+
+
+def calculate_cascade_similarity(
+        strings: list[str],
+        prefilter: LexicalPrefilter,
+        scorer: Callable[[list[str]], tuple[np.ndarray, list[str]]]
+) -> tuple[np.ndarray, list[str], np.ndarray]:
+    mask = prefilter.mask(strings)
+    survivor_scores, category_names = scorer([text for text, keep in zip(strings, mask) if keep])
+    scores = np.zeros((len(strings), len(category_names)), dtype=survivor_scores.dtype)
+    scores[mask] = survivor_scores
+    return scores, category_names, mask
@@ -0,0 +1,122 @@
+import asyncio
+import dataclasses
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterable, Callable, Iterable, Optional, Union
+
+_STOP = object()
+
+
+@dataclasses.dataclass
+class StageStats:
+    name: str
+    workers: int
+    processed: int = 0
+    dropped: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+    max_queue: int = 0
+
+    def __str__(self) -> str:
+        return (f"{self.name}: Workers: {self.workers}   Processed: {self.processed}   Dropped: {self.dropped}   Failed: {self.failed}   "
+                f"Busy: {self.busy_seconds:.1f}s   Max queue: {self.max_queue}")
+
+
+@dataclasses.dataclass(frozen=True)
+class PipelineStage:
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    queue_size: int = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class PipelineError:
+    stage: str
+    item: Any
+    error: BaseException
+
+    def __str__(self) -> str:
+        return f"{self.stage} failed: {self.item} -> {type(self.error).__name__}: {self.error}"
+
+
+class Pipeline:
+    def __init__(self, stages: list[PipelineStage]):
+        if len(stages) == 0:
+            raise ValueError("Pipeline requires at least one stage")
+        self._stages = stages
+        self.stats = [StageStats(stage.name, stage.workers) for stage in stages]
+        self.errors: list[PipelineError] = []
+
+    async def _call(self, stage: PipelineStage, executor: Optional[ThreadPoolExecutor], item: Any) -> Any:
+        if executor is None:
+            return await stage.func(item)
+        return await asyncio.get_running_loop().run_in_executor(executor, stage.func, item)
+
+    async def _run_worker(
+            self,
+            stage: PipelineStage,
+            stats: StageStats,
+            executor: Optional[ThreadPoolExecutor],
+            queue: asyncio.Queue,
+            output: Optional[asyncio.Queue],
+            output_stats: Optional[StageStats]
+    ):
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            start = time.perf_counter()
+            try:
+                result = await self._call(stage, executor, item)
+            except Exception as e:
+                stats.failed += 1
+                self.errors.append(PipelineError(stage.name, item, e))
+                continue
+            finally:
+                stats.busy_seconds += time.perf_counter() - start
+            if result is None:
+                stats.dropped += 1
+                continue
+            stats.processed += 1
+            if output is not None:
+                await output.put(result)
+                output_stats.max_queue = max(output_stats.max_queue, output.qsize())
+
+    async def _run_stage(self, index: int, queues: list[asyncio.Queue]):
+        stage = self._stages[index]
+        executor = None if inspect.iscoroutinefunction(stage.func) else ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=stage.name)
+        output, output_stats = (queues[index + 1], self.stats[index + 1]) if index + 1 < len(queues) else (None, None)
+        try:
+            await asyncio.gather(*[self._run_worker(stage, self.stats[index], executor, queues[index], output, output_stats) for _ in range(stage.workers)])
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        if output is not None:
+            for _ in range(self._stages[index + 1].workers):
+                await output.put(_STOP)
+
+    async def _put_source(self, queue: asyncio.Queue, item: Any):
+        await queue.put(item)
+        self.stats[0].max_queue = max(self.stats[0].max_queue, queue.qsize())
+
+    async def run(self, items: Union[Iterable, AsyncIterable]):
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self._stages]
+        stage_tasks = [asyncio.create_task(self._run_stage(i, queues)) for i in range(len(self._stages))]
+        try:
+            if isinstance(items, AsyncIterable):
+                async for item in items:
+                    await self._put_source(queues[0], item)
+            else:
+                for item in items:
+                    await self._put_source(queues[0], item)
+            for _ in range(self._stages[0].workers):
+                await queues[0].put(_STOP)
+            await asyncio.gather(*stage_tasks)
+        finally:
+            for task in stage_tasks:
+                task.cancel()
+
+    def __str__(self) -> str:
+        return "\n".join(str(i) for i in self.stats)
@@ -0,0 +1,119 @@
+import dataclasses
+import gc
+import multiprocessing
+import os
+from typing import Callable, Iterable, Iterator, Optional
+
+import psutil
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcessMemory:
+    pid: int
+    rss: int
+    uss: int
+
+    @property
+    def shared(self) -> int:
+        return self.rss - self.uss
+
+
+def get_process_memory(pid: int) -> Optional[ProcessMemory]:
+    try:
+        info = psutil.Process(pid).memory_full_info()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+    return ProcessMemory(pid=pid, rss=info.rss, uss=info.uss)
+
+
+def _worker_pid(_: int) -> int:
+    return os.getpid()
+
+
+def _format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+@dataclasses.dataclass
+class PoolMemoryReport:
+    name: str
+    shared_preload: bool
+    parent: Optional[ProcessMemory] = None
+    before: dict[int, ProcessMemory] = dataclasses.field(default_factory=dict)
+    after: dict[int, ProcessMemory] = dataclasses.field(default_factory=dict)
+
+    def __str__(self) -> str:
+        lines = [f"{self.name} pool memory (shared preload: {self.shared_preload})"]
+        if self.parent is not None:
+            lines.append(f"Parent {self.parent.pid}: RSS {_format_size(self.parent.rss)}   USS {_format_size(self.parent.uss)}")
+        for pid, before in self.before.items():
+            line = f"Worker {pid}: RSS {_format_size(before.rss)}   USS {_format_size(before.uss)}"
+            after = self.after.get(pid)
+            if after is not None:
+                line += f"  ->  RSS {_format_size(after.rss)}   USS {_format_size(after.uss)}   Shared {_format_size(after.shared)}"
+            lines.append(line)
+        if len(self.after) > 0:
+            lines.append(f"Total worker USS: {_format_size(sum(i.uss for i in self.after.values()))}")
+        return "\n".join(lines)
+
+
+class PreloadedPool:
+    def __init__(
+            self,
+            processes: int,
+            preload: Optional[Callable] = None,
+            preload_args: tuple = (),
+            name: str = "Worker",
+            share: bool = True
+    ):
+        self._processes = processes
+        self._share = share and "fork" in multiprocessing.get_all_start_methods()
+        if self._share:
+            if preload is not None:
+                preload(*preload_args)
+            gc.collect()
+            gc.freeze()
+            try:
+                self._pool = multiprocessing.get_context("fork").Pool(processes=processes)
+            finally:
+                gc.unfreeze()
+        else:
+            self._pool = multiprocessing.Pool(processes=processes, initializer=preload, initargs=preload_args)
+        self._pool.map(_worker_pid, range(processes), chunksize=1)
+        self.memory = PoolMemoryReport(name=name, shared_preload=self._share, parent=get_process_memory(os.getpid()), before=self._measure_workers())
+
+    def _measure_workers(self) -> dict[int, ProcessMemory]:
+        result = {}
+        # noinspection PyUnresolvedReferences,PyProtectedMember
+        for process in self._pool._pool:
+            memory = get_process_memory(process.pid)
+            if memory is not None:
+                result[process.pid] = memory
+        return result
+
+    def memory_report(self) -> PoolMemoryReport:
+        self.memory.after = self._measure_workers()
+        return self.memory
+
+    def apply_async(self, func: Callable, args: tuple = (), callback: Optional[Callable] = None):
+        return self._pool.apply_async(func, args, callback=callback)
+
+    def imap_unordered(self, func: Callable, iterable: Iterable, chunksize: int = 1) -> Iterator:
+        return self._pool.imap_unordered(func, iterable, chunksize)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self) -> 'PreloadedPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
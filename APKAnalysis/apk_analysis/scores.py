@@ -0,0 +1,100 @@
+import dataclasses
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def scores_to_dict(scores: np.ndarray, categories: list[str], start: int = 0) -> dict[int, dict[str, float]]:
+    return {start + idx: dict(zip(categories, row)) for idx, row in enumerate(scores.tolist())}
+
+
+@dataclasses.dataclass(frozen=True)
+class ScoreBlock:
+    start: int
+    categories: list[str]
+    scores: np.ndarray
+
+    def __len__(self) -> int:
+        return self.scores.shape[0]
+
+    @property
+    def stop(self) -> int:
+        return self.start + len(self)
+
+    def to_dict(self) -> dict[int, dict[str, float]]:
+        return scores_to_dict(self.scores, self.categories, self.start)
+
+
+def select_top_scores(scores: np.ndarray, top_k: Optional[int] = None, threshold: Optional[float] = None) -> sp.csr_matrix:
+    if top_k is None and threshold is None:
+        raise ValueError("Sparse scores require top_k or threshold")
+    mask = np.zeros(scores.shape, dtype=bool)
+    if top_k is not None and top_k > 0 and scores.shape[0] > 0:
+        if top_k >= scores.shape[1]:
+            mask[:] = True
+        else:
+            columns = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            np.put_along_axis(mask, columns, True, axis=1)
+    if threshold is not None:
+        mask |= scores >= threshold
+    mask &= scores != 0
+    rows, columns = np.nonzero(mask)
+    return sp.csr_matrix((scores[rows, columns].astype(np.float32), (rows, columns)), shape=scores.shape, dtype=np.float32)
+
+
+@dataclasses.dataclass(frozen=True)
+class SparseScoreBlock:
+    start: int
+    categories: list[str]
+    scores: sp.csr_matrix
+
+    def __len__(self) -> int:
+        return self.scores.shape[0]
+
+    @property
+    def stop(self) -> int:
+        return self.start + len(self)
+
+    def to_dense(self) -> ScoreBlock:
+        return ScoreBlock(self.start, self.categories, self.scores.toarray())
+
+    def to_dict(self) -> dict[int, dict[str, float]]:
+        result = {}
+        for idx in range(len(self)):
+            row = self.scores.getrow(idx)
+            result[self.start + idx] = {self.categories[c]: v for c, v in zip(row.indices.tolist(), row.data.tolist())}
+        return result
+
+
+AnyScoreBlock = Union[ScoreBlock, SparseScoreBlock]
+
+
+def iter_sparse_score_blocks(blocks: Iterable[AnyScoreBlock], top_k: Optional[int] = None, threshold: Optional[float] = None) -> Iterator[SparseScoreBlock]:
+    for block in blocks:
+        if isinstance(block, SparseScoreBlock):
+            yield block
+        else:
+            yield SparseScoreBlock(block.start, block.categories, select_top_scores(block.scores, top_k, threshold))
+
+
+def collect_score_blocks(blocks: Iterable[AnyScoreBlock]) -> dict[int, dict[str, float]]:
+    result: dict[int, dict[str, float]] = {}
+    for block in blocks:
+        result.update(block.to_dict())
+    return result
+
+
+def collect_score_matrix(blocks: Iterable[AnyScoreBlock], size: int) -> tuple[np.ndarray, list[str]]:
+    result: Optional[np.ndarray] = None
+    categories: list[str] = []
+    for block in blocks:
+        if isinstance(block, SparseScoreBlock):
+            block = block.to_dense()
+        if result is None:
+            result = np.zeros((size, len(block.categories)), dtype=block.scores.dtype)
+            categories = block.categories
+        result[block.start:block.stop] = block.scores
+    if result is None:
+        result = np.zeros((size, 0), dtype=np.float32)
+    return result, categories
@@ -0,0 +1,217 @@
+import asyncio
+import dataclasses
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from .encoder import SentenceEncoder
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "apk_analysis_encoder.sock")
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHARED_MEMORY_PREFIX = "apk_analysis_"
+
+
+@dataclasses.dataclass
+class EncoderServerStats:
+    requests: int = 0
+    items: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"Requests: {self.requests}   Items: {self.items}   Batches: {self.batches}   "
+                f"Mean batch size: {self.mean_batch_size:.1f}   Encoding: {self.seconds:.2f}s")
+
+
+@dataclasses.dataclass
+class _EncodeRequest:
+    texts: list[str]
+    path: str
+    normalize: bool
+    future: asyncio.Future
+
+
+class EncoderServer:
+    def __init__(self, encoder: SentenceEncoder, socket_path: str = DEFAULT_SOCKET_PATH, max_batch_size: int = 1024, max_delay: float = 0.01):
+        self._encoder = encoder
+        self._socket_path = socket_path
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self.stats = EncoderServerStats()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                op = request.get("op")
+                if op == "info":
+                    response = {"ok": True, "model": self._encoder.model, "identifier": self._encoder.identifier, "dimension": self._encoder.dimension}
+                elif op == "ping":
+                    response = {"ok": True, "pong": True}
+                elif op == "tokens":
+                    response = {"ok": True, "lengths": self._encoder.token_lengths(request["texts"]).tolist()}
+                elif op == "encode":
+                    future = asyncio.get_running_loop().create_future()
+                    await self._queue.put(_EncodeRequest(request["texts"], request["path"], request.get("normalize", False), future))
+                    try:
+                        response = {"ok": True, "count": await future}
+                    except Exception as e:
+                        response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                else:
+                    response = {"ok": False, "error": f"Unknown op: {op}"}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def _next_batch(self) -> list[_EncodeRequest]:
+        batch = [await self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self._max_delay
+        while size < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _encode_batch(self, batch: list[_EncodeRequest]) -> list[Optional[Exception]]:
+        start = time.perf_counter()
+        texts = [text for request in batch for text in request.texts]
+        embeddings = self._encoder.encode(texts, batch_size=self._max_batch_size)
+        self.stats.seconds += time.perf_counter() - start
+        self.stats.batches += 1
+        self.stats.items += len(texts)
+        errors = []
+        offset = 0
+        for request in batch:
+            output = embeddings[offset:offset + len(request.texts)]
+            offset += len(request.texts)
+            if request.normalize:
+                norms = np.linalg.norm(output, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                output = output / norms
+            try:
+                if os.path.dirname(os.path.realpath(request.path)) != os.path.realpath(SHARED_MEMORY_DIR) or \
+                        not os.path.basename(request.path).startswith(SHARED_MEMORY_PREFIX):
+                    raise ValueError(f"Output path outside shared memory: {request.path}")
+                if len(request.texts) > 0:
+                    target = np.memmap(request.path, dtype=np.float32, mode="r+", shape=output.shape)
+                    target[:] = output
+                    del target
+                errors.append(None)
+            except (OSError, ValueError) as e:
+                errors.append(e)
+        return errors
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.stats.requests += len(batch)
+            try:
+                errors = await loop.run_in_executor(None, self._encode_batch, batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+            for request, error in zip(batch, errors):
+                if error is None:
+                    request.future.set_result(len(request.texts))
+                else:
+                    request.future.set_exception(error)
+
+    async def serve(self):
+        self._queue = asyncio.Queue()
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        batcher = asyncio.create_task(self._run_batches())
+        server = await asyncio.start_unix_server(self._handle_client, path=self._socket_path, limit=1 << 30)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+
+class RemoteSentenceEncoder(SentenceEncoder):
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: Optional[float] = None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile("rb")
+        self._lock = threading.Lock()
+        info = self._request({"op": "info"})
+        super().__init__(info["model"], None)
+        self._identifier = info["identifier"]
+        self._dimension = info["dimension"]
+
+    def _request(self, request: dict) -> dict:
+        with self._lock:
+            self._socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError("Encoder server closed the connection")
+        response = json.loads(line)
+        if not response.get("ok", False):
+            raise RuntimeError(f"Encoder server error: {response.get('error')}")
+        return response
+
+    @property
+    def identifier(self) -> str:
+        return self._identifier
+
+    @property
+    def dimension(self) -> int:
+        return self._dimension
+
+    def ping(self) -> bool:
+        return self._request({"op": "ping"}).get("pong", False)
+
+    def token_lengths(self, texts: list[str]) -> np.ndarray:
+        return np.array(self._request({"op": "tokens", "texts": texts})["lengths"], dtype=np.int64)
+
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        return self.encode(texts)
+
+    def encode(self, texts: list[str], batch_size: int = 256, show_progress_bar: bool = False, normalize_embeddings: bool = False) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, self._dimension), dtype=np.float32)
+        start = time.perf_counter()
+        path = os.path.join(SHARED_MEMORY_DIR, f"{SHARED_MEMORY_PREFIX}{uuid.uuid4().hex}.f32")
+        result = np.memmap(path, dtype=np.float32, mode="w+", shape=(len(texts), self._dimension))
+        try:
+            self._request({"op": "encode", "texts": texts, "path": path, "normalize": normalize_embeddings})
+        finally:
+            os.remove(path)
+        self.stats.add(np.zeros(len(texts), dtype=np.int64), [np.arange(len(texts))], time.perf_counter() - start)
+        return result
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'RemoteSentenceEncoder':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,43 @@
+import asyncio
+import os
+
+from apk_analysis.daemon import DEFAULT_ANALYSIS_SOCKET_PATH, AnalysisToolsDaemon, AnalysisToolsServer
+from apk_analysis.utils import check_java_version
+
+WORK_DIR = os.path.join(".", "workspace")
+APK_DUMP_DIR = os.path.join(WORK_DIR, "apk_dump")
+
+MIN_JAVA_VERSION = "11"
+SOCKET_PATH = DEFAULT_ANALYSIS_SOCKET_PATH
+ANALYSIS_WORKERS = None
+ANALYSIS_MAX_MEMORY = None
+PING_INTERVAL = 30.0
+PING_TIMEOUT = 10.0
+ANALYSIS_APK_TIMEOUT = 600
+ANALYSIS_MEMORY_LIMIT = None
+
+
+async def main():
+    await check_java_version(MIN_JAVA_VERSION)
+    daemon = AnalysisToolsDaemon(os.path.abspath(APK_DUMP_DIR), ANALYSIS_WORKERS, ANALYSIS_MAX_MEMORY, PING_INTERVAL, PING_TIMEOUT,
+                                 apk_timeout=ANALYSIS_APK_TIMEOUT, memory_limit=ANALYSIS_MEMORY_LIMIT)
+    print("Starting analysis tools ...")
+    if not await daemon.ping():
+        raise RuntimeError("Analysis tools daemon is not responding")
+    server = AnalysisToolsServer(daemon, SOCKET_PATH)
+    print(f"Serving on {SOCKET_PATH}, set ANALYSIS_SERVER_SOCKET in main_apk.py to connect")
+    try:
+        await server.serve()
+    finally:
+        print(daemon.stats)
+
+
+if __name__ == "__main__":
+    looper = asyncio.get_event_loop()
+    try:
+        looper.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not looper.is_closed:
+            looper.close()
@@ -2,24 +2,38 @@ import asyncio
 import dataclasses
 import json
 import os
-from typing import Optional
+from typing import AsyncIterator, Optional
 from urllib.parse import urlparse
 
 import aiofiles
 import aiofiles.os
+import numpy as np
 from dataclasses_json import DataClassJsonMixin
 
-from apk_analysis.analysis import run_analysis_tools
+from apk_analysis.analysis import AnalysisQuarantine, AnalysisToolResult, iter_sharded_analysis_tools
+from apk_analysis.cache import CleanTextCache
+from apk_analysis.daemon import RemoteAnalysisTools
 from apk_analysis.data import AndroidPermissions, AndroidAPILevel
-from apk_analysis.dataset import clean_raw_apk_dump_english_strings, generate_dataset, load_apk_dump, load_strings_from_dump
-from apk_analysis.nlp import calculate_transformer_cosine_similarity, filter_english_text
-from apk_analysis.utils import check_java_version, load_data
+from apk_analysis.data import APKAnalysisResult
+from apk_analysis.dataset import clean_raw_apk_dump_english_strings, load_apk_dump, load_strings_from_dump
+from apk_analysis.embedding import EmbeddingStore
+from apk_analysis.encoder import SentenceEncoder, load_sentence_encoder
+from apk_analysis.lexical import LexicalPrefilter, measure_cascade_recall
+from apk_analysis.nlp import LanguageDetectorPool, LanguageFilterStats, calculate_cascade_similarity, calculate_transformer_centroid_similarity, \
+    filter_english_text, get_text_cleaner_namespace, init_text_cleaner
+from apk_analysis.pipeline import Pipeline, PipelineStage
+from apk_analysis.pool import PreloadedPool
+from apk_analysis.utils import check_java_version, get_workers_size, load_data
 
 WORK_DIR = os.path.join(".", "workspace")
 
 APK_DIR = os.path.join(WORK_DIR, "apks")
 APK_DUMP_DIR = os.path.join(WORK_DIR, "apk_dump")
 RESULT_DIR = os.path.join(WORK_DIR, "result")
+CACHE_DIR = os.path.join(WORK_DIR, "cache")
+CLEAN_TEXT_CACHE_PATH = os.path.join(CACHE_DIR, "clean_text_cache.sqlite")
+EMBEDDING_STORE_DIR = os.path.join(CACHE_DIR, "embeddings")
+ANALYSIS_QUARANTINE_PATH = os.path.join(CACHE_DIR, "analysis_quarantine.json")
 
 DATASET_DIR = os.path.join(".", "resources", "dataset")
 PRIVACY_TYPES_PATH = os.path.join(DATASET_DIR, "privacy_types", "category_labels.json")
@@ -34,6 +48,27 @@ DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD = 0.3
 MODEL_EN_LG = "en_core_web_lg"
 # noinspection SpellCheckingInspection
 MODEL_TRANSFORMER_SIMILARITY = "MSMARCO-distilbert-base-v4"
+SENTENCE_SPLITTER = "parser"
+CLEAN_TEXT_CACHE_SIZE = 1024 * 1024 * 1024
+EMBEDDING_QUANTIZATION = "float32"
+ENCODER_THREADS = None
+ENCODER_SERVER_SOCKET = None
+ENCODER_MODEL = MODEL_TRANSFORMER_SIMILARITY if ENCODER_SERVER_SOCKET is None else f"server:{ENCODER_SERVER_SOCKET}"
+LEXICAL_PREFILTER = True
+LEXICAL_PREFILTER_MIN_OVERLAP = 1
+LEXICAL_PREFILTER_RECALL_CHECK = False
+TEXT_CLEANER_WORKERS = None
+ANALYSIS_JVMS = None
+ANALYSIS_JVM_WORKERS = 2
+ANALYSIS_MEMORY_RATIO = 0.5
+ANALYSIS_APK_TIMEOUT = 600
+ANALYSIS_MEMORY_LIMIT_RATIO = 1.5
+ANALYSIS_SERVER_SOCKET = None
+LOAD_WORKERS = 2
+CLEAN_WORKERS = 2
+SCORE_WORKERS = 1
+REPORT_WORKERS = 1
+PIPELINE_QUEUE_SIZE = 4
 
 DANGEROUS_PERMISSION_LEVELS = {"dangerous", "signature", "signatureOrSystem", "privileged"}
 REMOTE_HOST_SCHEMES = {"http", "https", "wss", "ftp", "ssl", "tcp", "udp", "telnet", "ldap", "rtp"}
@@ -82,6 +117,23 @@ class APKReport(DataClassJsonMixin):
     privacy_protection_measures: list[str]
 
 
+@dataclasses.dataclass
+class APKPipelineItem:
+    apk_path: str
+    analysis_result: Optional[AnalysisToolResult] = None
+    apk_dump: Optional[APKAnalysisResult] = None
+    clean_en_strings: Optional[list[str]] = None
+    privacy_types: Optional[list[str]] = None
+    data_protection_types: Optional[list[str]] = None
+
+    @property
+    def name(self) -> str:
+        return self.apk_dump.manifest.package_name if self.apk_dump is not None else os.path.basename(self.apk_path)
+
+    def __str__(self) -> str:
+        return self.name
+
+
 async def get_categories(category_labels_path: str) -> dict[str, set[str]]:
     if await aiofiles.os.path.exists(category_labels_path):
         content: dict[str, list[str]] = await load_data(category_labels_path)
@@ -167,14 +219,55 @@ def calculate_http_ssl_ratio(hosts: list[RemoteHost]) -> Optional[float]:
         return https / total
 
 
-def analyze_category_types(clean_en_strings: list[str], category_types: dict[str, set[str]], threshold: float) -> list[str]:
-    similarities = calculate_transformer_cosine_similarity(clean_en_strings, category_types, MODEL_TRANSFORMER_SIMILARITY)
-    df = generate_dataset(similarities).to_pandas()
-    result = [(col.replace("_", " "), df[col][df[col] >= threshold].count()) for col in df]
+def analyze_category_types(
+        clean_en_strings: list[str],
+        category_types: dict[str, set[str]],
+        threshold: float,
+        sentence_encoder: SentenceEncoder,
+        embedding_store: Optional[EmbeddingStore] = None
+) -> list[str]:
+    def _score(texts: list[str]) -> tuple[np.ndarray, list[str]]:
+        return calculate_transformer_centroid_similarity(texts, category_types, sentence_encoder, store=embedding_store)
+
+    if LEXICAL_PREFILTER:
+        prefilter = LexicalPrefilter(category_types, LEXICAL_PREFILTER_MIN_OVERLAP)
+        scores, categories, mask = calculate_cascade_similarity(clean_en_strings, prefilter, _score)
+        print(f"Lexical prefilter kept {int(mask.sum())}/{len(mask)} text")
+        if LEXICAL_PREFILTER_RECALL_CHECK:
+            full_scores, _ = _score(clean_en_strings)
+            print(f"Lexical prefilter recall: {measure_cascade_recall(full_scores, scores, mask, threshold)}")
+    else:
+        scores, categories = _score(clean_en_strings)
+    result = [(category.replace("_", " "), count) for category, count in zip(categories, (scores >= threshold).sum(axis=0).tolist())]
     result = sorted([i for i in result if i[1] > 0], key=lambda x: x[1], reverse=True)
     return [i[0] for i in result]
 
 
+def build_apk_report(apk_dump: APKAnalysisResult, app_privacy_types: list[str], app_data_protection_types: list[str],
+                     api_levels: dict[int, AndroidAPILevel], permissions: AndroidPermissions) -> APKReport:
+    remote_hosts, other_uris = filter_remote_hosts(apk_dump.strings.uris)
+    return APKReport(
+        application_name=apk_dump.manifest.application_name,
+        package_name=apk_dump.manifest.package_name,
+        min_sdk_version=apk_dump.manifest.min_sdk_version,
+        min_sdk_version_name=get_api_version_name(apk_dump.manifest.min_sdk_version, api_levels),
+        target_sdk_version=apk_dump.manifest.target_sdk_version,
+        target_sdk_version_name=get_api_version_name(apk_dump.manifest.target_sdk_version, api_levels),
+        version_code=apk_dump.manifest.version_code,
+        version_name=apk_dump.manifest.version_name,
+        use_permissions=[get_apk_permission(i, permissions) for i in apk_dump.manifest.use_permissions],
+        api_call_permissions=[get_apk_permission(i, permissions) for i in apk_dump.dex_api_permissions.api_call_permissions],
+        content_provider_permissions=[get_apk_permission(i, permissions) for i in apk_dump.dex_api_permissions.content_provider_permissions],
+        ip_list=apk_dump.strings.ipv4,
+        uri_list=other_uris,
+        host_list=remote_hosts,
+        http_ssl_ratio=calculate_http_ssl_ratio(remote_hosts),
+        trackers=[APKTracker(name=i.name, website=i.website, categories=i.categories) for i in apk_dump.trackers],
+        privacy_data_collections=[reformat_text(i) for i in app_privacy_types],
+        privacy_protection_measures=[reformat_text(i) for i in app_data_protection_types]
+    )
+
+
 async def main():
     print("Init environment ...")
     await check_java_version(MIN_JAVA_VERSION)
@@ -182,69 +275,84 @@ async def main():
     permissions = await load_permissions(PERMISSIONS_REL_PATH)
     privacy_types = await get_categories(PRIVACY_TYPES_PATH)
     data_protection_types = await get_categories(DATA_PROTECTION_PATH)
-
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    clean_text_cache = CleanTextCache(CLEAN_TEXT_CACHE_PATH, get_text_cleaner_namespace(MODEL_EN_LG, SENTENCE_SPLITTER), CLEAN_TEXT_CACHE_SIZE)
+    language_detector = LanguageDetectorPool.instance(accuracy=True)
+    text_cleaner_pool = PreloadedPool(get_workers_size(0.5, TEXT_CLEANER_WORKERS), preload=init_text_cleaner, preload_args=(MODEL_EN_LG, SENTENCE_SPLITTER),
+                                      name="Text cleaner")
+    sentence_encoder = load_sentence_encoder(ENCODER_MODEL, ENCODER_THREADS)
+    embedding_store = EmbeddingStore.open(EMBEDDING_STORE_DIR, sentence_encoder.identifier, quantization=EMBEDDING_QUANTIZATION)
+
+    analysis_quarantine = AnalysisQuarantine(ANALYSIS_QUARANTINE_PATH)
     apk_paths = [os.path.join(APK_DIR, i) for i in os.listdir(APK_DIR) if not i.startswith(".") and i.endswith(".apk")]
-    print(f"Found {len(apk_paths)} APK")
-
-    print()
-
-    print("Running code analysis ...")
-    analysis_results = await run_analysis_tools(APK_DUMP_DIR, apk_paths)
-    success_analysis_results = [i for b, i in analysis_results.values() if b]
-    print(f"Success: {len(success_analysis_results)}   Failed: {len(analysis_results) - len(success_analysis_results)}")
+    print(f"Found {len(apk_paths)} APK   Quarantined: {len(analysis_quarantine)}")
 
     print()
 
-    print("Analysing strings ...")
-    for dump_path in success_analysis_results:
-        apk_dump = await load_apk_dump(dump_path)
-        print(f"App: {apk_dump.manifest.application_name} ({apk_dump.manifest.version_code}) - {apk_dump.manifest.package_name}")
-
-        print()
-
-        raw_strings = load_strings_from_dump(apk_dump)
-        print(f"Get {len(raw_strings)} raw text")
-
-        raw_en_strings = list(filter_english_text(raw_strings, accuracy=True))
-        print(f"Get {len(raw_en_strings)} raw english text")
-
-        clean_en_strings = clean_raw_apk_dump_english_strings(raw_en_strings, MODEL_EN_LG)
-        print(f"Get {len(clean_en_strings)} clean text")
-
-        print()
-
-        print("Analysing data collections ...")
-        app_privacy_types = analyze_category_types(clean_en_strings, privacy_types, PRIVACY_TYPE_SIMILARITY_THRESHOLD)
-        print()
+    async def _decompile() -> AsyncIterator[APKPipelineItem]:
+        if ANALYSIS_SERVER_SOCKET is not None:
+            async with RemoteAnalysisTools(ANALYSIS_SERVER_SOCKET, ANALYSIS_APK_TIMEOUT, analysis_quarantine) as analysis_tools:
+                async for result in analysis_tools.iter_analysis([os.path.abspath(i) for i in apk_paths]):
+                    yield APKPipelineItem(result.apk_path, analysis_result=result)
+        else:
+            async for result in iter_sharded_analysis_tools(APK_DUMP_DIR, apk_paths, ANALYSIS_JVMS, ANALYSIS_JVM_WORKERS, ANALYSIS_MEMORY_RATIO,
+                                                            ANALYSIS_APK_TIMEOUT, ANALYSIS_MEMORY_LIMIT_RATIO, analysis_quarantine):
+                yield APKPipelineItem(result.apk_path, analysis_result=result)
+
+    async def _load(item: APKPipelineItem) -> APKPipelineItem:
+        if not item.analysis_result.success:
+            raise RuntimeError(item.analysis_result.output)
+        item.apk_dump = await load_apk_dump(item.analysis_result.output)
+        print(f"App: {item.apk_dump.manifest.application_name} ({item.apk_dump.manifest.version_code}) - {item.name}")
+        return item
+
+    def _clean(item: APKPipelineItem) -> APKPipelineItem:
+        raw_strings = load_strings_from_dump(item.apk_dump)
+        language_stats = LanguageFilterStats()
+        raw_en_strings = list(filter_english_text(raw_strings, accuracy=True, stats=language_stats))
+        item.clean_en_strings = clean_raw_apk_dump_english_strings(raw_en_strings, MODEL_EN_LG, sentence_splitter=SENTENCE_SPLITTER, cache=clean_text_cache,
+                                                                   pool=text_cleaner_pool)
+        print(f"{item}: Get {len(raw_strings)} raw text, {len(raw_en_strings)} raw english text, {len(item.clean_en_strings)} clean text")
+        print(f"{item}: {language_stats}")
+        return item
+
+    def _score(item: APKPipelineItem) -> APKPipelineItem:
+        print(f"{item}: Analysing data collections ...")
+        item.privacy_types = analyze_category_types(item.clean_en_strings, privacy_types, PRIVACY_TYPE_SIMILARITY_THRESHOLD, sentence_encoder, embedding_store)
+        print(f"{item}: Analysing data protections ...")
+        item.data_protection_types = analyze_category_types(item.clean_en_strings, data_protection_types, DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD,
+                                                            sentence_encoder, embedding_store)
+        return item
+
+    async def _report(item: APKPipelineItem) -> APKPipelineItem:
+        await output_apk_report(build_apk_report(item.apk_dump, item.privacy_types, item.data_protection_types, api_levels, permissions))
+        print(f"{item}: Report exported")
+        return item
+
+    print("Analysing APK ...")
+    pipeline = Pipeline([
+        PipelineStage("Load dump", _load, LOAD_WORKERS, PIPELINE_QUEUE_SIZE),
+        PipelineStage("Clean text", _clean, CLEAN_WORKERS, PIPELINE_QUEUE_SIZE),
+        PipelineStage("Score", _score, SCORE_WORKERS, PIPELINE_QUEUE_SIZE),
+        PipelineStage("Report", _report, REPORT_WORKERS, PIPELINE_QUEUE_SIZE)
+    ])
+    try:
+        await pipeline.run(_decompile())
 
-        print("Analysing data protections ...")
-        app_data_protection_types = analyze_category_types(clean_en_strings, data_protection_types, DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD)
         print()
 
-        print(f"Exporting report ...")
-        remote_hosts, other_uris = filter_remote_hosts(apk_dump.strings.uris)
-        apk_report = APKReport(
-            application_name=apk_dump.manifest.application_name,
-            package_name=apk_dump.manifest.package_name,
-            min_sdk_version=apk_dump.manifest.min_sdk_version,
-            min_sdk_version_name=get_api_version_name(apk_dump.manifest.min_sdk_version, api_levels),
-            target_sdk_version=apk_dump.manifest.target_sdk_version,
-            target_sdk_version_name=get_api_version_name(apk_dump.manifest.target_sdk_version, api_levels),
-            version_code=apk_dump.manifest.version_code,
-            version_name=apk_dump.manifest.version_name,
-            use_permissions=[get_apk_permission(i, permissions) for i in apk_dump.manifest.use_permissions],
-            api_call_permissions=[get_apk_permission(i, permissions) for i in apk_dump.dex_api_permissions.api_call_permissions],
-            content_provider_permissions=[get_apk_permission(i, permissions) for i in apk_dump.dex_api_permissions.content_provider_permissions],
-            ip_list=apk_dump.strings.ipv4,
-            uri_list=other_uris,
-            host_list=remote_hosts,
-            http_ssl_ratio=calculate_http_ssl_ratio(remote_hosts),
-            trackers=[APKTracker(name=i.name, website=i.website, categories=i.categories) for i in apk_dump.trackers],
-            privacy_data_collections=[reformat_text(i) for i in app_privacy_types],
-            privacy_protection_measures=[reformat_text(i) for i in app_data_protection_types]
-        )
-        await output_apk_report(apk_report)
-        print()
+        print(pipeline)
+        for error in pipeline.errors:
+            print(error)
+        print(f"Clean text cache: {clean_text_cache.stats}")
+        print(f"Embedding store: {embedding_store.stats}")
+        print(language_detector.memory_report())
+        print(text_cleaner_pool.memory_report())
+    finally:
+        text_cleaner_pool.close()
+        clean_text_cache.close()
+        embedding_store.close()
 
 
 if __name__ == "__main__":
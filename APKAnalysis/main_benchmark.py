@@ -0,0 +1,181 @@
+import asyncio
+import os
+import random
+
+from apk_analysis.benchmark import benchmark_clean_text, benchmark_cosine_similarity, benchmark_normalize_text, benchmark_n_gram_similarity, benchmark_sentence_encoder, \
+    benchmark_token_batching, benchmark_lexical_prefilter, make_synthetic_corpus
+from apk_analysis.nlp import SENTENCE_SPLITTERS
+from apk_analysis.utils import load_data
+
+RESOURCES_DIR = os.path.join(".", "resources")
+BENCHMARK_DIR = os.path.join(RESOURCES_DIR, "benchmark")
+DATASET_DIR = os.path.join(RESOURCES_DIR, "dataset")
+
+CLEAN_TEXT_CORPUS_PATH = os.path.join(BENCHMARK_DIR, "clean_text_corpus.json")
+CLEAN_EN_STRING_PATH = os.path.join(DATASET_DIR, "clean_en_strings.pkl")
+PRIVACY_TYPES_CATEGORY_LABELS_PATH = os.path.join(DATASET_DIR, "privacy_types", "category_labels.json")
+DATA_PROTECTION_TYPES_CATEGORY_LABELS_PATH = os.path.join(DATASET_DIR, "data_protection_types", "category_labels.json")
+
+MODEL_EN_LG = "en_core_web_lg"
+# noinspection SpellCheckingInspection
+MODEL_TRANSFORMER_SIMILARITY = "MSMARCO-distilbert-base-v4"
+ENCODER_BENCHMARK_MODELS = [f"onnx:{MODEL_TRANSFORMER_SIMILARITY}", f"onnx-int8:{MODEL_TRANSFORMER_SIMILARITY}", f"static:{MODEL_TRANSFORMER_SIMILARITY}"]
+ENCODER_THREADS = None
+PRIVACY_TYPE_SIMILARITY_THRESHOLD = 0.15
+DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD = 0.3
+
+NORMALIZE_TEXT_CORPUS_REPEAT = 2000
+SIMILARITY_CORPUS_SIZE = 5000
+SENTENCE_ENCODER_CORPUS_SIZE = 2000
+TOKEN_BATCHING_CORPUS_REPEAT = 20
+LEXICAL_PREFILTER_CORPUS_SIZE = 20000
+LEXICAL_PREFILTER_MIN_OVERLAP = 1
+
+NORMALIZE_TEXT_BENCHMARK = True
+CLEAN_TEXT_BENCHMARK = True
+N_GRAM_SIMILARITY_BENCHMARK = True
+COSINE_SIMILARITY_BENCHMARK = True
+SENTENCE_ENCODER_BENCHMARK = True
+TOKEN_BATCHING_BENCHMARK = True
+LEXICAL_PREFILTER_BENCHMARK = True
+
+
+async def run_normalize_text_benchmark():
+    corpus: list[str] = await load_data(CLEAN_TEXT_CORPUS_PATH)
+    corpus = corpus * NORMALIZE_TEXT_CORPUS_REPEAT
+    print("Corpus size:", len(corpus))
+    identical, timings = benchmark_normalize_text(corpus)
+    print(f"Identical to legacy output: {identical}")
+    for timing in timings:
+        print(timing)
+    print()
+
+
+async def run_clean_text_benchmark():
+    corpus: list[str] = await load_data(CLEAN_TEXT_CORPUS_PATH)
+    print("Corpus size:", len(corpus))
+    for sentence_splitter in SENTENCE_SPLITTERS:
+        identical, timings = benchmark_clean_text(corpus, MODEL_EN_LG, sentence_splitter)
+        print(f"Sentence splitter: {sentence_splitter}   Identical to legacy output: {identical}")
+        for timing in timings:
+            print(timing)
+        print()
+
+
+async def load_categories(path: str) -> dict[str, set[str]]:
+    content: dict[str, list[str]] = await load_data(path)
+    return {k: set(v) for k, v in content.items()}
+
+
+async def load_privacy_types_categories() -> dict[str, set[str]]:
+    return await load_categories(PRIVACY_TYPES_CATEGORY_LABELS_PATH)
+
+
+async def run_n_gram_similarity_benchmark():
+    categories = await load_privacy_types_categories()
+    corpus = make_synthetic_corpus(categories, SIMILARITY_CORPUS_SIZE)
+    print("Categories:", len(categories), "  Labels:", sum(len(v) for v in categories.values()), "  Corpus size:", len(corpus))
+    identical, timings = benchmark_n_gram_similarity(corpus, categories)
+    print(f"Identical to legacy output: {identical}")
+    for timing in timings:
+        print(timing)
+    print()
+
+
+async def run_cosine_similarity_benchmark():
+    categories = await load_privacy_types_categories()
+    corpus = make_synthetic_corpus(categories, SIMILARITY_CORPUS_SIZE)
+    print("Corpus size:", len(corpus))
+    max_difference, timings = benchmark_cosine_similarity(corpus, categories, MODEL_EN_LG)
+    print(f"Max score difference: {max_difference:.2e}")
+    for timing in timings:
+        print(timing)
+    print()
+
+
+async def run_sentence_encoder_benchmark():
+    for name, path, threshold in [
+        ("Privacy types", PRIVACY_TYPES_CATEGORY_LABELS_PATH, PRIVACY_TYPE_SIMILARITY_THRESHOLD),
+        ("Data protection types", DATA_PROTECTION_TYPES_CATEGORY_LABELS_PATH, DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD)
+    ]:
+        categories = await load_categories(path)
+        corpus = make_synthetic_corpus(categories, SENTENCE_ENCODER_CORPUS_SIZE)
+        print(f"{name}   Corpus size: {len(corpus)}   Threshold: {threshold}")
+        for model in ENCODER_BENCHMARK_MODELS:
+            accuracy, timings = benchmark_sentence_encoder(corpus, categories, threshold, MODEL_TRANSFORMER_SIMILARITY, model, ENCODER_THREADS)
+            print(accuracy)
+            for timing in timings:
+                print(timing)
+            print()
+
+
+async def run_token_batching_benchmark():
+    categories = await load_privacy_types_categories()
+    corpus: list[str] = await load_data(CLEAN_TEXT_CORPUS_PATH)
+    corpus = corpus * TOKEN_BATCHING_CORPUS_REPEAT + make_synthetic_corpus(categories, SENTENCE_ENCODER_CORPUS_SIZE)
+    random.Random(9326).shuffle(corpus)
+    print("Corpus size:", len(corpus))
+    max_difference, results = benchmark_token_batching(corpus, MODEL_TRANSFORMER_SIMILARITY)
+    print(f"Max embedding difference: {max_difference:.2e}")
+    for name, stats in results:
+        print(f"{name}: {stats}")
+    print()
+
+
+async def run_lexical_prefilter_benchmark():
+    corpus: list[str] = await load_data(CLEAN_EN_STRING_PATH)
+    if len(corpus) > LEXICAL_PREFILTER_CORPUS_SIZE:
+        corpus = random.Random(9326).sample(corpus, LEXICAL_PREFILTER_CORPUS_SIZE)
+    for name, path, threshold in [
+        ("Privacy types", PRIVACY_TYPES_CATEGORY_LABELS_PATH, PRIVACY_TYPE_SIMILARITY_THRESHOLD),
+        ("Data protection types", DATA_PROTECTION_TYPES_CATEGORY_LABELS_PATH, DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD)
+    ]:
+        categories = await load_categories(path)
+        print(f"{name}   Corpus size: {len(corpus)}   Threshold: {threshold}   Min overlap: {LEXICAL_PREFILTER_MIN_OVERLAP}")
+        recall, timings = benchmark_lexical_prefilter(corpus, categories, threshold, MODEL_TRANSFORMER_SIMILARITY, LEXICAL_PREFILTER_MIN_OVERLAP,
+                                                      ENCODER_THREADS)
+        print(recall)
+        for timing in timings:
+            print(timing)
+        print()
+
+
+async def main():
+    if NORMALIZE_TEXT_BENCHMARK:
+        print("----- Normalize text -----")
+        await run_normalize_text_benchmark()
+
+    if CLEAN_TEXT_BENCHMARK:
+        print("----- Clean text -----")
+        await run_clean_text_benchmark()
+
+    if N_GRAM_SIMILARITY_BENCHMARK:
+        print("----- N gram similarity -----")
+        await run_n_gram_similarity_benchmark()
+
+    if COSINE_SIMILARITY_BENCHMARK:
+        print("----- Cosine similarity -----")
+        await run_cosine_similarity_benchmark()
+
+    if SENTENCE_ENCODER_BENCHMARK:
+        print("----- Sentence encoder -----")
+        await run_sentence_encoder_benchmark()
+
+    if TOKEN_BATCHING_BENCHMARK:
+        print("----- Token batching -----")
+        await run_token_batching_benchmark()
+
+    if LEXICAL_PREFILTER_BENCHMARK:
+        print("----- Lexical prefilter -----")
+        await run_lexical_prefilter_benchmark()
+
+
+if __name__ == "__main__":
+    looper = asyncio.get_event_loop()
+    try:
+        looper.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not looper.is_closed:
+            looper.close()
@@ -1,15 +1,26 @@
 import asyncio
 import gc
 import os
-from typing import Callable
-
-from apk_analysis.dataset import get_all_apk_dump_english_strings, get_clean_all_raw_apk_dump_english_strings, dump_dataset, load_dataset, get_dataset_path
+from typing import Callable, Iterator, Optional
+
+from apk_analysis.cache import CleanTextCache
+from apk_analysis.dataset import get_all_apk_dump_english_strings, get_clean_all_raw_apk_dump_english_strings, get_dataset_path, write_dataset_blocks, \
+    iter_dataset_blocks, DatasetSummary
+from apk_analysis.dedup import NearDuplicateClusters, cluster_near_duplicates
+from apk_analysis.embedding import EmbeddingStore
+from apk_analysis.encoder import SentenceEncoder, load_sentence_encoder
 from apk_analysis.graph import load_graph, get_category_labels
-from apk_analysis.nlp import calculate_cosine_similarity, calculate_n_gram_jaccard_similarity, calculate_n_gram_similarity, calculate_transformer_cosine_similarity
+from apk_analysis.lexical import iter_term_weight_similarity
+from apk_analysis.nlp import iter_vector_cosine_similarity, iter_n_gram_jaccard_similarity, iter_n_gram_similarity, iter_transformer_cosine_similarity, \
+    iter_transformer_centroid_similarity, get_text_cleaner_namespace
+from apk_analysis.scores import AnyScoreBlock, iter_sparse_score_blocks
 
 RESOURCES_DIR = os.path.join(".", "resources")
 APK_DUMP_DIR = os.path.join(RESOURCES_DIR, "apk_dump")
 DATASET_DIR = os.path.join(RESOURCES_DIR, "dataset")
+CACHE_DIR = os.path.join(RESOURCES_DIR, "cache")
+CLEAN_TEXT_CACHE_PATH = os.path.join(CACHE_DIR, "clean_text_cache.sqlite")
+EMBEDDING_STORE_DIR = os.path.join(CACHE_DIR, "embeddings")
 
 RAW_EN_STRING_PATH = os.path.join(DATASET_DIR, "raw_en_strings")
 CLEAN_EN_STRING_PATH = os.path.join(DATASET_DIR, "clean_en_strings")
@@ -27,10 +38,19 @@ COSINE_DATASET_FILE = "cosine_dataset"
 N_GRAM_JACCARD_DATASET_FILE = "n_gram_jaccard_dataset"
 N_GRAM_DATASET_FILE = "n_gram_dataset"
 TRANSFORMER_DATASET_FILE = "transformer_dataset"
+TERM_WEIGHT_DATASET_FILE = "term_weight_dataset"
 
 MODEL_EN_LG = "en_core_web_lg"
 # noinspection SpellCheckingInspection
 MODEL_TRANSFORMER_SIMILARITY = "MSMARCO-distilbert-base-v4"
+SENTENCE_SPLITTER = "parser"
+CLEAN_TEXT_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+EMBEDDING_QUANTIZATION = "float32"
+ENCODER_THREADS = None
+ENCODER_SERVER_SOCKET = None
+ENCODER_MODEL = MODEL_TRANSFORMER_SIMILARITY if ENCODER_SERVER_SOCKET is None else f"server:{ENCODER_SERVER_SOCKET}"
+PRIVACY_TYPE_SIMILARITY_THRESHOLD = 0.15
+DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD = 0.3
 
 PRIVACY_TYPES = True
 DATA_PROTECTION_TYPES = True
@@ -39,6 +59,18 @@ COSINE_SIMILARITY = True
 N_GRAM_JACCARD_SIMILARITY = True
 N_GRAM_SIMILARITY = True
 TRANSFORMER_SIMILARITY = True
+TERM_WEIGHT_SIMILARITY = True
+
+N_GRAM_JACCARD_BACKEND = "sparse"
+TRANSFORMER_CENTROID = True
+TERM_WEIGHTING = "bm25"
+
+NEAR_DUPLICATE_CLUSTERING = True
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NEAR_DUPLICATE_SHINGLE_SIZE = 1
+
+SPARSE_SCORES = False
+SPARSE_TOP_K = 5
 
 DUMP_PICKLE = True
 
@@ -50,35 +82,44 @@ def prepare_dir():
         os.makedirs(PRIVACY_TYPES_DIR)
     if not os.path.exists(DATA_PROTECTION_TYPES_DIR):
         os.makedirs(DATA_PROTECTION_TYPES_DIR)
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
 
 
 async def calculate_similarities(
         clean_en_strings: list[str],
         categories: dict[str, set[str]],
         output_dir: str,
-        dump_pickle: bool
+        dump_pickle: bool,
+        embedding_store: Optional[EmbeddingStore] = None,
+        sparse_threshold: Optional[float] = None,
+        clusters: Optional[NearDuplicateClusters] = None,
+        sentence_encoder: Optional[SentenceEncoder] = None
 ):
-    async def _calculate_similarity(task_name: str, file_name: str, func: Callable[[], dict[int, dict[str, float]]]):
+    async def _calculate_similarity(task_name: str, file_name: str, func: Callable[[], Iterator[AnyScoreBlock]], clustered: bool = False):
         dataset_path = get_dataset_path(output_dir, file_name, dump_pickle)
         if not os.path.exists(dataset_path):
-            print(f"Calculating {task_name} ...")
-            result = func()
-            print(f"Dumping {task_name} dataset ...")
-            dataset_result = await dump_dataset(dataset_path, result, dump_pickle)
-            del result
+            print(f"Calculating {task_name} and dumping dataset ...")
+            blocks = func()
+            if SPARSE_SCORES:
+                blocks = iter_sparse_score_blocks(blocks, SPARSE_TOP_K, sparse_threshold)
+            if clustered:
+                blocks = clusters.expand_score_blocks(blocks)
+            summary = write_dataset_blocks(dataset_path, blocks, dump_pickle)
         else:
             print(f"Found {task_name} dataset")
-            dataset_result = load_dataset(dataset_path)
-        print("Total:", len(dataset_result.labels))
-        print("Empty:", sum([1 if all([j == 0.0 for j in i]) else 0 for i in dataset_result.labels]))
-        del dataset_result
+            summary = DatasetSummary()
+            for block in iter_dataset_blocks(dataset_path):
+                summary.add(block.scores)
+        print("Total:", summary.total)
+        print("Empty:", summary.empty)
         gc.collect()
 
     if COSINE_SIMILARITY:
         await _calculate_similarity(
             "cosine similarity",
             COSINE_DATASET_FILE,
-            lambda: calculate_cosine_similarity(clean_en_strings, categories, MODEL_EN_LG)
+            lambda: iter_vector_cosine_similarity(clean_en_strings, categories, MODEL_EN_LG)
         )
         print()
 
@@ -86,7 +127,7 @@ async def calculate_similarities(
         await _calculate_similarity(
             "n gram jaccard similarity",
             N_GRAM_JACCARD_DATASET_FILE,
-            lambda: calculate_n_gram_jaccard_similarity(clean_en_strings, categories)
+            lambda: iter_n_gram_jaccard_similarity(clean_en_strings, categories, backend=N_GRAM_JACCARD_BACKEND)
         )
         print()
 
@@ -94,19 +135,35 @@ async def calculate_similarities(
         await _calculate_similarity(
             "n gram",
             N_GRAM_DATASET_FILE,
-            lambda: calculate_n_gram_similarity(clean_en_strings, categories)
+            lambda: iter_n_gram_similarity(clean_en_strings, categories)
         )
         print()
 
     if TRANSFORMER_SIMILARITY:
+        transformer_strings = clusters.representative_strings(clean_en_strings) if clusters is not None else clean_en_strings
         await _calculate_similarity(
             "transformer",
-            TRANSFORMER_DATASET_FILE,
-            lambda: calculate_transformer_cosine_similarity(
-                clean_en_strings,
+            f"{TRANSFORMER_DATASET_FILE}_dedup_{clusters.threshold}" if clusters is not None else TRANSFORMER_DATASET_FILE,
+            lambda: iter_transformer_centroid_similarity(
+                transformer_strings,
                 categories,
-                MODEL_TRANSFORMER_SIMILARITY
-            )
+                sentence_encoder,
+                store=embedding_store
+            ) if TRANSFORMER_CENTROID else iter_transformer_cosine_similarity(
+                transformer_strings,
+                categories,
+                sentence_encoder,
+                store=embedding_store
+            ),
+            clustered=clusters is not None
+        )
+        print()
+
+    if TERM_WEIGHT_SIMILARITY:
+        await _calculate_similarity(
+            f"{TERM_WEIGHTING} term weight similarity",
+            f"{TERM_WEIGHTING}_{TERM_WEIGHT_DATASET_FILE}",
+            lambda: iter_term_weight_similarity(clean_en_strings, categories, weighting=TERM_WEIGHTING)
         )
         print()
 
@@ -142,7 +199,16 @@ async def main():
     print()
 
     print("Cleaning english strings ...")
-    clean_en_strings = await get_clean_all_raw_apk_dump_english_strings(raw_en_strings, CLEAN_EN_STRING_PATH, MODEL_EN_LG, DUMP_PICKLE)
+    with CleanTextCache(CLEAN_TEXT_CACHE_PATH, get_text_cleaner_namespace(MODEL_EN_LG, SENTENCE_SPLITTER), CLEAN_TEXT_CACHE_SIZE) as clean_text_cache:
+        clean_en_strings = await get_clean_all_raw_apk_dump_english_strings(
+            raw_en_strings,
+            CLEAN_EN_STRING_PATH,
+            MODEL_EN_LG,
+            DUMP_PICKLE,
+            SENTENCE_SPLITTER,
+            clean_text_cache
+        )
+        print("Clean text cache:", clean_text_cache.stats)
     print("Clean strings size:", len(clean_en_strings))
     print("Max text length:", max([len(i.split()) for i in clean_en_strings]))
     del raw_en_strings
@@ -150,17 +216,33 @@ async def main():
 
     print()
 
-    if PRIVACY_TYPES:
-        print("----- Calculating private types similarities -----")
-        await calculate_similarities(clean_en_strings, privacy_types_categories, PRIVACY_TYPES_DIR, DUMP_PICKLE)
+    clusters = None
+    if NEAR_DUPLICATE_CLUSTERING and TRANSFORMER_SIMILARITY:
+        print("Clustering near duplicate strings ...")
+        clusters = cluster_near_duplicates(clean_en_strings, NEAR_DUPLICATE_THRESHOLD, shingle_size=NEAR_DUPLICATE_SHINGLE_SIZE)
+        print(clusters)
 
         print()
 
-    if DATA_PROTECTION_TYPES:
-        print("----- Calculating data protection types similarities -----")
-        await calculate_similarities(clean_en_strings, data_protection_types_categories, DATA_PROTECTION_TYPES_DIR, DUMP_PICKLE)
+    sentence_encoder = load_sentence_encoder(ENCODER_MODEL, ENCODER_THREADS) if TRANSFORMER_SIMILARITY else None
+    encoder_identifier = sentence_encoder.identifier if sentence_encoder is not None else ENCODER_MODEL
 
-        print()
+    with EmbeddingStore.open(EMBEDDING_STORE_DIR, encoder_identifier, quantization=EMBEDDING_QUANTIZATION) as embedding_store:
+        if PRIVACY_TYPES:
+            print("----- Calculating private types similarities -----")
+            await calculate_similarities(clean_en_strings, privacy_types_categories, PRIVACY_TYPES_DIR, DUMP_PICKLE, embedding_store, PRIVACY_TYPE_SIMILARITY_THRESHOLD, clusters,
+                                         sentence_encoder)
+
+            print()
+
+        if DATA_PROTECTION_TYPES:
+            print("----- Calculating data protection types similarities -----")
+            await calculate_similarities(clean_en_strings, data_protection_types_categories, DATA_PROTECTION_TYPES_DIR, DUMP_PICKLE, embedding_store,
+                                         DATA_COLLECTION_TYPE_SIMILARITY_THRESHOLD, clusters, sentence_encoder)
+
+            print()
+
+        print("Embedding store:", embedding_store.stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+from apk_analysis.embedding import load_embedding_store
+
+EMBEDDING_STORE_DIRS = [
+    os.path.join(".", "resources", "cache", "embeddings"),
+    os.path.join(".", "workspace", "cache", "embeddings"),
+]
+
+MAX_ENTRIES = None
+
+COMPACT = True
+
+
+async def main():
+    for root in EMBEDDING_STORE_DIRS:
+        if not os.path.exists(root):
+            continue
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            print(f"----- {path} -----")
+            with load_embedding_store(path) as store:
+                print(store.report())
+                if MAX_ENTRIES is not None:
+                    store.evict(MAX_ENTRIES)
+                    print(f"Evicted: {store.stats.evictions}")
+                if COMPACT:
+                    print("Compacting ...")
+                    store.compact()
+                    print(store.report())
+            print()
+
+
+if __name__ == "__main__":
+    looper = asyncio.get_event_loop()
+    try:
+        looper.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not looper.is_closed:
+            looper.close()
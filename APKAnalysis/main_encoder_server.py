@@ -0,0 +1,33 @@
+import asyncio
+
+from apk_analysis.encoder import load_sentence_encoder
+from apk_analysis.server import DEFAULT_SOCKET_PATH, EncoderServer
+
+# noinspection SpellCheckingInspection
+MODEL_TRANSFORMER_SIMILARITY = "MSMARCO-distilbert-base-v4"
+ENCODER_THREADS = None
+
+SOCKET_PATH = DEFAULT_SOCKET_PATH
+MAX_BATCH_SIZE = 1024
+MAX_DELAY = 0.01
+
+
+async def main():
+    print(f"Loading {MODEL_TRANSFORMER_SIMILARITY} ...")
+    server = EncoderServer(load_sentence_encoder(MODEL_TRANSFORMER_SIMILARITY, ENCODER_THREADS), SOCKET_PATH, MAX_BATCH_SIZE, MAX_DELAY)
+    print(f"Serving on {SOCKET_PATH}, use encoder model \"server:{SOCKET_PATH}\" to connect")
+    try:
+        await server.serve()
+    finally:
+        print(server.stats)
+
+
+if __name__ == "__main__":
+    looper = asyncio.get_event_loop()
+    try:
+        looper.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not looper.is_closed:
+            looper.close()
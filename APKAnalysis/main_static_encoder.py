@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+from apk_analysis.encoder import STATIC_EMBEDDING_DIMENSION, StaticSentenceEncoder, distill_static_embeddings, get_static_encoder_path
+from apk_analysis.utils import load_strings
+
+RESOURCES_DIR = os.path.join(".", "resources")
+DATASET_DIR = os.path.join(RESOURCES_DIR, "dataset")
+CLEAN_EN_STRING_PATHS = [os.path.join(DATASET_DIR, "clean_en_strings.pkl"), os.path.join(DATASET_DIR, "clean_en_strings.json")]
+
+# noinspection SpellCheckingInspection
+MODEL_TRANSFORMER_SIMILARITY = "MSMARCO-distilbert-base-v4"
+ENCODER_THREADS = None
+
+DIMENSION = STATIC_EMBEDDING_DIMENSION
+SIF_WEIGHTING = True
+SIF_COEFFICIENT = 1e-3
+
+
+async def main():
+    corpus = None
+    if SIF_WEIGHTING:
+        for path in CLEAN_EN_STRING_PATHS:
+            if os.path.exists(path):
+                print(f"Loading token frequency corpus {path} ...")
+                corpus = await load_strings(path)
+                print("Corpus size:", len(corpus))
+                break
+        else:
+            print("No clean strings found, skip SIF weighting")
+
+    path = get_static_encoder_path(MODEL_TRANSFORMER_SIMILARITY)
+    print(f"Distilling {MODEL_TRANSFORMER_SIMILARITY} into {path} ...")
+    distill_static_embeddings(MODEL_TRANSFORMER_SIMILARITY, path, DIMENSION, corpus, SIF_COEFFICIENT, threads=ENCODER_THREADS)
+    encoder = StaticSentenceEncoder(path)
+    print(f"Dimension: {encoder.dimension}")
+    print(f"Use encoder model \"static:{MODEL_TRANSFORMER_SIMILARITY}\" to score with it")
+
+
+if __name__ == "__main__":
+    looper = asyncio.get_event_loop()
+    try:
+        looper.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not looper.is_closed:
+            looper.close()
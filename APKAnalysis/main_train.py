@@ -6,6 +6,7 @@ from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 from transformers import AutoTokenizer, AlbertForSequenceClassification, AlbertTokenizerFast
 
+from apk_analysis.batching import BatchingStats, predict_multi_label
 from apk_analysis.dataset import load_dataset, TextDataset
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -89,6 +90,12 @@ def main():
 
                 pbar.set_postfix({"Loss": loss.item(), "Avg loss": sum(total_loss) / len(total_loss)})
 
+    batching_stats = BatchingStats()
+    val_scores = predict_multi_label(model, tokenizer, val_texts, DEVICE, max_token_vector_length, stats=batching_stats, show_progress_bar=True)
+    val_loss = torch.nn.functional.binary_cross_entropy(torch.from_numpy(val_scores), torch.tensor(val_labels, dtype=torch.float32))
+    print("Validation loss:", val_loss.item())
+    print(batching_stats)
+
 
 if __name__ == "__main__":
     main()
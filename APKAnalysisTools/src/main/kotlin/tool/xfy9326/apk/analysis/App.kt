@@ -1,6 +1,7 @@
 package tool.xfy9326.apk.analysis
 
 import com.github.ajalt.clikt.core.CliktCommand
+import com.github.ajalt.clikt.core.UsageError
 import com.github.ajalt.clikt.core.context
 import com.github.ajalt.clikt.output.MordantHelpFormatter
 import com.github.ajalt.clikt.parameters.arguments.argument
@@ -12,11 +13,12 @@ import com.github.ajalt.clikt.parameters.types.path
 import com.github.ajalt.clikt.parameters.types.restrictTo
 import kotlinx.coroutines.*
 import kotlinx.coroutines.sync.Mutex
+import kotlinx.coroutines.sync.Semaphore
 import kotlinx.coroutines.sync.withLock
-import kotlinx.serialization.json.Json
-import kotlinx.serialization.json.decodeFromStream
-import kotlinx.serialization.json.encodeToStream
+import kotlinx.coroutines.sync.withPermit
+import kotlinx.serialization.json.*
 import tool.xfy9326.apk.analysis.analyzer.APKAnalyzer
+import tool.xfy9326.apk.analysis.android.AndroidInfoManager
 import tool.xfy9326.apk.analysis.beans.AnalysisFilter
 import tool.xfy9326.apk.analysis.beans.AnalysisResult
 import tool.xfy9326.apk.analysis.io.LocalResourcesReader
@@ -90,9 +92,16 @@ private class MainCommand : CliktCommand(
         names = arrayOf("-p", "--pretty"),
         help = "Pretty JSON output"
     ).flag(default = false)
+    private val daemon: Boolean by option(
+        names = arrayOf("-d", "--daemon"),
+        help = "Keep running and analyze APK requests read from stdin as JSON lines"
+    ).flag(default = false)
+    private val inputList: File? by option(
+        names = arrayOf("-i", "--input-list"), help = "Text file with one APK file or dir path per line"
+    ).file(mustExist = true, canBeDir = false)
     private val apkFiles: List<File> by argument(
         name = "apks", help = "APK files or dirs"
-    ).file(mustExist = true).multiple(required = true)
+    ).file(mustExist = true).multiple()
 
     private val outputMutex = Mutex()
 
@@ -103,44 +112,70 @@ private class MainCommand : CliktCommand(
         }
     }
 
+    private fun getInputFiles(): List<File> =
+        apkFiles + (inputList?.readLines()?.filter { it.isNotBlank() }?.map { File(it) } ?: emptyList())
+
     override fun run() {
-        runBlocking(getAnalysisCoroutineContext(workers)) {
-            suspendRun()
+        if (!daemon && apkFiles.isEmpty() && inputList == null) throw UsageError("Require APK files or dirs, or an input list")
+        if (daemon) {
+            runBlocking(CoroutineName("$APP_NAME-Daemon")) {
+                suspendDaemonRun(getAnalysisCoroutineContext(workers))
+            }
+        } else {
+            runBlocking(getAnalysisCoroutineContext(workers)) {
+                suspendRun()
+            }
+        }
+    }
+
+    private fun getWorkersSize(): Int =
+        if (workers > 0) workers else Runtime.getRuntime().availableProcessors()
+
+    private fun getJson(): Json = Json {
+        prettyPrint = pretty
+        encodeDefaults = true
+    }
+
+    private suspend fun analyzeAPK(file: File, json: Json): Path {
+        val analysisResult = APKAnalyzer.getAnalysisResult(file, analysisFilter)
+        val outputPath = outputDir.resolve(analysisResult.getOutputName())
+        withContext(Dispatchers.IO) {
+            outputPath.outputStream().use {
+                json.encodeToStream(analysisResult, it)
+            }
         }
+        return outputPath
     }
 
 
     private suspend fun suspendRun() = coroutineScope {
         if (outputDir.notExists()) outputDir.createDirectories()
-        val allFiles = apkFiles.collectAllAPKs().toList()
+        val allFiles = getInputFiles().collectAllAPKs().toList()
 
-        val json = Json {
-            prettyPrint = pretty
-            encodeDefaults = true
-        }
+        val json = getJson()
 
+        val semaphore = Semaphore(getWorkersSize())
         var taskCounter = 0
         var failedCounter = 0
         println("Total: ${allFiles.size}")
         allFiles.map { file ->
             async(Dispatchers.Default) {
-                try {
-                    val analysisResult = APKAnalyzer.getAnalysisResult(file, analysisFilter)
-                    val outputPath = outputDir.resolve(analysisResult.getOutputName())
-                    withContext(Dispatchers.IO) {
-                        outputPath.outputStream().use {
-                            json.encodeToStream(analysisResult, it)
-                        }
-                    }
+                semaphore.withPermit {
                     outputMutex.withLock {
-                        taskCounter += 1
-                        println("Success ($taskCounter/${allFiles.size}): '${file.path}' -> '$outputPath'")
+                        println("Start: '${file.path}'")
                     }
-                } catch (e: Exception) {
-                    outputMutex.withLock {
-                        taskCounter += 1
-                        failedCounter += 1
-                        println("Error ($taskCounter/${allFiles.size}): '${file.path}' -> '$e'")
+                    try {
+                        val outputPath = analyzeAPK(file, json)
+                        outputMutex.withLock {
+                            taskCounter += 1
+                            println("Success ($taskCounter/${allFiles.size}): '${file.path}' -> '$outputPath'")
+                        }
+                    } catch (e: Exception) {
+                        outputMutex.withLock {
+                            taskCounter += 1
+                            failedCounter += 1
+                            println("Error ($taskCounter/${allFiles.size}): '${file.path}' -> '$e'")
+                        }
                     }
                 }
             }
@@ -148,4 +183,81 @@ private class MainCommand : CliktCommand(
 
         println("Finish: Success -> ${taskCounter - failedCounter} | Failed -> $failedCounter")
     }
-}
\ No newline at end of file
+
+    private suspend fun printResponse(response: JsonObject) = outputMutex.withLock {
+        println(response)
+    }
+
+    private suspend fun analyzeRequest(id: JsonElement?, path: String, json: Json) {
+        printResponse(buildJsonObject {
+            put("op", "start")
+            id?.let { put("id", it) }
+            put("path", path)
+        })
+        val response = try {
+            val outputPath = analyzeAPK(File(path), json)
+            buildJsonObject {
+                put("op", "result")
+                id?.let { put("id", it) }
+                put("path", path)
+                put("success", true)
+                put("output", outputPath.toString())
+            }
+        } catch (e: Exception) {
+            buildJsonObject {
+                put("op", "result")
+                id?.let { put("id", it) }
+                put("path", path)
+                put("success", false)
+                put("output", e.toString())
+            }
+        }
+        printResponse(response)
+    }
+
+    private suspend fun suspendDaemonRun(analysisContext: CoroutineContext) = coroutineScope {
+        if (outputDir.notExists()) outputDir.createDirectories()
+        AndroidInfoManager.preload()
+
+        val json = getJson()
+        val semaphore = Semaphore(getWorkersSize())
+        val reader = System.`in`.bufferedReader()
+
+        printResponse(buildJsonObject { put("op", "ready") })
+        while (true) {
+            val line = withContext(Dispatchers.IO) { reader.readLine() } ?: break
+            if (line.isBlank()) continue
+            val request = try {
+                Json.parseToJsonElement(line).jsonObject
+            } catch (e: Exception) {
+                printResponse(buildJsonObject {
+                    put("op", "error")
+                    put("output", e.toString())
+                })
+                continue
+            }
+            val id = request["id"]
+            val path = request["path"]?.jsonPrimitive?.contentOrNull
+            when (request["op"]?.jsonPrimitive?.contentOrNull) {
+                "ping" -> printResponse(buildJsonObject {
+                    put("op", "pong")
+                    id?.let { put("id", it) }
+                })
+                "analyze" -> if (path != null) {
+                    launch(analysisContext) { semaphore.withPermit { analyzeRequest(id, path, json) } }
+                } else {
+                    printResponse(buildJsonObject {
+                        put("op", "error")
+                        id?.let { put("id", it) }
+                        put("output", "Missing path")
+                    })
+                }
+                else -> printResponse(buildJsonObject {
+                    put("op", "error")
+                    id?.let { put("id", it) }
+                    put("output", "Unknown op: ${request["op"]}")
+                })
+            }
+        }
+    }
+}
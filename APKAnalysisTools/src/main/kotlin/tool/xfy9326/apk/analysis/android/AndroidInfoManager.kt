@@ -3,6 +3,8 @@
 package tool.xfy9326.apk.analysis.android
 
 import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.coroutineScope
+import kotlinx.coroutines.launch
 import tool.xfy9326.apk.analysis.beans.AndroidAPIPermission
 import tool.xfy9326.apk.analysis.beans.AndroidContentProvider
 import tool.xfy9326.apk.analysis.beans.Tracker
@@ -73,4 +75,13 @@ object AndroidInfoManager {
         } ?: throw NoSuchElementException("No available API version $targetVersion!")
 
     suspend fun getTrackersIndex(): TrackersIndex = trackersIndexCacheMap.value()
+
+    suspend fun preload() = coroutineScope {
+        launch { getContentProvidersMap() }
+        launch { getAuthorityClassesMap() }
+        launch { getTrackersIndex() }
+        for (version in dalvikDescriptorCacheMap.keys) {
+            launch { getDalvikInvokePermissionMapping(version, true) }
+        }
+    }
 }
\ No newline at end of file